@@ -25,6 +25,8 @@ Arguments classes for tests
 
 from insanity.log import debug, info
 from insanity.generator import Generator
+from insanity.threads import CallbackThread
+from insanity.expansion import select_indexes, CARTESIAN
 
 class Arguments(object):
     """
@@ -40,12 +42,25 @@ class Arguments(object):
     If a dynamic arguments produces multiple return values, you need
     to name that argument as the coma-separated concatenation of the
     individual arguments. Ex : "arg1,arg2,arg3"
+
+    Combinations are produced as the generators are iterated, the first
+    generator (in alphabetical order of the argument names) varying the
+    fastest. Only the values of the generators which need to be iterated
+    more than once are kept in memory.
+
+    Combinations can also be accessed by index (the index of a combination
+    being its position in the iteration order), and slices or shards
+    (see shard()) of the combinations are Arguments iterating the given
+    subset. Those need the values of all the generators.
+
+    Instead of all the combinations, a reduced set of them can be selected
+    with expand().
     """
 
     def __init__(self, **kwargs):
         self.args = kwargs
         # split out static args from generators
-        # generators : (generator, curidx, length)
+        # generators : { key : generator }
         self.generators = {}
         self.statics = {}
         for key, value in self.args.iteritems():
@@ -59,74 +74,286 @@ class Arguments(object):
                 except StopIteration:
                     raise ValueError("generator %r for argument %r produced no items" % \
                                      (value, key,))
-                self.generators[key] = [value, 0, 0]
+                self.generators[key] = value
             else:
                 self.statics[key] = value
-        self.genlist = self.generators.keys()
-        self._initialized = False
-        self.combinations = 1
+        # sorted, so that all processes produce the combinations in the
+        # same order
+        self.genlist = sorted(self.generators.keys())
+        # [(key, [argument names])]
+        self._genkeys = [(key, key.split(",")) for key in self.genlist]
+        # iteration state of each generator
+        # [iterator, values, position, current value]
+        # iterator is None once all values are known
+        # values is None for the last generator, which is only iterated once
+        self._state = None
+        self._exhausted = False
+        self._length = None
+        self._counter = None
+        # values of the generators, only filled for random access
+        # { key : [values] }, shared with the copies
+        self._values = {}
+        # indexes of the iterated combinations (a list or an xrange),
+        # None for all of them
+        self._indexes = None
+        # how the combinations were selected, see getExpansion()
+        self._expansion = None
         self.globalidx = 0
 
+    def _copy(self, indexes=None, expansion=None):
+        res = Arguments(**self.args)
+        res._values = self._values
+        if indexes != None:
+            res._indexes = indexes
+            res._length = len(indexes)
+        else:
+            res._length = self._length
+        res._expansion = expansion
+        return res
+
     ## Iterable interface
     def __iter__(self):
         # return a copy
-        return Arguments(**self.args)
+        return self._copy(self._indexes, self._expansion)
 
     def next(self):
-        if not self._initialized:
-            self._initialize()
-        if not self.globalidx < self.combinations:
+        if self._indexes != None:
+            if self.globalidx >= len(self._indexes):
+                raise StopIteration
+            res = self._getCombination(self._indexes[self.globalidx])
+            self.globalidx += 1
+            return res
+        if self._state == None:
+            self._start()
+        if self._exhausted:
             raise StopIteration
         # return the next dict of arguments
         # contains a copy of all static arguments
         # plus the next combination of generators
         res = self.statics.copy()
         if self.generators:
-            info("we have generators")
             # extend with current generator values
-            for key in self.genlist:
-                info("key")
-                gen, idx = self.generators[key][:2]
-                # split generator name
-                keys = key.split(",")
-                if len(keys) > 1:
-                    for i in range(len(keys)):
-                        res[keys[i]] = gen[idx][i]
-                else:
-                    res[keys[0]] = gen[idx]
+            for key, keys in self._genkeys:
+                self._setValue(res, keys, self._state[key][3])
             # update values
             self._updateGeneratorsPosition()
+        else:
+            self._exhausted = True
         # update global idx
         self.globalidx += 1
         return res
 
+    def _setValue(self, res, keys, value):
+        # split generator name
+        if len(keys) > 1:
+            for i in range(len(keys)):
+                res[keys[i]] = value[i]
+        else:
+            res[keys[0]] = value
+
+    ## Random access
+    def __getitem__(self, idx):
+        """
+        Returns the combination at the given index, or an Arguments
+        iterating the combinations of the given slice.
+        """
+        length = len(self)
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(length)
+            indexes = self._indexes
+            if indexes == None:
+                indexes = xrange(start, stop, step)
+            elif isinstance(indexes, xrange):
+                count = len(xrange(start, stop, step))
+                if count:
+                    vstart = indexes[start]
+                    vstep = 1
+                    if len(indexes) > 1:
+                        vstep = indexes[1] - indexes[0]
+                    indexes = xrange(vstart, vstart + count * vstep * step, vstep * step)
+                else:
+                    indexes = []
+            else:
+                # the stop of a reversed slice can be -1
+                indexes = [indexes[i] for i in xrange(start, stop, step)]
+            expansion = dict(self._expansion or {})
+            expansion["slices"] = expansion.get("slices", []) + [(start, stop, step)]
+            return self._copy(indexes, expansion)
+        if idx < 0:
+            idx += length
+        if idx < 0 or idx >= length:
+            raise IndexError("combination index out of range")
+        if self._indexes != None:
+            idx = self._indexes[idx]
+        return self._getCombination(idx)
+
+    def shard(self, index, count):
+        """
+        Returns an Arguments iterating the index-th of count disjoint
+        subsets of the combinations (every count-th combination, starting
+        with the index-th one).
+
+        The subsets only depend on the generated values, so separate
+        processes can each run one of them.
+        """
+        if count < 1 or index < 0 or index >= count:
+            raise ValueError("invalid shard %d/%d" % (index, count))
+        return self[index::count]
+
+    def expand(self, strategy=CARTESIAN, strength=2, budget=None, seed=0):
+        """
+        Returns an Arguments iterating a subset of the combinations,
+        selected with the given strategy:
+        * CARTESIAN : all the combinations
+        * TWISE : all the combinations of the values of any 'strength'
+          generators (pairwise by default)
+        * EACH : each value of each generator at least once
+        * RANDOM : 'budget' combinations picked at random
+
+        If budget is given, at most budget combinations are selected.
+
+        The selection only depends on the generated values and the given
+        arguments (including the seed of the random choices), see
+        getExpansion().
+        """
+        if self._indexes != None:
+            raise ValueError("Can't expand a subset of the combinations")
+        sizes = [len(self._getValues(key)) for key in self.genlist]
+        indexes = select_indexes(sizes, strategy, strength, budget, seed)
+        info("Selected %d combinations out of %d with %s" % (len(indexes), len(self),
+                                                               strategy))
+        return self._copy(indexes, {"strategy" : strategy,
+                                    "strength" : strength,
+                                    "budget" : budget,
+                                    "seed" : seed})
+
+    def getExpansion(self):
+        """
+        Returns a dictionnary describing how the combinations were
+        selected (see expand()), or None if all of them are iterated:
+        * strategy, strength, budget, seed : the arguments of expand()
+        * slices : the list of (start, stop, step) slices applied
+        """
+        return self._expansion
+
+    def _getValues(self, key):
+        values = self._values.get(key)
+        if values == None:
+            values = list(self.generators[key])
+            self._values[key] = values
+        return values
+
+    def _getCombination(self, index):
+        """
+        Returns the combination at the given index of the full iteration
+        """
+        res = self.statics.copy()
+        # the index is a mixed-radix number, each digit being the position
+        # of a generator (the first one being the least significant)
+        for key, keys in self._genkeys:
+            values = self._getValues(key)
+            index, pos = divmod(index, len(values))
+            self._setValue(res, keys, values[pos])
+        return res
+
+    def _start(self):
+        debug("starting iteration")
+        self._state = {}
+        for key in self.genlist:
+            iterator = iter(self.generators[key])
+            try:
+                value = iterator.next()
+            except StopIteration:
+                self._exhausted = True
+                return
+            values = None
+            if key != self.genlist[-1]:
+                values = [value]
+            self._state[key] = [iterator, values, 0, value]
+
     def _updateGeneratorsPosition(self):
         for key in self.genlist:
             # update the position of this generator
-            apos = (self.generators[key][1] + 1) % self.generators[key][2]
-            self.generators[key][1] = apos
-            # if we didn't go over, break, else continue to update next one
-            if self.generators[key][1]:
-                break
-
-    def _initialize(self):
-        # figure out the length of all generators
-        debug("initializing")
-        cpy = {}
-        for key, value in self.generators.iteritems():
-            gen, idx, nb = value
-            nb = len(gen)
-            if nb:
-                self.combinations *= nb
-            cpy[key] = [gen, idx, nb]
-        debug("self.combinations: %d" % self.combinations)
-        self.generators = cpy
-        self._initialized = True
+            state = self._state[key]
+            iterator, values, pos = state[:3]
+            try:
+                if iterator != None:
+                    value = iterator.next()
+                    if values != None:
+                        values.append(value)
+                elif pos + 1 < len(values):
+                    value = values[pos + 1]
+                else:
+                    raise StopIteration
+                state[2] = pos + 1
+                state[3] = value
+                # we didn't go over, don't update the next ones
+                return
+            except StopIteration:
+                if values == None:
+                    # the last generator is done, so are we
+                    self._exhausted = True
+                    return
+                # go back to the first value and update the next one
+                state[0] = None
+                state[2] = 0
+                state[3] = values[0]
+        self._exhausted = True
+
+    def _countLength(self):
+        nb = 1
+        for key, gen in self.generators.iteritems():
+            if key in self._values:
+                nb *= len(self._values[key])
+            else:
+                nb *= len(gen)
+        debug("combinations: %d" % nb)
+        self._length = nb
 
     def __len__(self):
-        if not self._initialized:
-            self._initialize()
-        return self.combinations
+        if self._length == None:
+            self._countLength()
+        return self._length
+
+    def estimateLength(self):
+        """
+        Returns the number of combinations if it is known (or can be
+        cheaply estimated), else None.
+        """
+        if self._length != None:
+            return self._length
+        nb = 1
+        for gen in self.generators.itervalues():
+            genlength = gen.estimateLength()
+            if genlength == None:
+                return None
+            nb *= genlength
+        return nb
+
+    def countInBackground(self):
+        """
+        Computes the exact number of combinations in a separate thread,
+        it will then be returned by estimateLength().
+        """
+        if self._length != None or self._counter != None:
+            return
+        self._counter = CallbackThread(self._countLength)
+        # don't prevent exiting before it's done
+        self._counter.setDaemon(True)
+        self._counter.start()
+
+    def getDuplicates(self):
+        """
+        Returns a dictionnary of the generated values which weren't used
+        because they are identical to a used one:
+        * key : the used value
+        * value : the list of identical values
+        """
+        res = {}
+        for gen in self.generators.itervalues():
+            for value, duplicates in gen.getDuplicates().iteritems():
+                res.setdefault(value, []).extend(duplicates)
+        return res
 
     def current(self):
         """ Returns the current position """
@@ -323,10 +323,15 @@ class CommandLineTesterClient(TesterClient):
         if testrun:
             pos = testrun.getCurrentBatchPosition()
             length = testrun.getCurrentBatchLength()
+        if testrun and length:
             perc = float(pos * 100.0) / float(length)
             print stub, "Test %r is done (Success:%5.1f%%)  %5d / %5d  [%5.1f%%]" % (test,
                                                                                      test.getSuccessPercentage(),
                                                                                      pos, length, perc)
+        elif testrun:
+            print stub, "Test %r is done (Success:%5.1f%%)  %5d / ?" % (test,
+                                                                         test.getSuccessPercentage(),
+                                                                         pos)
         else:
             print stub, "Test %r is done (Success:%5.1f%%)" % (test, test.getSuccessPercentage())
         if self._verbose:
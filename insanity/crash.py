@@ -0,0 +1,187 @@
+# GStreamer QA system
+#
+#       crash.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Crash signatures
+
+Crashes are grouped in buckets by their signature, computed from the
+signal which killed the process and the top frames of the crashing
+thread (the function names, or the module when they aren't known).
+
+The frames are read from the core file with eu-stack (elfutils) if
+available, which is much faster than loading all the symbols in gdb.
+"""
+
+import os
+import re
+import signal
+import threading
+import subprocess
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+from insanity.log import debug, exception
+
+# default number of frames used for the signatures
+SIGNATURE_FRAMES = 5
+
+# "#0  0x00007f3b2c8a6e97 raise - /lib/libc.so.6"
+_EUSTACK_FRAME = re.compile(r"^#\d+\s+0x[0-9a-fA-F]+(?:\s+(?!-\s)(\S+))?(?:\s+-\s+(\S+))?")
+# "#1  0x00007f3b2c8a8801 in abort () from /lib/libc.so.6"
+# "#2  gst_pad_push (pad=0x8123) at gstpad.c:4321"
+_GDB_FRAME = re.compile(r"^#\d+\s+(?:0x[0-9a-fA-F]+ in )?(\S+) \(.*?\)(?: from (\S+))?")
+
+def _frame_name(function, module):
+    if function and function != "??":
+        return function
+    if module:
+        return os.path.basename(module)
+    return "??"
+
+def parse_eustack_frames(output, nbframes=SIGNATURE_FRAMES):
+    """
+    Returns the names of the top nbframes frames of the first thread of
+    the given eu-stack output
+    """
+    frames = []
+    for line in output.splitlines():
+        if line.startswith("TID") and frames:
+            # next thread
+            break
+        match = _EUSTACK_FRAME.match(line)
+        if match:
+            frames.append(_frame_name(*match.groups()))
+            if len(frames) == nbframes:
+                break
+    return frames
+
+def parse_gdb_frames(output, nbframes=SIGNATURE_FRAMES):
+    """
+    Returns the names of the top nbframes frames of the given gdb
+    backtrace
+    """
+    frames = []
+    for line in output.splitlines():
+        match = _GDB_FRAME.match(line)
+        if match:
+            frames.append(_frame_name(*match.groups()))
+            if len(frames) == nbframes:
+                break
+    return frames
+
+def _run(args):
+    devnull = open(os.devnull, "w")
+    try:
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                       stderr=devnull)
+        except OSError:
+            # not installed
+            return None
+        return process.communicate()[0]
+    finally:
+        devnull.close()
+
+def get_core_frames(executable, core, nbframes=SIGNATURE_FRAMES):
+    """
+    Returns the names of the top nbframes frames of the crashing thread
+    of the given core file (dumped by executable).
+    """
+    output = _run(["eu-stack", "-m", "-n", str(nbframes),
+                   "-e", executable, "--core=%s" % core])
+    if output:
+        frames = parse_eustack_frames(output, nbframes)
+        if frames:
+            return frames
+    debug("eu-stack failed, using gdb")
+    output = _run(["gdb", "--batch", "-nx", "-ex", "bt %d" % nbframes,
+                   executable, core])
+    if not output:
+        return []
+    return parse_gdb_frames(output, nbframes)
+
+def signal_name(signum):
+    """
+    Returns the name of the given signal number
+    """
+    if signum == None:
+        return "no signal"
+    for name in dir(signal):
+        if name.startswith("SIG") and not name.startswith("SIG_") \
+               and getattr(signal, name) == signum:
+            return name
+    return "signal %d" % signum
+
+def compute_crash_signature(signum, frames):
+    """
+    Returns the signature of a crash from its signal number (or None) and
+    its top frames.
+    """
+    h = sha1()
+    h.update("%s\n" % signum)
+    for frame in frames:
+        h.update("%s\n" % frame)
+    return h.hexdigest()
+
+class CrashCounter(object):
+    """
+    Counts the crashes of each signature, starting from the number of
+    crashes already known by the storage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # { signature : number of crashes }
+        self._counts = {}
+
+    def add(self, signature, storage=None):
+        """
+        Accounts a new crash with the given signature, and returns the
+        number of crashes with the same signature before it.
+        """
+        self._lock.acquire()
+        try:
+            if not signature in self._counts:
+                known = 0
+                if storage:
+                    try:
+                        known = storage.getCrashBucketSize(signature)
+                    except:
+                        exception("Couldn't get the size of crash bucket %s",
+                                  signature)
+                self._counts[signature] = known
+            res = self._counts[signature]
+            self._counts[signature] += 1
+            return res
+        finally:
+            self._lock.release()
+
+_crash_counter = None
+
+def get_crash_counter():
+    """
+    Returns the CrashCounter shared in this process
+    """
+    global _crash_counter
+    if _crash_counter == None:
+        _crash_counter = CrashCounter()
+    return _crash_counter
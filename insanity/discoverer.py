@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# GStreamer QA system
+#
+#       discoverer.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Media discoverer process
+
+Reads URIs (one per line) on its standard input, and writes the pickled
+(uri, media information) of each of them to the given file descriptor,
+probing several URIs at once.
+
+This is run by insanity.mediaindex.Discoverer, see that module for the
+contents of the media information.
+"""
+
+import os
+import sys
+import cPickle
+import gobject
+gobject.threads_init()
+import gst
+from insanity.log import debug, warning, exception
+from insanity.mediaindex import is_media_type
+
+class Probe(object):
+    """
+    Typefinds and probes the streams of one URI, by prerolling it in a
+    decodebin2 pipeline.
+
+    callback is called with the probe and the media information once done.
+    """
+
+    def __init__(self, uri, timeout, callback):
+        self.uri = uri
+        self._callback = callback
+        self._streams = []
+        self._done = False
+        # ismedia stays unknown if the probe fails before typefinding
+        self._mediainfo = {"mimetype" : None,
+                           "ismedia" : None,
+                           "duration" : -1,
+                           "streams" : [],
+                           "error" : None}
+        self._timeoutid = gobject.timeout_add(timeout * 1000, self._timeoutCb)
+        self._pipeline = None
+        try:
+            self._pipeline = self._createPipeline()
+        except Exception, e:
+            exception("Couldn't create pipeline for %s", uri)
+            gobject.idle_add(self._finish, "Couldn't create pipeline: %s" % e)
+            return
+        bus = self._pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._busMessageCb)
+        if self._pipeline.set_state(gst.STATE_PAUSED) == gst.STATE_CHANGE_FAILURE:
+            gobject.idle_add(self._finish, "Couldn't preroll")
+
+    def _createPipeline(self):
+        src = gst.element_make_from_uri(gst.URI_SRC, self.uri)
+        try:
+            dbin = gst.element_factory_make("decodebin2")
+        except:
+            dbin = gst.element_factory_make("decodebin")
+        pipeline = gst.Pipeline()
+        pipeline.add(src, dbin)
+        src.link(dbin)
+        dbin.get_by_name("typefind").connect("have-type", self._haveTypeCb)
+        dbin.connect("unknown-type", self._unknownTypeCb)
+        dbin.connect("new-decoded-pad", self._newDecodedPadCb)
+        return pipeline
+
+    def _haveTypeCb(self, typefind, probability, caps):
+        mimetype = caps.to_string()
+        debug("%s : %s", self.uri, mimetype)
+        self._mediainfo["mimetype"] = mimetype
+        if not is_media_type(mimetype):
+            # no need to go further
+            self._mediainfo["ismedia"] = False
+            gobject.idle_add(self._finish)
+        else:
+            self._mediainfo["ismedia"] = True
+
+    def _unknownTypeCb(self, dbin, pad, caps):
+        self._connectFakesink(pad)
+        self._streams.append((pad, False))
+
+    def _newDecodedPadCb(self, dbin, pad, is_last):
+        self._connectFakesink(pad)
+        self._streams.append((pad, True))
+
+    def _connectFakesink(self, pad):
+        queue = gst.element_factory_make("queue")
+        fakesink = gst.element_factory_make("fakesink")
+        self._pipeline.add(queue, fakesink)
+        fakesink.set_state(gst.STATE_PAUSED)
+        queue.set_state(gst.STATE_PAUSED)
+        queue.link(fakesink)
+        pad.link(queue.get_pad("sink"))
+
+    def _busMessageCb(self, bus, message):
+        if self._done:
+            return
+        if message.type == gst.MESSAGE_ERROR:
+            error, dbg = message.parse_error()
+            self._finish(error.message)
+        elif message.type == gst.MESSAGE_STATE_CHANGED and message.src == self._pipeline:
+            old, new, pending = message.parse_state_changed()
+            if new == gst.STATE_PAUSED and pending == gst.STATE_VOID_PENDING:
+                self._analyzeStreams()
+                self._finish()
+
+    def _analyzeStreams(self):
+        streams = []
+        for pad, raw in self._streams:
+            caps = pad.get_negotiated_caps() or pad.get_caps()
+            length = -1
+            if raw:
+                try:
+                    length = pad.query_duration(gst.FORMAT_TIME)[0]
+                except:
+                    warning("duration query failed on %s", self.uri)
+            streams.append((pad.get_name(), length, caps.to_string()))
+            if raw and self._mediainfo["duration"] == -1:
+                self._mediainfo["duration"] = length
+        self._mediainfo["streams"] = streams
+
+    def _timeoutCb(self):
+        self._timeoutid = None
+        # the streams are unknown, not missing
+        self._mediainfo["streams"] = None
+        self._finish("Timed out")
+        return False
+
+    def _finish(self, error=None):
+        if self._done:
+            return False
+        self._done = True
+        if error:
+            self._mediainfo["error"] = error
+        if self._timeoutid != None:
+            gobject.source_remove(self._timeoutid)
+            self._timeoutid = None
+        if self._pipeline != None:
+            self._pipeline.get_bus().remove_signal_watch()
+            self._pipeline.set_state(gst.STATE_NULL)
+            self._pipeline = None
+        self._streams = []
+        self._callback(self, self._mediainfo)
+        return False
+
+class DiscovererProcess(object):
+    """
+    Probes the URIs read from standard input, nbworkers at a time.
+    """
+
+    def __init__(self, output, nbworkers, timeout):
+        self._output = output
+        self._nbworkers = nbworkers
+        self._timeout = timeout
+        self._pending = []
+        self._probes = []
+        self._buffer = ""
+        self._eof = False
+        self._mainloop = gobject.MainLoop()
+        gobject.io_add_watch(sys.stdin.fileno(),
+                             gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+                             self._inputCb)
+
+    def run(self):
+        self._mainloop.run()
+
+    def _inputCb(self, fd, condition):
+        data = ""
+        if condition & gobject.IO_IN:
+            data = os.read(fd, 4096)
+        if not data:
+            self._eof = True
+            self._checkDone()
+            return False
+        lines = (self._buffer + data).split("\n")
+        self._buffer = lines.pop()
+        self._pending.extend([x.strip() for x in lines if x.strip()])
+        self._startProbes()
+        return True
+
+    def _startProbes(self):
+        while self._pending and len(self._probes) < self._nbworkers:
+            uri = self._pending.pop(0)
+            self._probes.append(Probe(uri, self._timeout, self._probeDoneCb))
+
+    def _probeDoneCb(self, probe, mediainfo):
+        self._probes.remove(probe)
+        cPickle.dump((probe.uri, mediainfo), self._output, cPickle.HIGHEST_PROTOCOL)
+        self._output.flush()
+        self._startProbes()
+        self._checkDone()
+
+    def _checkDone(self):
+        if self._eof and not self._pending and not self._probes:
+            self._mainloop.quit()
+
+if __name__ == "__main__":
+    # args : <output file descriptor> <nbworkers> <timeout>
+    output = os.fdopen(int(sys.argv[1]), "wb")
+    DiscovererProcess(output, int(sys.argv[2]), int(sys.argv[3])).run()
+    output.close()
@@ -23,18 +23,46 @@
 
 """
 Environment-related methods and classes
+
+Collecting the GStreamer environment (which enumerates the whole plugin
+registry) is done in a separate process and is slow, so the result is
+cached on disk. The cache is keyed by the GST_* environment variables,
+the registry file (by its identity, not its path, since testruns use
+links to a shared registry) and the plugin directories, and is checked
+against the modification times of the directories of the plugins it
+lists. Entries which weren't used for ENVIRONMENT_CACHE_MAX_AGE are
+removed.
+
+The GStreamer registry itself is also built once and shared between
+testruns, see provideRegistry().
 """
 
 import cPickle
 import subprocess
 import os
-import tempfile
+import stat
+import time
+import fcntl
+import shutil
 import sys
 import imp
 import gobject
 gobject.threads_init()
 import gst
-from insanity.log import debug, exception
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from insanity.log import debug, info, warning, exception
+from insanity.utils import get_cache_directory
+
+# environment variables which don't change the collected environment
+UNCACHED_VARIABLES = ["GST_REGISTRY", "GST_DEBUG", "GST_DEBUG_FILE",
+                      "GST_DEBUG_NO_COLOR", "GST_DEBUG_DUMP_DOT_DIR"]
+
+# cached environments which weren't used for that long (in seconds) are
+# removed
+ENVIRONMENT_CACHE_MAX_AGE = 30 * 24 * 3600
 
 # TODO : methods/classes to retrieve/process environment
 #
@@ -43,35 +71,269 @@ from insanity.log import debug, exception
 #   gstreamer versions
 #   pluggable env retrievers
 #   Application should be able to add information of its own
-def _pollSubProcess(process, resfile, callback):
-    res = process.poll()
-    if res == None:
-        return True
-    # get dictionnary from resultfile
+def _mtime(path):
+    try:
+        return os.stat(path)[stat.ST_MTIME]
+    except OSError:
+        return None
+
+def _fileIdentity(path):
+    # the registries of testruns are links to a shared one, they must
+    # have the same identity
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st[stat.ST_MTIME])
+
+def _getPluginDirectories(environ):
+    dirs = []
+    for var in ("GST_PLUGIN_PATH", "GST_PLUGIN_SYSTEM_PATH"):
+        dirs.extend([x for x in environ.get(var, "").split(os.pathsep) if x])
+    return dirs
+
+def getEnvironmentFingerprint(environ):
+    """
+    Returns the fingerprint of the environment which would be collected
+    with the given environment variables.
+    """
+    data = [sys.executable, _mtime(sys.executable)]
+    data.extend([(k, v) for k, v in sorted(environ.items())
+                 if k.startswith("GST_") and not k in UNCACHED_VARIABLES])
+    # an empty (or missing) registry will be rebuilt from the plugin
+    # directories
+    registry = environ.get("GST_REGISTRY")
+    if registry and os.path.exists(registry) and os.path.getsize(registry):
+        data.append(_fileIdentity(registry))
+    data.extend([(x, _mtime(x)) for x in _getPluginDirectories(environ)])
+    return sha1(repr(data)).hexdigest()
+
+def _getRegistryPluginDirectories(environ):
+    dirs = _getPluginDirectories(environ)
+    if not environ.get("GST_PLUGIN_SYSTEM_PATH"):
+        # the system plugins are the ones known by our own registry
+        for plugin in gst.registry_get_default().get_plugin_list():
+            filename = plugin.get_filename()
+            if filename:
+                directory = os.path.dirname(filename)
+                if not directory in dirs:
+                    dirs.append(directory)
+    return dirs
+
+def getRegistryFingerprint(environ):
+    """
+    Returns the fingerprint of the registry which would be built with the
+    given environment variables, computed from the plugin directories and
+    the modification times of the files they contain.
+    """
+    data = [sys.executable, environ.get("GST_PLUGIN_PATH"),
+            environ.get("GST_PLUGIN_SYSTEM_PATH")]
+    for directory in _getRegistryPluginDirectories(environ):
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            files.sort()
+            data.extend([(os.path.join(root, x), _mtime(os.path.join(root, x)))
+                         for x in files])
+    return sha1(repr(data)).hexdigest()
+
+def _buildRegistry(environ, path):
+    """
+    Builds a new registry in path, using a temporary file so that path is
+    only created once the registry is complete.
+    """
+    tmp = "%s.%d" % (path, os.getpid())
+    env = dict(environ)
+    env["GST_REGISTRY"] = tmp
+    env["GST_REGISTRY_UPDATE"] = "yes"
+    pargs = [sys.executable, "-c", "import gst"]
+    info("Building registry %s", path)
+    try:
+        subprocess.call(pargs, env=env)
+        if os.path.exists(tmp) and os.path.getsize(tmp):
+            # testruns get links to it, it must not be modified
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmp, path)
+            return True
+        warning("Building registry %s failed", path)
+    except:
+        exception("Building registry %s failed", path)
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    return False
+
+def getCachedRegistry(environ):
+    """
+    Returns the path of the shared registry for the given environment
+    variables, building it if it doesn't exist or is stale.
+
+    Only one process builds a given registry, others wait for it to be
+    done.
+
+    Returns None if the registry couldn't be built.
+    """
+    directory = get_cache_directory("registry")
+    fingerprint = getRegistryFingerprint(environ)
+    path = os.path.join(directory, "%s.bin" % fingerprint)
+    if os.path.exists(path):
+        return path
+    lock = open(os.path.join(directory, "%s.lock" % fingerprint), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # it might have been built while we were waiting for the lock
+        if not os.path.exists(path) and not _buildRegistry(environ, path):
+            return None
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    return path
+
+def provideRegistry(environ, path):
+    """
+    Makes path a (read-only) copy of the shared registry for the given
+    environment variables, so that it can be used as GST_REGISTRY.
+
+    Returns True if it succeeded. Else path is left untouched and the
+    registry will be built by the first process using it.
+    """
     try:
-        wmf = open(resfile, "rb")
-        resdict = cPickle.load(wmf)
-        wmf.close()
-        os.remove(resfile)
+        cached = getCachedRegistry(environ)
     except:
-        exception("Couldn't get pickle from file %s", resfile)
+        exception("Couldn't get a shared registry")
+        cached = None
+    if cached == None:
+        return False
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(cached, path)
+    except OSError:
+        # different filesystems
+        shutil.copy(cached, path)
+    debug("Using shared registry %s for %s", cached, path)
+    return True
+
+def _getCachePath(fingerprint):
+    return os.path.join(get_cache_directory("environment"),
+                        "%s.pickle" % fingerprint)
+
+def _loadCachedEnvironment(fingerprint):
+    """
+    Returns the cached environment for the given fingerprint, or None if
+    there isn't any or if a plugin directory was modified since.
+    """
+    path = _getCachePath(fingerprint)
+    if not os.path.exists(path):
+        return None
+    try:
+        f = open(path, "rb")
+        try:
+            directories, resdict = cPickle.load(f)
+        finally:
+            f.close()
+    except:
+        exception("Couldn't load cached environment %s", path)
+        return None
+    for directory, mtime in directories.iteritems():
+        if _mtime(directory) != mtime:
+            debug("%s was modified, cached environment is stale", directory)
+            _removeCachedEnvironment(path)
+            return None
+    # remember it's still used
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return resdict
+
+def _removeCachedEnvironment(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # removed by another process
+        pass
+
+def _pruneCachedEnvironments():
+    """
+    Removes the cached environments which weren't used for
+    ENVIRONMENT_CACHE_MAX_AGE
+    """
+    directory = get_cache_directory("environment")
+    limit = time.time() - ENVIRONMENT_CACHE_MAX_AGE
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        mtime = _mtime(path)
+        if name.endswith(".pickle") and mtime != None and mtime < limit:
+            debug("Removing stale cached environment %s", path)
+            _removeCachedEnvironment(path)
+
+def _storeCachedEnvironment(fingerprint, resdict):
+    directories = {}
+    for key, value in resdict.iteritems():
+        if key.startswith("gst-registry.") and key.endswith(".filename") and value:
+            directory = os.path.dirname(value)
+            directories[directory] = _mtime(directory)
+    path = _getCachePath(fingerprint)
+    tmp = "%s.%d" % (path, os.getpid())
+    try:
+        f = open(tmp, "wb")
+        try:
+            cPickle.dump((directories, resdict), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except:
+        exception("Couldn't store cached environment %s", path)
+    _pruneCachedEnvironments()
+
+def _completeEnvironment(environ, resdict):
+    # the environment variables and machine information are cheap to get
+    # and not cached
+    res = dict(environ)
+    res["uname"] = ' '.join(os.uname())
+    res.update(resdict)
+    return res
+
+def _readSubProcess(fd, condition, process, data, fingerprint, environ, callback):
+    if condition & gobject.IO_IN:
+        buf = os.read(fd, 65536)
+        if buf:
+            data.append(buf)
+            return True
+    # end of file, the process is done
+    os.close(fd)
+    process.wait()
+    try:
+        resdict = cPickle.loads("".join(data))
+    except:
+        exception("Couldn't get pickle from environment collection process")
+        resdict = None
+    if resdict != None:
+        _storeCachedEnvironment(fingerprint, resdict)
+    else:
         resdict = {}
     # call callback with dictionnary
-    callback(resdict)
+    callback(_completeEnvironment(environ, resdict))
     return False
 
 def collectEnvironment(environ, callback):
     """
-    Using the given environment variables, spawn a new process to collect
-    various environment information.
-
-    Returns a dictionnary of information.
+    Using the given environment variables, collect various environment
+    information.
 
     When the information collection is done, the given callback will be called
     with the dictionnary of information as it's sole argument.
+
+    If the information for that environment is cached, the callback is
+    called straight away. Else a new process is spawned to collect it.
     """
-    resfile, respath = tempfile.mkstemp()
-    os.close(resfile)
+    fingerprint = getEnvironmentFingerprint(environ)
+    resdict = _loadCachedEnvironment(fingerprint)
+    if resdict != None:
+        info("Using cached environment %s", fingerprint)
+        callback(_completeEnvironment(environ, resdict))
+        return
+
+    readfd, writefd = os.pipe()
     thispath = os.path.abspath(__file__)
     # The compiled module suffix can be ".pyc" or ".pyo":
     suffixes = [s[0] for s in imp.get_suffixes()
@@ -80,17 +342,22 @@ def collectEnvironment(environ, callback):
         if thispath.endswith(suffix):
             thispath = thispath[:-len(suffix)] + ".py"
             break
-    pargs = [sys.executable, thispath, respath]
+    pargs = [sys.executable, thispath, str(writefd)]
 
     try:
         debug("spawning subprocess %r", pargs)
         proc = subprocess.Popen(pargs, env=environ)
     except:
         exception("Spawning remote process (%s) failed" % (" ".join(pargs),))
-        os.remove(respath)
+        os.close(readfd)
+        os.close(writefd)
         callback({})
     else:
-        gobject.timeout_add(500, _pollSubProcess, proc, respath, callback)
+        # only the subprocess writes to the pipe
+        os.close(writefd)
+        gobject.io_add_watch(readfd, gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+                             _readSubProcess, proc, [], fingerprint, environ,
+                             callback)
 
 ##
 ## SUBPROCESS METHODS/FUNCTIONS
@@ -100,7 +367,6 @@ def _tupletostr(atup):
     return ".".join([str(x) for x in atup])
 
 def _getGStreamerRegistry():
-    import stat
     # returns a dictionnary with the contents of the registry:
     # key : plugin-name
     # value : (version, filename, date, [features])
@@ -145,16 +411,15 @@ def _privateCollectEnvironment():
     """
     Method called from the subprocess to collect environment
     """
-    # we first get the system environment variables
-    res = os.environ.copy()
-    res["uname"] = ' '.join(os.uname())
+    # the environment variables are added by the calling process
+    res = {}
     res.update(_getGObjectEnvironment())
     res.update(_getGStreamerEnvironment())
     return res
 
 if __name__ == "__main__":
-    # args : <outputfile>
+    # args : <output file descriptor>
     d = _privateCollectEnvironment()
-    mf = open(sys.argv[1], "wb+")
-    cPickle.dump(d, mf)
+    mf = os.fdopen(int(sys.argv[1]), "wb")
+    cPickle.dump(d, mf, cPickle.HIGHEST_PROTOCOL)
     mf.close()
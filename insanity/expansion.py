@@ -0,0 +1,201 @@
+# GStreamer QA system
+#
+#       expansion.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Combination selection strategies
+
+Those select a subset of the combinations of several dimensions (the
+generators of an Arguments), each of them having a number of values.
+
+A combination is described by a row of value positions (one per
+dimension), and identified by its index, the mixed-radix number of its
+positions (the first dimension being the least significant).
+"""
+
+import random
+
+# all the combinations
+CARTESIAN = "cartesian"
+# all the combinations of values of any 'strength' dimensions
+TWISE = "t-wise"
+# each value of each dimension at least once
+EACH = "each"
+# 'budget' combinations picked at random
+RANDOM = "random"
+
+STRATEGIES = [CARTESIAN, TWISE, EACH, RANDOM]
+
+def combinations(items, nb):
+    """
+    Yields the tuples of nb items of the given list, in order
+    """
+    if nb == 0:
+        yield ()
+        return
+    for i in range(len(items) - nb + 1):
+        for rest in combinations(items[i + 1:], nb - 1):
+            yield (items[i], ) + rest
+
+def product(sizes):
+    """
+    Yields the tuples of positions of all the combinations of dimensions
+    of the given sizes, the last dimension varying the fastest.
+    """
+    if not sizes:
+        yield ()
+        return
+    for first in range(sizes[0]):
+        for rest in product(sizes[1:]):
+            yield (first, ) + rest
+
+def row_index(row, sizes):
+    """
+    Returns the index of the combination of the given positions
+    """
+    index = 0
+    for pos, size in reversed(zip(row, sizes)):
+        index = index * size + pos
+    return index
+
+def covering_array(sizes, strength=2, rnd=None):
+    """
+    Returns rows covering all the combinations of values of any 'strength'
+    dimensions (a covering array), built with the In-Parameter-Order
+    algorithm.
+
+    The positions which don't matter are picked with rnd (a
+    random.Random), or set to 0.
+    """
+    ndims = len(sizes)
+    if ndims <= strength:
+        return [list(x) for x in product(sizes)]
+    # dimensions are added from the largest one
+    order = range(ndims)
+    order.sort(key=lambda x: -sizes[x])
+    osizes = [sizes[x] for x in order]
+    rows = [list(x) for x in product(osizes[:strength])]
+    for dim in range(strength, ndims):
+        size = osizes[dim]
+        # uncovered (dimensions, their positions, position of dim)
+        uncovered = set()
+        for dims in combinations(range(dim), strength - 1):
+            for positions in product([osizes[x] for x in dims]):
+                for pos in range(size):
+                    uncovered.add((dims, positions, pos))
+        alldims = list(combinations(range(dim), strength - 1))
+        # horizontal growth : extend the existing rows
+        for row in rows:
+            keys = [(dims, tuple([row[x] for x in dims])) for dims in alldims]
+            best = None
+            bestcount = -1
+            for pos in range(size):
+                count = 0
+                for dims, positions in keys:
+                    if (dims, positions, pos) in uncovered:
+                        count += 1
+                if count > bestcount:
+                    best = pos
+                    bestcount = count
+            row.append(best)
+            for dims, positions in keys:
+                uncovered.discard((dims, positions, best))
+        # vertical growth : new rows for what is left
+        newrows = []
+        for dims, positions, pos in sorted(uncovered):
+            for row in newrows:
+                if row[dim] != pos:
+                    continue
+                if [x for x, p in zip(dims, positions) if row[x] not in (None, p)]:
+                    continue
+                break
+            else:
+                row = [None] * (dim + 1)
+                row[dim] = pos
+                newrows.append(row)
+            for x, p in zip(dims, positions):
+                row[x] = p
+        rows.extend(newrows)
+    res = []
+    for row in rows:
+        orow = [0] * ndims
+        for x, pos in zip(order, row):
+            if pos == None:
+                if rnd:
+                    pos = rnd.randrange(sizes[x])
+                else:
+                    pos = 0
+            orow[x] = pos
+        res.append(orow)
+    return res
+
+def each_value_rows(sizes, rnd=None):
+    """
+    Returns rows using each value of each dimension at least once.
+
+    The values of each dimension are shuffled with rnd (a random.Random)
+    if given.
+    """
+    permutations = []
+    for size in sizes:
+        perm = range(size)
+        if rnd:
+            rnd.shuffle(perm)
+        permutations.append(perm)
+    return [[p[i % len(p)] for p in permutations]
+            for i in range(max(sizes or [1]))]
+
+def select_indexes(sizes, strategy=CARTESIAN, strength=2, budget=None,
+                   seed=0):
+    """
+    Returns the sorted indexes (a list, or an xrange for all of them) of
+    the combinations selected with the given strategy (see STRATEGIES).
+
+    The selection only depends on the arguments, including the seed
+    used by the random choices.
+
+    For the RANDOM strategy, budget is the number of combinations. For the
+    other ones, it limits the number of selected combinations.
+    """
+    if not strategy in STRATEGIES:
+        raise ValueError("Unknown strategy %r" % strategy)
+    total = 1
+    for size in sizes:
+        total *= size
+    rnd = random.Random(seed)
+    if strategy == CARTESIAN:
+        if budget == None or budget >= total:
+            return xrange(total)
+        indexes = rnd.sample(xrange(total), budget)
+    elif strategy == RANDOM:
+        if budget == None:
+            raise ValueError("The random strategy needs a budget")
+        indexes = rnd.sample(xrange(total), min(budget, total))
+    elif strategy == EACH:
+        indexes = [row_index(row, sizes) for row in each_value_rows(sizes, rnd)]
+    else:
+        if strength < 1:
+            raise ValueError("Invalid strength %d" % strength)
+        indexes = [row_index(row, sizes)
+                   for row in covering_array(sizes, strength, rnd)]
+    indexes = sorted(set(indexes))
+    if budget != None and len(indexes) > budget:
+        indexes = sorted(rnd.sample(indexes, budget))
+    return indexes
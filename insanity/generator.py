@@ -23,6 +23,10 @@
 Generator classes
 
 Generators expand some arguments into a dictionnary of arguments.
+
+Generators can be iterated without generating the full list of results
+first, subclasses producing many results should implement _iterate() to
+return them as they are found.
 """
 
 # TODO
@@ -65,16 +69,55 @@ class Generator(object):
     def _generate(self):
         """
         Return the full list of results
-        to be implemented by subclasses
+        to be implemented by subclasses (or _iterate())
+        """
+        return list(self._iterate())
+
+    def _iterate(self):
+        """
+        Returns an iterator over the results, can be implemented by
+        subclasses to avoid generating the full list of results.
+        """
+        # each default implementation uses the other one
+        if self._generate.im_func is Generator._generate.im_func:
+            raise NotImplementedError
+        return iter(self.generate())
+
+    def estimateLength(self):
+        """
+        Returns the number of results if it is known (or cheap to
+        estimate), else None.
+        """
+        if self._length != None:
+            return self._length
+        if self.generated:
+            return len(self.generated)
+        return None
+
+    def getDuplicates(self):
+        """
+        Returns a dictionnary of the items which weren't returned because
+        they are identical to a returned one:
+        * key : the returned item
+        * value : the list of identical items
         """
-        raise NotImplementedError
+        return {}
 
     def __iter__(self):
-        return iter(self.generate()[:])
+        if self.generated:
+            return iter(self.generated[:])
+        return self._iterate()
 
     def __len__(self):
         if self._length == None:
-            self._length = len(self.generate())
+            if self.generated:
+                self._length = len(self.generated)
+            else:
+                # count the results without keeping them
+                nb = 0
+                for item in self._iterate():
+                    nb += 1
+                self._length = nb
         return self._length
 
     def __getitem__(self, idx):
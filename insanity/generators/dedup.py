@@ -0,0 +1,246 @@
+# GStreamer QA system
+#
+#       generators/dedup.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Content deduplication generators
+"""
+
+import os
+import cPickle
+import tempfile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+from insanity.generator import Generator
+from insanity.log import debug, info, exception
+from insanity.utils import get_cache_directory
+
+# number of bytes hashed at the beginning and at the end of files for the
+# partial hash
+PARTIAL_HASH_SIZE = 64 * 1024
+# size of the blocks read for the full hash
+FULL_HASH_BLOCKSIZE = 1024 * 1024
+
+class FileHashCache(object):
+    """
+    On-disk cache of the partial and full content hashes of files.
+
+    Hashes are only computed when needed, and are stored with the size
+    and modification time of the file, a modified file is hashed again.
+
+    If persistent is False, the cache is only kept in memory.
+    """
+
+    def __init__(self, persistent=True):
+        self.path = None
+        # { path : (size, mtime, partialhash, fullhash) }
+        self._entries = {}
+        self._modified = False
+        if persistent:
+            self.path = os.path.join(get_cache_directory("contenthash"),
+                                     "hashes.pickle")
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            f = open(self.path, "rb")
+            try:
+                self._entries = cPickle.load(f)
+            finally:
+                f.close()
+        except:
+            exception("Couldn't load hash cache %s", self.path)
+            self._entries = {}
+
+    def save(self):
+        """
+        Writes the cache to disk if it was modified.
+        """
+        if not self._modified or self.path == None:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            f = os.fdopen(fd, "wb")
+            try:
+                cPickle.dump(self._entries, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, self.path)
+        except:
+            exception("Couldn't save hash cache %s", self.path)
+        self._modified = False
+
+    def _getEntry(self, path):
+        st = os.stat(path)
+        entry = self._entries.get(path)
+        if entry == None or entry[:2] != (st.st_size, st.st_mtime):
+            entry = (st.st_size, st.st_mtime, None, None)
+            self._entries[path] = entry
+        return entry
+
+    def getSize(self, path):
+        """
+        Returns the size of the given file
+        """
+        return os.path.getsize(path)
+
+    def getPartialHash(self, path):
+        """
+        Returns the hash of the beginning and the end of the given file
+        """
+        entry = self._getEntry(path)
+        if entry[2] == None:
+            size = entry[0]
+            h = sha1()
+            f = open(path, "rb")
+            try:
+                h.update(f.read(PARTIAL_HASH_SIZE))
+                if size > 2 * PARTIAL_HASH_SIZE:
+                    f.seek(-PARTIAL_HASH_SIZE, 2)
+                    h.update(f.read(PARTIAL_HASH_SIZE))
+                elif size > PARTIAL_HASH_SIZE:
+                    h.update(f.read())
+            finally:
+                f.close()
+            entry = (entry[0], entry[1], h.hexdigest(), entry[3])
+            self._entries[path] = entry
+            self._modified = True
+        return entry[2]
+
+    def getFullHash(self, path):
+        """
+        Returns the hash of the full contents of the given file
+        """
+        entry = self._getEntry(path)
+        if entry[0] <= PARTIAL_HASH_SIZE:
+            # the partial hash already covers the whole file
+            return self.getPartialHash(path)
+        if entry[3] == None:
+            h = sha1()
+            f = open(path, "rb")
+            try:
+                while True:
+                    data = f.read(FULL_HASH_BLOCKSIZE)
+                    if not data:
+                        break
+                    h.update(data)
+            finally:
+                f.close()
+            entry = (entry[0], entry[1], entry[2], h.hexdigest())
+            self._entries[path] = entry
+            self._modified = True
+        return entry[3]
+
+class DeduplicatingGenerator(Generator):
+    """
+    Arguments:
+    * generator of files (paths or file:// URIs)
+    * cache option (default : True)
+
+    Returns:
+    * the items of the generator, except those whose contents are
+      identical to an item returned before
+
+    Files are compared by size first, then by the hash of their beginning
+    and end, and finally by the hash of their full contents, so that only
+    files with the same size are read.
+
+    The items which were skipped are available with getDuplicates().
+    """
+
+    __args__ = {
+        "generator":"Generator of file paths or file:// URIs",
+        "cache":"If True, keep the hashes of the files on disk (default:True)"
+        }
+
+    def __init__(self, generator=None, cache=True, *args, **kwargs):
+        """
+        generator : the generator of files to deduplicate
+        cache : keep the hashes of the files on disk
+        """
+        Generator.__init__(self, generator=generator, cache=cache,
+                           *args, **kwargs)
+        self.generator = generator
+        self.cache = cache
+        # { representative : [duplicates] }
+        self._duplicates = {}
+
+    def getDuplicates(self):
+        """
+        Returns a dictionnary of the skipped items found so far:
+        * key : the item which was returned
+        * value : the list of items with the same contents
+        """
+        return dict([(k, list(v)) for k, v in self._duplicates.items()])
+
+    def _iterate(self):
+        hashes = FileHashCache(persistent=self.cache)
+        # { size : [(item, path)] } of the returned items
+        bysize = {}
+        nbskipped = 0
+        try:
+            for item in self.generator:
+                path = item
+                if isinstance(item, str) and item.startswith("file://"):
+                    path = item[len("file://"):]
+                try:
+                    candidates = bysize.setdefault(hashes.getSize(path), [])
+                    representative = self._findIdentical(hashes, path, candidates)
+                except (OSError, IOError):
+                    # not a file, keep it
+                    debug("Couldn't read %r", item)
+                    yield item
+                    continue
+                if representative == None:
+                    candidates.append((item, path))
+                    yield item
+                    continue
+                debug("%r is identical to %r", item, representative)
+                # the generator might be iterated several times (or
+                # concurrently when counted in the background)
+                duplicates = self._duplicates.setdefault(representative, [])
+                if not item in duplicates:
+                    duplicates.append(item)
+                nbskipped += 1
+            info("Skipped %d duplicate files", nbskipped)
+        finally:
+            hashes.save()
+
+    def _findIdentical(self, hashes, path, candidates):
+        """
+        Returns the item of candidates (files of the same size) whose
+        contents are identical to path, or None.
+        """
+        if not candidates:
+            return None
+        partial = hashes.getPartialHash(path)
+        candidates = [(item, cpath) for item, cpath in candidates
+                      if hashes.getPartialHash(cpath) == partial]
+        if not candidates:
+            return None
+        full = hashes.getFullHash(path)
+        for item, cpath in candidates:
+            if hashes.getFullHash(cpath) == full:
+                return item
+        return None
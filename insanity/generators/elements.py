@@ -21,11 +21,197 @@
 
 """
 GstElement-related generators
+
+The element factories of the registry and the compatibility of encoders
+with muxers are described by an ElementDatabase, which is shared by all
+the generators and kept in a cache file per registry.
 """
 
+import os
+import cPickle
+import tempfile
+import threading
 import gst
 from insanity.generator import Generator
-#from insanity.log import critical, error, warning, debug, info
+from insanity.environment import getRegistryFingerprint
+from insanity.utils import get_cache_directory
+from insanity.log import info, exception
+
+RAW_AUDIO_CAPS = "audio/x-raw-int;audio/x-raw-float"
+RAW_VIDEO_CAPS = "video/x-raw-rgb;video/x-raw-yuv"
+
+class ElementDatabase(object):
+    """
+    Klass tokens of the element factories, along with the compatibility of
+    encoders (src pads) with muxers (sink pads).
+
+    Compatibilities are computed when first needed, intersecting the caps
+    of each pair of factories only once, and stored in a cache file named
+    after the fingerprint of the registry.
+    """
+
+    def __init__(self, fingerprint=None):
+        if fingerprint == None:
+            fingerprint = getRegistryFingerprint(os.environ)
+        self.path = os.path.join(get_cache_directory("elements"),
+                                 "%s.pickle" % fingerprint)
+        self._lock = threading.Lock()
+        self._modified = False
+        # [factory names] in registry order
+        self._factories = []
+        # { factory name : [klass tokens] }
+        self._klasses = {}
+        # { klass token : set of factory names }
+        self._byklass = {}
+        # { (encoder, muxer) : compatible }
+        # raw streams use RAW_AUDIO_CAPS and RAW_VIDEO_CAPS as encoder
+        self._compatible = {}
+        # not stored
+        # { (factory name, direction) : (caps, set of structure names) }
+        self._caps = {}
+        if not self._load():
+            self._scanRegistry()
+            self.save()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return False
+        try:
+            f = open(self.path, "rb")
+            try:
+                self._factories, self._klasses, self._compatible = cPickle.load(f)
+            finally:
+                f.close()
+        except:
+            exception("Couldn't load element database %s", self.path)
+            return False
+        self._indexKlasses()
+        return True
+
+    def save(self):
+        """
+        Writes the database to the cache file if it was modified.
+        """
+        self._lock.acquire()
+        try:
+            if not self._modified:
+                return
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+                f = os.fdopen(fd, "wb")
+                try:
+                    cPickle.dump((self._factories, self._klasses, self._compatible),
+                                 f, cPickle.HIGHEST_PROTOCOL)
+                finally:
+                    f.close()
+                os.rename(tmp, self.path)
+            except:
+                exception("Couldn't save element database %s", self.path)
+            self._modified = False
+        finally:
+            self._lock.release()
+
+    def _scanRegistry(self):
+        info("Scanning the element factories of the registry")
+        allf = gst.registry_get_default().get_feature_list(gst.TYPE_ELEMENT_FACTORY)
+        for fact in allf:
+            name = fact.get_name()
+            self._factories.append(name)
+            self._klasses[name] = fact.get_klass().split('/')
+        self._indexKlasses()
+        self._modified = True
+
+    def _indexKlasses(self):
+        self._byklass = {}
+        for name, klasses in self._klasses.iteritems():
+            for klass in klasses:
+                self._byklass.setdefault(klass, set()).add(name)
+
+    def getFactories(self, classes=[]):
+        """
+        Returns the names of the factories having all the given klass
+        tokens, in registry order.
+        """
+        if not classes:
+            return self._factories[:]
+        names = None
+        for klass in classes:
+            matching = self._byklass.get(klass, set())
+            if names == None:
+                names = set(matching)
+            else:
+                names &= matching
+        return [x for x in self._factories if x in names]
+
+    def getKlasses(self, name):
+        """
+        Returns the klass tokens of the given factory
+        """
+        return self._klasses.get(name, [])
+
+    def _getCaps(self, name, direction):
+        """
+        Returns the union of the caps of the pad templates of the given
+        factory and direction (ANY caps excepted for sink pads) along with
+        the names of their structures (None if they contain ANY caps).
+        """
+        key = (name, direction)
+        if not key in self._caps:
+            if name in (RAW_AUDIO_CAPS, RAW_VIDEO_CAPS):
+                caps = gst.Caps(name)
+            else:
+                caps = gst.Caps()
+                fact = gst.element_factory_find(name)
+                if fact != None:
+                    for pt in fact.get_static_pad_templates():
+                        if pt.direction != direction:
+                            continue
+                        tcaps = pt.get_caps()
+                        if direction == gst.PAD_SINK and tcaps.is_any():
+                            continue
+                        caps = caps.union(tcaps)
+            if caps.is_any():
+                names = None
+            else:
+                names = set([caps[i].get_name() for i in range(caps.get_size())])
+            self._caps[key] = (caps, names)
+        return self._caps[key]
+
+    def isCompatible(self, encoder, muxer):
+        """
+        Returns True if one of the src pads of the given encoder factory
+        (or RAW_AUDIO_CAPS/RAW_VIDEO_CAPS) can be linked to one of the sink
+        pads of the given muxer factory.
+        """
+        key = (encoder, muxer)
+        res = self._compatible.get(key)
+        if res != None:
+            return res
+        self._lock.acquire()
+        try:
+            esrc, enames = self._getCaps(encoder, gst.PAD_SRC)
+            msink, mnames = self._getCaps(muxer, gst.PAD_SINK)
+            if enames != None and mnames != None and not enames & mnames:
+                # caps with different media types can't intersect
+                res = False
+            else:
+                res = not esrc.intersect(msink).is_empty()
+            self._compatible[key] = res
+            self._modified = True
+        finally:
+            self._lock.release()
+        return res
+
+_element_database = None
+
+def get_element_database():
+    """
+    Returns the ElementDatabase of the registry of this process.
+    """
+    global _element_database
+    if _element_database == None:
+        _element_database = ElementDatabase()
+    return _element_database
 
 class ElementGenerator(Generator):
     """
@@ -41,24 +227,16 @@ class ElementGenerator(Generator):
         "factories":"If set to True, will return objects and not strings"
         }
 
-    def _generate(self):
-        def list_compat(la, lb):
-            for item in la:
-                if not item in lb:
-                    return False
-            return True
+    def _getFactoryNames(self, database):
+        """
+        Returns the names of the matching factories
+        """
+        return database.getFactories(self.kwargs.get("classes", []))
 
-        res = []
-        classes = self.kwargs.get("classes", [])
-        retfact = self.kwargs.get("factories", False)
-        allf = gst.registry_get_default().get_feature_list(gst.TYPE_ELEMENT_FACTORY)
-        # filter by class
-        for fact in allf:
-            if list_compat(classes, fact.get_klass().split('/')):
-                if retfact:
-                    res.append(fact)
-                else:
-                    res.append(fact.get_name())
+    def _generate(self):
+        res = self._getFactoryNames(get_element_database())
+        if self.kwargs.get("factories", False):
+            res = [gst.element_factory_find(x) for x in res]
         return res
 
 class MuxerGenerator(ElementGenerator):
@@ -88,14 +266,14 @@ class VideoEncoderGenerator(ElementGenerator):
         kwargs["classes"] = ["Codec", "Encoder"]
         ElementGenerator.__init__(self, *args, **kwargs)
 
-    def _generate(self):
+    def _getFactoryNames(self, database):
         res = []
-        facts = ElementGenerator._generate(self)
+        names = ElementGenerator._getFactoryNames(self, database)
         # filter those which have Video or Image
-        for fact in facts:
-            klasses = fact.get_klass().split('/')
+        for name in names:
+            klasses = database.getKlasses(name)
             if "Video" in klasses or "audio" in klasses:
-                res.append(fact)
+                res.append(name)
         return res
 
 class EncoderMuxerGenerator(Generator):
@@ -138,90 +316,65 @@ class EncoderMuxerGenerator(Generator):
         singlestreams = self.kwargs.get("single_streams", False)
         retfact = self.kwargs.get("factories", False)
 
+        database = get_element_database()
         muxer = muxername and gst.element_factory_find(muxername)
         aenc = aencname and gst.element_factory_find(aencname)
         venc = vencname and gst.element_factory_find(vencname)
 
         if muxer:
-            allmuxers = [muxer]
+            allmuxers = [muxername]
         else:
-            allmuxers = MuxerGenerator(factories=True).generate()
+            allmuxers = MuxerGenerator()._getFactoryNames(database)
 
         if aenc:
-            allaencs = [aenc]
+            allaencs = [aencname]
         else:
-            allaencs = AudioEncoderGenerator(factories=True).generate()
+            allaencs = AudioEncoderGenerator()._getFactoryNames(database)
 
         if venc:
-            allvencs = [venc]
+            allvencs = [vencname]
         else:
-            allvencs = VideoEncoderGenerator(factories=True).generate()
-
-        def can_sink_caps(muxer, ocaps):
-            pts = muxer.get_static_pad_templates()
-            sdir = gst.PAD_SINK
-            sinkcaps = [x.get_caps() for x in pts if x.direction == sdir and not x.get_caps().is_any()]
-            for caps in sinkcaps:
-                if not caps.intersect(ocaps).is_empty():
-                    return True
-            return False
-
-        def encoders_muxer_compatible(encoders, muxer):
-            res = []
-            for encoder in encoders:
-                pts = encoder.get_static_pad_templates()
-                for caps in [x.get_caps() for x in pts if x.direction == gst.PAD_SRC]:
-                    if can_sink_caps(muxer, caps):
-                        res.append(encoder)
-                        break
-            return res
+            allvencs = VideoEncoderGenerator()._getFactoryNames(database)
 
         res = []
         # reduce allmuxers to those intersecting with the encoders
         for mux in allmuxers:
             # get the compatible encoders, without forgetting the
             # raw pads
-            compatvenc = encoders_muxer_compatible(allvencs, mux)
-            compataenc = encoders_muxer_compatible(allaencs, mux)
+            compatvenc = [x for x in allvencs if database.isCompatible(x, mux)]
+            compataenc = [x for x in allaencs if database.isCompatible(x, mux)]
 
             # skip muxers than don't accept the specified encoders
-            if vencname and not gst.element_factory_find(vencname) in compatvenc:
+            if vencname and not vencname in compatvenc:
                 continue
-            if aencname and not gst.element_factory_find(aencname) in compataenc:
+            if aencname and not aencname in compataenc:
                 continue
 
-            acaps = gst.Caps("audio/x-raw-int;audio/x-raw-float")
-            vcaps = gst.Caps("video/x-raw-rgb;video/x-raw-yuv")
-
-            if not aencname and can_sink_caps(mux, acaps):
-                compataenc.append(gst.element_factory_find("identity"))
-            if not vencname and can_sink_caps(mux, vcaps):
-                compatvenc.append(gst.element_factory_find("identity"))
+            if not aencname and database.isCompatible(RAW_AUDIO_CAPS, mux):
+                compataenc.append("identity")
+            if not vencname and database.isCompatible(RAW_VIDEO_CAPS, mux):
+                compatvenc.append("identity")
 
             # and now produce the tuples
             for venc in compatvenc:
                 for aenc in compataenc:
-                    if retfact:
-                        res.append((aenc, venc, mux))
-                    else:
-                        res.append((aenc.get_name(),
-                                    venc.get_name(),
-                                    mux.get_name()))
+                    res.append((aenc, venc, mux))
 
             if singlestreams:
                 if not aencname:
                     for venc in compatvenc:
-                        if retfact:
-                            res.append((None, venc, mux))
-                        else:
-                            res.append((None, venc.get_name(),
-                                        mux.get_name()))
+                        res.append((None, venc, mux))
                 if not vencname:
                     for aenc in compataenc:
-                        if retfact:
-                            res.append((aenc, None, mux))
-                        else:
-                            res.append((aenc.get_name(), None,
-                                        mux.get_name()))
-
+                        res.append((aenc, None, mux))
+
+        database.save()
+        if retfact:
+            factories = {None : None}
+            for combination in res:
+                for name in combination:
+                    if not name in factories:
+                        factories[name] = gst.element_factory_find(name)
+            res = [tuple([factories[x] for x in combination])
+                   for combination in res]
         return res
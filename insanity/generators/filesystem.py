@@ -21,13 +21,215 @@
 
 """
 File system related generators
+
+The contents of the scanned directories are kept in an on-disk index, so
+that only the directories modified since the previous scan are listed
+again. Directories are listed by a small pool of threads, ahead of the
+iteration.
 """
 
-import os.path
-from fnmatch import fnmatch
+import os
+import re
+import time
+import threading
+import cPickle
+import tempfile
+from fnmatch import translate
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 from insanity.generator import Generator
-from insanity.log import debug, info
+from insanity.log import debug, info, exception
+from insanity.utils import get_cache_directory
+
+# number of threads listing directories
+SCANNER_THREADS = 4
+
+def compile_masks(masks):
+    """
+    Returns a compiled regular expression matching any of the given
+    fnmatch masks, or None if there are no masks.
+    """
+    if not masks:
+        return None
+    return re.compile("|".join(["(?:%s)" % translate(x) for x in masks]))
+
+class DirectoryIndex(object):
+    """
+    On-disk index of the contents of the directories below root.
+
+    Each directory is stored with its modification time, and only listed
+    again if it was modified since.
+
+    If persistent is False, the index is only kept in memory.
+    """
+
+    def __init__(self, root, persistent=True):
+        self.root = root
+        self.path = None
+        # { directory : (mtime, [filenames], [subdirectories]) }
+        self._entries = {}
+        self._visited = set()
+        self._modified = False
+        if persistent:
+            self.path = os.path.join(get_cache_directory("filesystem"),
+                                     "%s.index" % sha1(root).hexdigest())
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            f = open(self.path, "rb")
+            try:
+                self._entries = cPickle.load(f)
+            finally:
+                f.close()
+        except:
+            exception("Couldn't load directory index %s", self.path)
+            self._entries = {}
+
+    def save(self, complete=False):
+        """
+        Writes the index to disk if it was modified.
+
+        If complete is True, the whole tree was scanned and the
+        directories which weren't visited are removed from the index.
+        """
+        if complete and len(self._visited) != len(self._entries):
+            self._entries = dict([(k, v) for k, v in self._entries.iteritems()
+                                  if k in self._visited])
+            self._modified = True
+        if not self._modified or self.path == None:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            f = os.fdopen(fd, "wb")
+            try:
+                cPickle.dump(self._entries, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, self.path)
+        except:
+            exception("Couldn't save directory index %s", self.path)
+        self._modified = False
+
+    def scan(self, directory):
+        """
+        Returns a tuple of the (unsorted) lists of the file names and of
+        the subdirectory names of directory, or None if it can't be listed.
+
+        Symbolic links to directories are in neither list.
+        """
+        self._visited.add(directory)
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return None
+        entry = self._entries.get(directory)
+        if entry != None and entry[0] == mtime:
+            return entry[1:]
+        debug("listing %s", directory)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return None
+        files = []
+        subdirs = []
+        for name in names:
+            fullpath = os.path.join(directory, name)
+            if not os.path.isdir(fullpath):
+                files.append(name)
+            elif not os.path.islink(fullpath):
+                subdirs.append(name)
+        if mtime >= time.time() - 1:
+            # it might still be modified within the same mtime, it
+            # will have to be listed again
+            mtime = None
+        self._entries[directory] = (mtime, files, subdirs)
+        self._modified = True
+        return (files, subdirs)
+
+class DirectoryScanner(object):
+    """
+    Pool of threads listing directories (through a DirectoryIndex) before
+    they are needed.
+    """
+
+    def __init__(self, nbthreads=SCANNER_THREADS):
+        self._lock = threading.Condition()
+        # directories to scan : [(index, directory)]
+        self._queue = []
+        # { directory : result } , result being None until it's scanned
+        self._results = {}
+        self._stopped = False
+        self._threads = []
+        for i in range(nbthreads):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            try:
+                while not self._queue and not self._stopped:
+                    self._lock.wait()
+                if self._stopped:
+                    return
+                index, directory = self._queue.pop(0)
+            finally:
+                self._lock.release()
+            try:
+                res = index.scan(directory)
+            except:
+                exception("Couldn't scan %s", directory)
+                res = None
+            self._lock.acquire()
+            try:
+                self._results[directory] = (res, )
+                self._lock.notifyAll()
+            finally:
+                self._lock.release()
+
+    def prefetch(self, index, directories):
+        """
+        Queues the given directories to be scanned.
+        """
+        self._lock.acquire()
+        try:
+            for directory in directories:
+                if not directory in self._results:
+                    self._results[directory] = None
+                    self._queue.append((index, directory))
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+    def get(self, index, directory):
+        """
+        Returns the result of index.scan(directory), waiting for it if
+        needed.
+        """
+        self.prefetch(index, [directory])
+        self._lock.acquire()
+        try:
+            while self._results[directory] == None:
+                self._lock.wait()
+            return self._results.pop(directory)[0]
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
 
 class FileSystemGenerator(Generator):
     """
@@ -36,6 +238,7 @@ class FileSystemGenerator(Generator):
     * recursive option (default : True)
     * matching option (default : [])
     * reject option (default : [])
+    * index option (default : True)
 
     Returns:
     * file system path
@@ -45,65 +248,91 @@ class FileSystemGenerator(Generator):
         "paths":"List of paths or files",
         "recursive":"If True, go down in subdirectories (default:True)",
         "matching":"List of masks for files to be taken into account",
-        "reject":"List of masks for files to NOT be taken into account"
+        "reject":"List of masks for files to NOT be taken into account",
+        "index":"If True, keep an index of the scanned directories (default:True)"
         }
 
     __produces__ = "paths"
 
     def __init__(self, paths=[], recursive=True,
-                 matching=[], reject=[], *args,
+                 matching=[], reject=[], index=True, *args,
                  **kwargs):
         """
         paths : list of paths and/or files
         recursive : go down in subdirectories
         matching : will only return files matching the given masks
         reject : will not return files matching the given masks
+        index : only list the directories modified since the previous scan
         """
         Generator.__init__(self, paths=paths, recursive=recursive,
-                           matching=matching, reject=reject,
+                           matching=matching, reject=reject, index=index,
                            *args, **kwargs)
         self.paths = paths
         self.recursive = recursive
         self.matching = matching
         self.reject = reject
+        self.index = index
+        self._matching = compile_masks(matching)
+        self._reject = compile_masks(reject)
         info("paths:%r, recursive:%r, matching:%r, reject:%r" % (paths, recursive, matching, reject))
 
     def _is_valid_file(self, filename):
         """ returns True if the given filename is valid """
-        if self.matching:
+        if self._matching:
             # try against the positive matches
-            for match in self.matching:
-                if fnmatch(filename, match):
-                    return True
-            return False
+            return self._matching.match(filename) != None
 
-        if self.reject:
+        if self._reject:
             # try against the negative matches
-            for match in self.reject:
-                if fnmatch(filename, match):
-                    return False
+            return self._reject.match(filename) == None
         # if there's no matching exceptions, it's valid
         return True
 
-    def _get_files(self, directory):
-        res = []
-        for dirpath, dirnames, filenames in os.walk(directory):
-            res.extend([os.path.join(dirpath, fn) for fn in filenames if self._is_valid_file(fn)])
-            if not self.recursive:
-                break
-        res.sort()
-        return res
-
-    def _generate(self):
-        res = []
-        for path in self.paths:
-            fullpath = os.path.abspath(path)
-            if os.path.isfile(fullpath) and self._is_valid_file(fullpath):
-                res.append(fullpath)
+    def _get_files(self, directory, index, scanner):
+        """
+        Yields the valid files of directory (and its subdirectories if
+        recursive), sorted by path.
+        """
+        res = scanner.get(index, directory)
+        if res == None:
+            return
+        files, subdirs = res
+        # sorting subdirectories as 'name/' keeps the whole result sorted
+        entries = [(name, os.path.join(directory, name), False)
+                   for name in files if self._is_valid_file(name)]
+        if self.recursive:
+            subdirs = sorted(subdirs)
+            scanner.prefetch(index, [os.path.join(directory, x) for x in subdirs])
+            entries.extend([(name + "/", os.path.join(directory, name), True)
+                            for name in subdirs])
+        entries.sort()
+        for key, fullpath, isdir in entries:
+            if isdir:
+                for res in self._get_files(fullpath, index, scanner):
+                    yield res
             else:
-                res.extend(self._get_files(fullpath))
-        info("Returning %d files" % len(res))
-        return res
+                yield fullpath
+
+    def _iterate(self):
+        scanner = DirectoryScanner()
+        indexes = []
+        complete = False
+        try:
+            for path in self.paths:
+                fullpath = os.path.abspath(path)
+                if os.path.isfile(fullpath) and self._is_valid_file(fullpath):
+                    yield fullpath
+                    continue
+                index = DirectoryIndex(fullpath, persistent=self.index)
+                indexes.append(index)
+                for res in self._get_files(fullpath, index, scanner):
+                    yield res
+            complete = True
+        finally:
+            scanner.stop()
+            for index in indexes:
+                # non-recursive scans don't visit the whole tree
+                index.save(complete and self.recursive)
 
 class URIFileSystemGenerator(FileSystemGenerator):
     """
@@ -113,6 +342,6 @@ class URIFileSystemGenerator(FileSystemGenerator):
 
     __produces__ = "URI"
 
-    def _generate(self):
-        return ["file://%s" % x for x in FileSystemGenerator._generate(self)]
-
+    def _iterate(self):
+        for path in FileSystemGenerator._iterate(self):
+            yield "file://%s" % path
@@ -0,0 +1,64 @@
+# GStreamer QA system
+#
+#       generators/media.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Media file generators
+"""
+
+from insanity.generators.filesystem import URIFileSystemGenerator
+from insanity.mediaindex import get_media_index, Discoverer, DISCOVERER_CHUNK
+from insanity.log import debug
+
+class MediaURIFileSystemGenerator(URIFileSystemGenerator):
+    """
+    Same as URIFileSystemGenerator, excepts that it only returns the URIs
+    of media files.
+
+    The media index is used to know which files are media files, the
+    unknown files are discovered in batches while iterating. Files whose
+    discovery failed (ex : timed out) are kept, since they need testing
+    the most.
+    """
+
+    def _iterate(self):
+        index = get_media_index()
+        discoverer = Discoverer()
+        batch = []
+        try:
+            for uri in URIFileSystemGenerator._iterate(self):
+                batch.append(uri)
+                if len(batch) < DISCOVERER_CHUNK:
+                    continue
+                for res in self._filterMedia(index, discoverer, batch):
+                    yield res
+                batch = []
+            for res in self._filterMedia(index, discoverer, batch):
+                yield res
+        finally:
+            discoverer.close()
+
+    def _filterMedia(self, index, discoverer, uris):
+        if not uris:
+            return []
+        infos = index.discover(uris, discoverer)
+        res = [x for x in uris if infos.get(x, {}).get("ismedia") != False]
+        debug("%d media files out of %d", len(res), len(uris))
+        return res
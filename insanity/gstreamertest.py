@@ -21,6 +21,7 @@
 
 import sys
 import os
+import time
 
 from insanity.log import error, warning, debug, info, exception
 from insanity.test import PythonDBusTest
@@ -38,6 +39,133 @@ if gst.pygst_version < (0, 10, 9):
         os._exit(status)
     sys.exit = exi
 
+# environment variable through which the pipeline-statistics-monitor asks
+# the remote test to collect statistics, its value is the interval (in
+# milliseconds) between two samples of the queue levels
+PIPELINE_STATISTICS_ENV = "INSANITY_PIPELINE_STATISTICS"
+
+# elements whose levels are sampled
+QUEUE_FACTORIES = ["queue", "queue2"]
+
+class PipelineStatistics(object):
+    """
+    Counts the buffers going through the source pads of the elements of a
+    pipeline, and samples the levels of its queues.
+
+    The probes only update a few counters, the totals are only sent once
+    the test is done (see getPadCounters() and getQueueSamples()).
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        # { "element:pad" : [buffers, bytes, first timestamp, last end
+        #                    timestamp, sum of the durations] }
+        self._pads = {}
+        # { queuename : (queue, [samples, sum of buffers, min buffers,
+        #                        max buffers, max bytes, max time]) }
+        self._queues = {}
+        self._samplingid = None
+        self._starttime = None
+        self._processingtime = 0
+
+    def watchElement(self, element):
+        """
+        Installs the probes on the source pads of element, and on the ones
+        it will add.
+        """
+        if isinstance(element, gst.Bin):
+            # the pads of bins are ghost pads of the children ones
+            return
+        for pad in element.src_pads():
+            self._watchPad(element, pad)
+        element.connect("pad-added", self._padAddedCb)
+        factory = element.get_factory()
+        if factory and factory.get_name() in QUEUE_FACTORIES:
+            self._queues[element.get_name()] = (element, [0, 0, -1, 0, 0, 0])
+
+    def _padAddedCb(self, element, pad):
+        if pad.get_direction() == gst.PAD_SRC:
+            self._watchPad(element, pad)
+
+    def _watchPad(self, element, pad):
+        name = "%s:%s" % (element.get_name(), pad.get_name())
+        if name in self._pads:
+            return
+        counters = [0, 0, -1, -1, 0]
+        self._pads[name] = counters
+        pad.add_buffer_probe(self._bufferProbeCb, counters)
+
+    def _bufferProbeCb(self, pad, buf, counters):
+        # called from the streaming threads, keep it cheap
+        counters[0] += 1
+        counters[1] += buf.size
+        if buf.timestamp != gst.CLOCK_TIME_NONE:
+            end = buf.timestamp
+            if buf.duration != gst.CLOCK_TIME_NONE:
+                end += buf.duration
+                counters[4] += buf.duration
+            if counters[2] == -1 or buf.timestamp < counters[2]:
+                counters[2] = buf.timestamp
+            if end > counters[3]:
+                counters[3] = end
+        return True
+
+    def start(self):
+        """
+        Starts measuring the processing time and sampling the queues.
+        """
+        self._starttime = time.time()
+        # queues might be added later on (ex : by decodebin)
+        self._samplingid = gobject.timeout_add(self._interval,
+                                               self._sampleQueuesCb)
+
+    def stop(self):
+        """
+        Stops measuring the processing time and sampling the queues.
+        """
+        if self._samplingid:
+            gobject.source_remove(self._samplingid)
+            self._samplingid = None
+        if self._starttime != None:
+            self._processingtime = long((time.time() - self._starttime) * gst.SECOND)
+            self._starttime = None
+
+    def _sampleQueuesCb(self):
+        for queue, levels in self._queues.itervalues():
+            nbbuffers = queue.get_property("current-level-buffers")
+            levels[0] += 1
+            levels[1] += nbbuffers
+            if levels[2] == -1 or nbbuffers < levels[2]:
+                levels[2] = nbbuffers
+            levels[3] = max(levels[3], nbbuffers)
+            levels[4] = max(levels[4], queue.get_property("current-level-bytes"))
+            levels[5] = max(levels[5], queue.get_property("current-level-time"))
+        return True
+
+    def getProcessingTime(self):
+        """
+        Returns the time (in nanoseconds) between start() and stop()
+        """
+        return self._processingtime
+
+    def getPadCounters(self):
+        """
+        Returns a dictionnary of the counters of each "element:pad" source
+        pad : (buffers, bytes, first timestamp, last end timestamp, sum of
+        the durations). Unknown timestamps are -1.
+        """
+        return dict([(name, tuple(counters))
+                     for name, counters in self._pads.iteritems()])
+
+    def getQueueSamples(self):
+        """
+        Returns a dictionnary of the level samples of each queue :
+        (samples, sum of buffers, min buffers, max buffers, max bytes,
+        max time)
+        """
+        return dict([(name, tuple(levels))
+                     for name, (queue, levels) in self._queues.iteritems()])
+
 class GStreamerTestBase(PythonDBusTest):
     """
     Tests that specifically run a GStreamer pipeline
@@ -76,6 +204,7 @@ class GStreamerTestBase(PythonDBusTest):
         self._elements = []
         self._waitcb = None
         self._reachedInitialState = False
+        self._statistics = None
         PythonDBusTest.__init__(self, env=env, *args, **kwargs)
 
     def setUp(self):
@@ -107,6 +236,9 @@ class GStreamerTestBase(PythonDBusTest):
             facname = factory.get_name()
         self._elements = [(self.pipeline.get_name(),facname,
                            "")] #name,factoryname,parentname
+        interval = os.environ.get(PIPELINE_STATISTICS_ENV)
+        if interval:
+            self._statistics = PipelineStatistics(int(interval))
         self._watchContainer(self.pipeline)
 
         # connect to bus
@@ -123,6 +255,8 @@ class GStreamerTestBase(PythonDBusTest):
         if self._waitcb:
             gobject.source_remove(self._waitcb)
             self._waitcb = None
+        if self._statistics:
+            self._statistics.stop()
         if self.pipeline:
             self.pipeline.set_state(gst.STATE_NULL)
         self.validateStep("no-errors-seen", self._errors == [])
@@ -149,13 +283,35 @@ class GStreamerTestBase(PythonDBusTest):
             self.extraInfo("tags", dbus.Dictionary(self._tags, signature="sv"))
         if not self._elements == []:
             self.extraInfo("elements-used", self._elements)
+        if self._statistics:
+            self._sendStatistics()
         return True
 
+    def _sendStatistics(self):
+        # sent in one go, and summarized by the pipeline-statistics-monitor
+        # (those keys aren't stored with the test)
+        self.extraInfo("pipeline-processing-time",
+                       dbus.Int64(self._statistics.getProcessingTime()))
+        pads = self._statistics.getPadCounters()
+        if pads:
+            self.extraInfo("pipeline-pad-counters",
+                           dbus.Dictionary([(k, dbus.Array(v, signature="x"))
+                                            for k, v in pads.iteritems()],
+                                           signature="sax"))
+        queues = self._statistics.getQueueSamples()
+        if queues:
+            self.extraInfo("pipeline-queue-samples",
+                           dbus.Dictionary([(k, dbus.Array(v, signature="x"))
+                                            for k, v in queues.iteritems()],
+                                           signature="sax"))
+
     def remoteTest(self):
         # kickstart pipeline to initial state
         PythonDBusTest.remoteTest(self)
         debug("Setting pipeline to initial state %r", self.__pipeline_initial_state__)
         gst.log("Setting pipeline to initial state %r" % self.__pipeline_initial_state__)
+        if self._statistics:
+            self._statistics.start()
         res = self.pipeline.set_state(self.__pipeline_initial_state__)
         debug("set_state returned %r", res)
         gst.log("set_state() returned %r" % res)
@@ -229,6 +385,8 @@ class GStreamerTestBase(PythonDBusTest):
             self._elements.append((elt.get_name(),
                                    factory_name,
                                    container.get_name()))
+            if self._statistics:
+                self._statistics.watchElement(elt)
             if isinstance(elt, gst.Bin):
                 self._watchContainer(elt)
         container.connect("element-added", self._elementAddedCb)
@@ -244,6 +402,8 @@ class GStreamerTestBase(PythonDBusTest):
         self._elements.append((element.get_name(),
                                factory_name,
                                container.get_name()))
+        if self._statistics:
+            self._statistics.watchElement(element)
         # if bin, add current and connect signal
         if isinstance(element, gst.Bin):
             self._watchContainer(element)
@@ -0,0 +1,389 @@
+# GStreamer QA system
+#
+#       mediaindex.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Media corpus index
+
+The media information of files (mime type, streams and duration) is
+kept in an index, so that it only has to be discovered once per file.
+Entries are keyed by the identity of the file (device, inode, size and
+modification time), a modified file will be discovered again.
+
+The media information is a dictionnary with:
+* mimetype : the mime type of the file (None if it wasn't recognized)
+* ismedia : True if the file is a media file GStreamer can handle, None
+  if it isn't known (ex : the discovery timed out)
+* duration : the duration of the file (in nanoseconds, -1 if unknown)
+* streams : the list of (padname, length, caps) of the streams, or None
+  if the file was only typefinded
+* error : an error message, or None
+
+Discovery is done by a separate process (see insanity.discoverer) which
+probes several files at once.
+"""
+
+import os
+import sys
+import time
+import select
+import urllib
+import cPickle
+import threading
+import subprocess
+try:
+    from sqlite3 import dbapi2 as sqlite
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite
+from insanity.log import debug, info, warning
+from insanity.utils import get_cache_directory
+
+# mime types of files which aren't media files
+NON_MEDIA_TYPES = ["application/x-executable",
+                   "application/x-rar",
+                   "application/zip",
+                   "application/x-gzip",
+                   "application/x-bzip",
+                   "text/plain",
+                   "text/uri-list",
+                   "text/x-pango-markup"]
+
+# number of files probed at once by the discoverer process
+DISCOVERER_WORKERS = 4
+# maximum duration of the probing of one file (in seconds)
+DISCOVERER_TIMEOUT = 20
+# number of URIs sent at once to the discoverer process
+DISCOVERER_CHUNK = 32
+# the discoverer process is considered as hung if it doesn't return any
+# result for DISCOVERER_TIMEOUT times this factor
+DISCOVERER_HANG_FACTOR = 2
+
+MEDIA_INDEX_SCHEME = """
+CREATE TABLE IF NOT EXISTS media (
+   path TEXT PRIMARY KEY,
+   device INTEGER,
+   inode INTEGER,
+   size INTEGER,
+   mtime FLOAT,
+   mimetype TEXT,
+   ismedia INTEGER,
+   duration INTEGER,
+   streams BLOB,
+   error TEXT,
+   discoverytime INTEGER
+);
+"""
+
+def is_media_type(mimetype):
+    """
+    Returns True if mimetype is the type of a media file
+    """
+    if not mimetype:
+        return False
+    return not mimetype.split(",")[0].strip() in NON_MEDIA_TYPES
+
+def uri_to_path(uri):
+    """
+    Returns the local file path of the given URI, or None if it isn't a
+    local file.
+    """
+    if not uri.startswith("file://"):
+        return None
+    path = uri[len("file://"):]
+    # URIs built by the filesystem generators aren't escaped
+    if not os.path.exists(path):
+        path = urllib.unquote(path)
+    return path
+
+def file_identity(path):
+    """
+    Returns the (device, inode, size, mtime) of the given file, or None if
+    it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+class MediaIndex(object):
+    """
+    SQLite index of the media information of files.
+
+    Only local files are indexed.
+    """
+
+    def __init__(self, path=None):
+        if path == None:
+            path = os.path.join(get_cache_directory("media"), "index.db")
+        self.path = path
+        self._lock = threading.Lock()
+        self.con = sqlite.connect(path, check_same_thread=False)
+        self.con.text_factory = str
+        self.con.executescript(MEDIA_INDEX_SCHEME)
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def getMediaInfo(self, uri):
+        """
+        Returns the media information of the given uri, or None if it
+        isn't known (or if the file was modified since).
+        """
+        path = uri_to_path(uri)
+        if path == None:
+            return None
+        identity = file_identity(path)
+        if identity == None:
+            return None
+        self._lock.acquire()
+        try:
+            res = self.con.execute("""
+            SELECT device, inode, size, mtime, mimetype, ismedia, duration,
+                   streams, error
+            FROM media WHERE path=?""", (path, )).fetchone()
+        finally:
+            self._lock.release()
+        if res == None or tuple(res[:4]) != identity:
+            return None
+        mimetype, ismedia, duration, streams, error = res[4:]
+        if streams != None:
+            streams = cPickle.loads(str(streams))
+        if ismedia != None:
+            ismedia = bool(ismedia)
+        return {"mimetype" : mimetype,
+                "ismedia" : ismedia,
+                "duration" : duration,
+                "streams" : streams,
+                "error" : error}
+
+    def setMediaInfo(self, uri, mediainfo):
+        """
+        Stores the media information of the given uri.
+
+        Partial information (without streams) doesn't replace the full
+        information of an unmodified file.
+        """
+        path = uri_to_path(uri)
+        if path == None:
+            return
+        identity = file_identity(path)
+        if identity == None:
+            return
+        streams = mediainfo.get("streams")
+        if streams == None:
+            previous = self.getMediaInfo(uri)
+            if previous != None and previous["streams"] != None:
+                return
+        else:
+            streams = sqlite.Binary(cPickle.dumps(list(streams),
+                                                  cPickle.HIGHEST_PROTOCOL))
+        mimetype = mediainfo.get("mimetype")
+        ismedia = mediainfo.get("ismedia")
+        if ismedia == None and mimetype:
+            ismedia = is_media_type(mimetype)
+        if ismedia != None:
+            ismedia = int(ismedia)
+        self._lock.acquire()
+        try:
+            self.con.execute("""
+            INSERT OR REPLACE INTO media (path, device, inode, size, mtime,
+                                          mimetype, ismedia, duration, streams,
+                                          error, discoverytime)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                             (path, ) + identity +
+                             (mimetype, ismedia, mediainfo.get("duration", -1),
+                              streams, mediainfo.get("error"), int(time.time())))
+            self.con.commit()
+        finally:
+            self._lock.release()
+
+    def isMedia(self, uri):
+        """
+        Returns True if uri is a media file, False if it isn't and None
+        if it isn't known (or couldn't be found out).
+        """
+        mediainfo = self.getMediaInfo(uri)
+        if mediainfo == None:
+            return None
+        return mediainfo["ismedia"]
+
+    def discover(self, uris, discoverer=None):
+        """
+        Returns a dictionnary of uri : media information for the given
+        uris, discovering (with the given Discoverer, or a new one) the
+        files which aren't known yet.
+        """
+        res = {}
+        unknown = []
+        for uri in uris:
+            mediainfo = self.getMediaInfo(uri)
+            if mediainfo == None or mediainfo["streams"] == None:
+                unknown.append(uri)
+            else:
+                res[uri] = mediainfo
+        if not unknown:
+            return res
+        owndiscoverer = discoverer == None
+        if owndiscoverer:
+            discoverer = Discoverer()
+        try:
+            for uri, mediainfo in discoverer.discover(unknown):
+                if mediainfo.get("ismedia") == None and mediainfo.get("mimetype"):
+                    mediainfo["ismedia"] = is_media_type(mediainfo["mimetype"])
+                self.setMediaInfo(uri, mediainfo)
+                res[uri] = mediainfo
+        finally:
+            if owndiscoverer:
+                discoverer.close()
+        return res
+
+class Discoverer(object):
+    """
+    Long-lived process discovering the media information of URIs.
+
+    The process is started by the first call to discover(), and stopped
+    by close().
+    """
+
+    def __init__(self, nbworkers=DISCOVERER_WORKERS,
+                 timeout=DISCOVERER_TIMEOUT, environ=None):
+        self.nbworkers = nbworkers
+        self.timeout = timeout
+        self.environ = environ
+        self._process = None
+        self._results = None
+
+    def _start(self):
+        readfd, writefd = os.pipe()
+        thispath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "discoverer.py")
+        pargs = [sys.executable, thispath, str(writefd),
+                 str(self.nbworkers), str(self.timeout)]
+        debug("spawning discoverer %r", pargs)
+        try:
+            self._process = subprocess.Popen(pargs, stdin=subprocess.PIPE,
+                                             env=self.environ)
+        finally:
+            # only the subprocess writes to the pipe
+            os.close(writefd)
+        # unbuffered, so that select() tells whether a result is available
+        self._results = os.fdopen(readfd, "rb", 0)
+
+    def discover(self, uris):
+        """
+        Returns the list of (uri, media information) of the given uris, in
+        the order in which they were discovered.
+
+        If the discoverer process hangs, it is killed and the uris it was
+        probing are returned with an error (and unknown streams), the
+        other ones are probed by a new process.
+        """
+        res = []
+        # results aren't read while sending uris, so they are only sent a
+        # few at a time to avoid filling the pipes
+        for i in range(0, len(uris), DISCOVERER_CHUNK):
+            chunk = uris[i:i + DISCOVERER_CHUNK]
+            while chunk:
+                if self._process == None:
+                    self._start()
+                self._process.stdin.write("".join(["%s\n" % x for x in chunk]))
+                self._process.stdin.flush()
+                chunk = self._readResults(chunk, res)
+                if chunk == None:
+                    return res
+        info("Discovered %d uris", len(res))
+        return res
+
+    def _readResults(self, uris, res):
+        """
+        Appends the results of the given uris (sent to the discoverer
+        process) to res.
+
+        Returns the uris which have to be sent again to a new process if
+        it hung, or None if it exited.
+        """
+        pending = list(uris)
+        while pending:
+            ready = select.select([self._results], [], [],
+                                  self.timeout * DISCOVERER_HANG_FACTOR)[0]
+            if not ready:
+                # the uris being probed are the first pending ones
+                hung = pending[:self.nbworkers]
+                warning("discoverer process hung on %r, restarting it", hung)
+                for uri in hung:
+                    res.append((uri, {"mimetype" : None,
+                                      "ismedia" : None,
+                                      "duration" : -1,
+                                      "streams" : None,
+                                      "error" : "Discoverer timed out"}))
+                self.kill()
+                return pending[self.nbworkers:]
+            try:
+                uri, mediainfo = cPickle.load(self._results)
+            except EOFError:
+                warning("discoverer process exited")
+                self.close()
+                return None
+            if uri in pending:
+                pending.remove(uri)
+            res.append((uri, mediainfo))
+        return []
+
+    def kill(self):
+        """
+        Kills the discoverer process.
+        """
+        if self._process == None:
+            return
+        try:
+            self._process.kill()
+        except OSError:
+            # already gone
+            pass
+        self.close()
+
+    def close(self):
+        """
+        Stops the discoverer process.
+        """
+        if self._process == None:
+            return
+        try:
+            self._process.stdin.close()
+        except IOError:
+            pass
+        self._process.wait()
+        self._results.close()
+        self._process = None
+        self._results = None
+
+_media_index = None
+
+def get_media_index():
+    """
+    Returns the default MediaIndex (shared by all its users in this
+    process).
+    """
+    global _media_index
+    if _media_index == None:
+        _media_index = MediaIndex()
+    return _media_index
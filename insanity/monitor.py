@@ -45,10 +45,16 @@ information, run extra analysis, etc...
 
 import os
 import os.path
+import sys
+import tempfile
 import subprocess
 from insanity.test import Test, DBusTest, GStreamerTest
+from insanity.gstreamertest import PIPELINE_STATISTICS_ENV
 from insanity.log import warning, debug, info, exception
-from insanity.utils import compress_file
+from insanity.threads import WorkerPool
+from insanity.crash import get_core_frames, compute_crash_signature, \
+     get_crash_counter, SIGNATURE_FRAMES
+from insanity.utils import StreamCompressor, RingBufferCapture, COMPRESSION_CODECS
 
 class Monitor(object):
     """
@@ -167,7 +173,10 @@ class Monitor(object):
         Report the location of an output file
         """
         debug("%s : %s", key, value)
-        self._outputfiles[key] = value
+        # the previous dictionnary might be being stored by another thread
+        outputfiles = dict(self._outputfiles)
+        outputfiles[key] = value
+        self._outputfiles = outputfiles
 
     # getters
 
@@ -276,16 +285,21 @@ class GstDebugLogMonitor(Monitor):
     __monitor_description__ = "Logs GStreamer debug activity"
     __monitor_arguments__ = {
         "debug-level" : "GST_DEBUG value (defaults to '*:2')",
-        "compress-logs" : "Whether the resulting log should be compressed (default:True)"
+        "compress-logs" : "Whether the resulting log should be compressed (default:True)",
+        "compression" : "Compression codec of the log : %s (default:gzip)" % ", ".join(sorted(COMPRESSION_CODECS.keys())),
+        "compression-level" : "Compression level, from 1 (fastest) to 9 (smallest) (default:6)",
+        "ring-buffer-size" : "If set, only keep the last ring-buffer-size KB of the log (and of stdout) in memory, and only store them if the test fails"
         }
     __monitor_output_files__ = {
         "gst-log-file" : "file containing the GST_DEBUG log"
         }
     __applies_on__ = GStreamerTest
 
-    # needs to redirect stderr to a file
+    # needs to redirect stderr to a file, which is compressed by a
+    # separate thread while the test runs
     def setUp(self):
         Monitor.setUp(self)
+        self._compressor = None
         if self.test._stderr:
             warning("stderr is already being used, can't setUp monitor")
             return False
@@ -297,29 +311,53 @@ class GstDebugLogMonitor(Monitor):
             if not self.test.setTimeout(self.test.getTimeout() * 2):
                 warning("Couldn't change the timeout !")
                 return False
+        codec = "none"
+        if self.arguments.get("compress-logs", True):
+            codec = self.arguments.get("compression", "gzip")
+        if not codec in COMPRESSION_CODECS:
+            warning("Unknown compression codec %r", codec)
+            return False
+        level = int(self.arguments.get("compression-level", 6))
+        ringsize = self.arguments.get("ring-buffer-size")
+        if ringsize and self.test._stdout:
+            warning("stdout is already being used, can't setUp monitor")
+            return False
         # get file for redirection
-        self._logfile, self._logfilepath = self.testrun.get_temp_file(nameid="gst-debug-log")
+        fd, self._logfilepath = self.testrun.get_temp_file(nameid="gst-debug-log",
+                                                           suffix=COMPRESSION_CODECS[codec][0])
+        os.close(fd)
         debug("Got temporary file %s", self._logfilepath)
-        self.test._stderr = self._logfile
+        if ringsize:
+            self._compressor = RingBufferCapture(self._logfilepath,
+                                                 int(ringsize) * 1024,
+                                                 codec, level)
+            self.test._stdout = self._compressor.fileno()
+        else:
+            self._compressor = StreamCompressor(self._logfilepath, codec, level)
+        self._compressor.start()
+        self.test._stderr = self._compressor.fileno()
         return True
 
     def tearDown(self):
         Monitor.tearDown(self)
-        if self._logfile:
-            os.close(self._logfile)
-        if not os.path.getsize(self._logfilepath):
-            # if log file is empty remove it
-            debug("log file is empty, removing it")
-            os.remove(self._logfilepath)
-        else:
-            if self.arguments.get("compress-logs", True):
-                res = self._logfilepath + ".gz"
-                debug("compressing debug log to %s", res)
-                compress_file(self._logfilepath, res)
-                os.remove(self._logfilepath)
-                self._logfilepath = res
-            # else report it
+        if not self._compressor:
+            return
+        # the compressor finishes on its own once the subprocess is gone,
+        # and removes the log file if it's empty
+        self._compressor.closeWriter()
+        if isinstance(self._compressor, RingBufferCapture):
+            # the test was torn down, its results are known
+            if self.test.getSuccessPercentage() == 100.0:
+                debug("test succeeded, dropping the captured log")
+                self._compressor.discard()
+                self._compressor = None
+                return
+            self._compressor.keep()
+        if self._compressor.hasData():
             self.setOutputFile("gst-log-file", self._logfilepath)
+        else:
+            debug("log file is empty")
+        self._compressor = None
 
 class ValgrindMemCheckMonitor(Monitor):
     """
@@ -387,6 +425,14 @@ class GDBMonitor(Monitor):
 
     /proc/sys/kernel/core_uses_pid = 1
     /proc/sys/kernel/core_pattern = core
+
+    Each test is run in its own directory, where the kernel dumps the
+    core file. Backtraces are generated in background threads (see
+    get_backtrace_pool()), the output files are added to the stored
+    test once they are done.
+
+    Crashes are also stored by signature (see insanity.crash), and full
+    backtraces can be limited to the first crashes of each signature.
     """
     __monitor_name__ = "gdb-monitor"
     __monitor_description__ = """
@@ -397,7 +443,9 @@ class GDBMonitor(Monitor):
     __monitor_arguments__ = {
         "save-core-dumps":"Save core dump files (default: False)",
         "generate-back-traces":"Generate back traces from core dumps (default True)",
-        "gdb-script":"Script to use to generate gdb backtraces (default : gdb.instructions"
+        "gdb-script":"Script to use to generate gdb backtraces (default : gdb.instructions",
+        "signature-frames":"Number of frames used for the crash signatures (default : %d)" % SIGNATURE_FRAMES,
+        "backtraces-per-signature":"Only generate back traces for the first crashes with the same signature (default : all of them)"
         }
     __monitor_output_files__ = {
         "core-dump":"The core dump file",
@@ -405,9 +453,13 @@ class GDBMonitor(Monitor):
         }
     __applies_on__ = DBusTest
 
+    # the core pattern is only checked once per process
+    _corePatternChecked = False
+
     # doesn't need to do any redirections
     # setup 'ulimit -c unlimited'
-    # when the test is done, check whether it crashed, if so:
+    # when the test is done, check whether it crashed, if so (in a
+    # background thread):
     #  * run a gdb script to collect a backtrace
     #  * remove core file
 
@@ -416,6 +468,10 @@ class GDBMonitor(Monitor):
         self._saveCoreDumps = self.arguments.get("save-core-dumps", False)
         self._generateBackTraces = self.arguments.get("generate-back-traces", True)
         self._GDBScript = self.arguments.get("gdb-script", "gdb.instructions")
+        self._signatureFrames = int(self.arguments.get("signature-frames",
+                                                       SIGNATURE_FRAMES))
+        self._maxBackTraces = self.arguments.get("backtraces-per-signature")
+        self._coredir = None
         # add some env variables
         self.test._environ["G_DEBUG"] = "fatal_warnings"
         try:
@@ -424,60 +480,208 @@ class GDBMonitor(Monitor):
         except:
             exception("Couldn't change core limit")
             return False
+        self._checkCorePattern()
+        # the core file is dumped in the working directory of the
+        # process, give it its own one so we know where to find it
+        self._coredir = tempfile.mkdtemp(prefix="gdb-monitor-",
+                                         dir=self.testrun.getWorkingDirectory())
+        self.test._cwd = self._coredir
         return True
 
     def tearDown(self):
         Monitor.tearDown(self)
+        if not self._coredir:
+            return
         # if the return value of the subprocess is non-null, we most
         # likely have a crasher and core dump
+        core = None
         if not self.test._returncode == 0:
-            debug("non-null returncode [%d] for pid %d",
+            debug("non-null returncode [%r] for pid %d",
                   self.test._returncode,
                   self.test._pid)
-            # try to find the core file
-            core = self._findCoreFile()
-            if core:
-                debug("Got core file %s", core)
-                if self._generateBackTraces:
-                    # output file for backtrace
-                    backtracefd, backtracepath = self.testrun.get_temp_file(nameid="gdb-back-trace")
-                    backtracefile = open(backtracepath, "a+")
-
-                    # run the backtrace script
-                    # This blocks, which is acceptable since we're tearing down
-                    subprocess.Popen(["gdb", "--batch", "-x", self._GDBScript, "python", core],
-                                     stdout = backtracefile,
-                                     stderr = backtracefile).wait()
-
-                    # cleanup
-                    os.close(backtracefd)
-                    backtracefile.close()
-
-                    # notify of backtrace file
-                    self.setOutputFile("backtrace-file", backtracepath)
-                if self._saveCoreDumps:
-                    # copy over the core dump
-                    corefd, corepath = self.testrun.get_temp_file(nameid="core-dump")
-                    # copy core dump to that file
-                    # FIXME : THIS MIGHT NOT WORK ON WINDOWS (see os.rename docs)
-                    try:
-                        os.rename(core, corepath)
-                        self.setOutputFile("core-dump", corepath)
-                    except:
-                        exception("Couldn't rename core dump file !!!")
-                        os.remove(core)
-                    finally:
-                        os.close(corefd)
-                else:
-                    os.remove(core)
-
-    def _findCoreFile(self):
-        cwd = self.testrun.getWorkingDirectory()
-        files = os.listdir(cwd)
-        debug("files : %r", files)
-        for fname in files:
-            if fname == "core":
-                return os.path.join(cwd, fname)
-            if fname == "core.%d" % self.test._pid:
-                return os.path.join(cwd, fname)
+            core = self._getCoreFile()
+        if not core:
+            self._removeCoreDirectory()
+            return
+        debug("Got core file %s", core)
+        # gdb takes a while to load the symbols, don't block the other
+        # tests meanwhile
+        self.testrun.addPendingOperation()
+        get_backtrace_pool().queueAction(self._processCoreDone,
+                                         self._processCore, core,
+                                         self.test._returncode)
+
+    def _checkCorePattern(self):
+        if GDBMonitor._corePatternChecked:
+            return
+        GDBMonitor._corePatternChecked = True
+        try:
+            f = open("/proc/sys/kernel/core_pattern")
+            try:
+                pattern = f.read().strip()
+            finally:
+                f.close()
+        except IOError:
+            return
+        if pattern.startswith("|") or "/" in pattern:
+            warning("core_pattern is %r, core files won't be found", pattern)
+
+    def _getCoreFile(self):
+        for fname in ["core.%d" % self.test._pid, "core"]:
+            path = os.path.join(self._coredir, fname)
+            if os.path.exists(path):
+                return path
         return None
+
+    def _removeCoreDirectory(self):
+        try:
+            os.rmdir(self._coredir)
+        except OSError:
+            warning("%s isn't empty, keeping it", self._coredir)
+
+    def _processCore(self, core, returncode):
+        """
+        Computes the signature of the crash, generates the backtrace of the
+        core file and saves it if needed.
+        Called from a worker thread, returns the output files and the
+        (signature, signal, frames) of the crash.
+        """
+        outputfiles = {}
+        signum = None
+        if returncode != None and returncode < 0:
+            signum = -returncode
+        # the remote process is run by the same interpreter (see
+        # PythonDBusTest.get_remote_launcher_args()), eu-stack needs its
+        # full path
+        frames = get_core_frames(sys.executable, core, self._signatureFrames)
+        signature = compute_crash_signature(signum, frames)
+        known = get_crash_counter().add(signature, self.testrun.getStorage())
+        debug("crash signature %s (%d known crashes)", signature, known)
+        backtrace = self._generateBackTraces
+        if backtrace and self._maxBackTraces != None:
+            backtrace = known < int(self._maxBackTraces)
+        if backtrace:
+            # output file for backtrace
+            backtracefd, backtracepath = self.testrun.get_temp_file(nameid="gdb-back-trace")
+            backtracefile = os.fdopen(backtracefd, "a+")
+            try:
+                # run the backtrace script
+                subprocess.Popen(["gdb", "--batch", "-x", self._GDBScript,
+                                  sys.executable, core],
+                                 stdout = backtracefile,
+                                 stderr = backtracefile).wait()
+            finally:
+                backtracefile.close()
+            outputfiles["backtrace-file"] = backtracepath
+        if self._saveCoreDumps:
+            # copy over the core dump
+            corefd, corepath = self.testrun.get_temp_file(nameid="core-dump")
+            # copy core dump to that file
+            # FIXME : THIS MIGHT NOT WORK ON WINDOWS (see os.rename docs)
+            try:
+                os.rename(core, corepath)
+                outputfiles["core-dump"] = corepath
+            except:
+                exception("Couldn't rename core dump file !!!")
+                os.remove(core)
+            finally:
+                os.close(corefd)
+        else:
+            os.remove(core)
+        self._removeCoreDirectory()
+        return outputfiles, (signature, signum, frames)
+
+    def _processCoreDone(self, res):
+        try:
+            if res == None:
+                return
+            outputfiles, crash = res
+            storage = self.testrun.getStorage()
+            if storage:
+                storage.newTestCrash(self.testrun, self.test, *crash)
+            for key, path in outputfiles.iteritems():
+                self.setOutputFile(key, path)
+                if storage:
+                    storage.addMonitorOutputFile(self.testrun, self.test,
+                                                 self, key, path)
+        finally:
+            self.testrun.pendingOperationDone()
+
+class PipelineStatisticsMonitor(Monitor):
+    """
+    Measures the throughput of each pad of the pipeline and the levels
+    of its queues.
+
+    The remote test counts the buffers, bytes and timestamps going through
+    the source pads with buffer probes, samples the levels of the queues
+    every sampling-interval milliseconds, and only sends the totals once
+    it's done.
+    """
+    __monitor_name__ = "pipeline-statistics-monitor"
+    __monitor_description__ = "Measures the throughput of the pads and the levels of the queues"
+    __monitor_arguments__ = {
+        "sampling-interval" : "Interval between two samples of the queue levels, in milliseconds (default:100)"
+        }
+    __monitor_extra_infos__ = {
+        "pad-statistics" : "Dictionnary of (buffers, bytes, covered duration, timestamp span, bitrate) of each element:pad source pad. Durations are in nanoseconds, the bitrate in bits per second (-1 if unknown)",
+        "queue-levels" : "Dictionnary of (samples, min buffers, mean buffers, max buffers, max bytes, max time) of each queue",
+        "processing-time" : "Time spent processing the media, in nanoseconds",
+        "processing-ratio" : "Ratio of the processing time to the duration of the processed media (the longest timestamp span of the pads)"
+        }
+    __applies_on__ = GStreamerTest
+
+    def setUp(self):
+        Monitor.setUp(self)
+        interval = int(self.arguments.get("sampling-interval", 100))
+        if interval <= 0:
+            warning("Invalid sampling interval %d", interval)
+            return False
+        self.test._environ[PIPELINE_STATISTICS_ENV] = str(interval)
+        return True
+
+    def tearDown(self):
+        Monitor.tearDown(self)
+        extras = self.test.getExtraInfo()
+        processing = extras.get("pipeline-processing-time")
+        if processing == None:
+            debug("The test didn't send any statistics")
+            return
+        self.extraInfo("processing-time", processing)
+        longest = 0
+        padstats = {}
+        pads = extras.get("pipeline-pad-counters", {})
+        for name, (buffers, nbytes, first, last, covered) in pads.iteritems():
+            span = -1
+            bitrate = -1
+            if first != -1 and last >= first:
+                span = last - first
+                longest = max(longest, span)
+                if span:
+                    bitrate = nbytes * 8 * 1000000000 / span
+            padstats[name] = (buffers, nbytes, covered, span, bitrate)
+        if padstats:
+            self.extraInfo("pad-statistics", padstats)
+        if longest:
+            self.extraInfo("processing-ratio", float(processing) / longest)
+        queuelevels = {}
+        queues = extras.get("pipeline-queue-samples", {})
+        for name, (samples, total, minbuf, maxbuf, maxbytes, maxtime) in queues.iteritems():
+            if samples:
+                queuelevels[name] = (samples, minbuf, float(total) / samples,
+                                     maxbuf, maxbytes, maxtime)
+        if queuelevels:
+            self.extraInfo("queue-levels", queuelevels)
+
+# maximum number of backtraces generated at once
+BACKTRACE_WORKERS = 2
+
+_backtrace_pool = None
+
+def get_backtrace_pool():
+    """
+    Returns the WorkerPool generating the backtraces of GDBMonitor
+    """
+    global _backtrace_pool
+    if _backtrace_pool == None:
+        _backtrace_pool = WorkerPool(BACKTRACE_WORKERS)
+    return _backtrace_pool
@@ -63,6 +63,10 @@ class Scenario(Test):
         pass
 
     def test(self):
+        if not self._tests:
+            debug("No subtests to run")
+            self.stop()
+            return
         # get the first test to run
         self._startNextSubTest()
 
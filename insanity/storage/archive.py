@@ -0,0 +1,100 @@
+# GStreamer QA system
+#
+#       storage/archive.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Compressed testrun archives
+
+An archive is a gzip-compressed SQLite database, it can be opened with
+SQLiteArchive (and merged back in any DBStorage).
+"""
+
+import os
+import gzip
+import shutil
+import tempfile
+from insanity.log import debug
+from insanity.storage.sqlite import SQLiteStorage
+
+ARCHIVE_SUFFIX = ".gz"
+
+def is_archive(path):
+    """
+    Returns True if path is the name of an archive file
+    """
+    return path.endswith(ARCHIVE_SUFFIX)
+
+class SQLiteArchive(SQLiteStorage):
+    """
+    SQLiteStorage working on an uncompressed copy of an archive.
+
+    If the archive file doesn't exist, a new one will be created. The
+    archive is only (re)written by the save() method, and the uncompressed
+    copy is removed by close().
+
+    Archives are always used synchronously.
+    """
+
+    def __init__(self, archive, *args, **kwargs):
+        self.archive = archive
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        if os.path.exists(archive):
+            debug("extracting %s to %s", archive, path)
+            src = gzip.open(archive, "rb")
+            dst = open(path, "wb")
+            try:
+                shutil.copyfileobj(src, dst)
+            finally:
+                src.close()
+                dst.close()
+        else:
+            os.unlink(path)
+        kwargs["async"] = False
+        SQLiteStorage.__init__(self, path, *args, **kwargs)
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self), self.archive)
+
+    def save(self):
+        """
+        Compresses the contents of the database to the archive file
+        """
+        self.con.commit()
+        tmp = self.archive + ".tmp"
+        debug("compressing %s to %s", self.path, self.archive)
+        src = open(self.path, "rb")
+        dst = gzip.open(tmp, "wb")
+        try:
+            shutil.copyfileobj(src, dst)
+        finally:
+            src.close()
+            dst.close()
+        os.rename(tmp, self.archive)
+
+    def close(self, callback=None, *args, **kwargs):
+        self._shutDown()
+        if callback != None and callable(callback):
+            callback(*args, **kwargs)
+
+    def _shutDown(self):
+        SQLiteStorage._shutDown(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -23,7 +23,11 @@
 Asynchronous storage interface
 """
 
+import time
+import threading
 from insanity.threads import ActionQueueThread
+from insanity.storage.stats import StorageStats, ACTION, QUEUE_WAIT, \
+     COMMIT, LOCK_WAIT, QUERY
 
 class queuemethod(object):
     def __init__(self, fn):
@@ -34,9 +38,37 @@ class queuemethod(object):
             if obj._async:
                 obj.queueAction(self.fn, obj, *args, **kwargs)
             else:
-                self.fn(obj, *args, **kwargs)
+                _TimedAction(obj, self.fn)(obj, *args, **kwargs)
         return wrapper
 
+class keyedqueuemethod(queuemethod):
+    """
+    Like queuemethod, but all calls with the same key (the argument at
+    position 'keyarg') are processed in order by the same writer thread,
+    while calls with other keys can be processed concurrently.
+    """
+    def __init__(self, fn, keyarg=0):
+        queuemethod.__init__(self, fn)
+        self.keyarg = keyarg
+
+    def __get__(self, obj, klass=None):
+        def wrapper(*args, **kwargs):
+            if obj._async:
+                obj.queueKeyedAction(args[self.keyarg], self.fn, obj,
+                                     *args, **kwargs)
+            else:
+                _TimedAction(obj, self.fn)(obj, *args, **kwargs)
+        return wrapper
+
+def keyedqueue(keyarg):
+    """
+    Decorator returning a keyedqueuemethod using the argument at position
+    keyarg as key.
+    """
+    def decorator(fn):
+        return keyedqueuemethod(fn, keyarg)
+    return decorator
+
 class finalqueuemethod(object):
     def __init__(self, fn):
         self.fn = fn
@@ -46,31 +78,161 @@ class finalqueuemethod(object):
             if obj._async:
                 obj.queueFinalAction(self.fn, obj, *args, **kwargs)
             else:
-                self.fn(obj, *args, **kwargs)
+                _TimedAction(obj, self.fn)(obj, *args, **kwargs)
         return wrapper
 
+class _TimedAction(object):
+    """
+    Wraps an action of an AsyncStorage, accounting the time it spent in the
+    queue and the time it took to execute.
+    """
+    def __init__(self, storage, method):
+        self._storage = storage
+        self._method = method
+
+    def __call__(self, *args, **kwargs):
+        self._storage._actionStarted(self)
+        start = time.time()
+        try:
+            return self._method(*args, **kwargs)
+        finally:
+            self._storage._stats.addTiming(ACTION,
+                                           getattr(self._method, "__name__",
+                                                   repr(self._method)),
+                                           time.time() - start)
+
+class _BarrierAction(object):
+    """
+    Action queued in all the writer threads. The method is called (once) by
+    the last thread reaching it, the other threads wait until it's done.
+    """
+    def __init__(self, nbthreads, method, args, kwargs):
+        self._cond = threading.Condition()
+        self._waiting = nbthreads
+        self._done = False
+        self._method = method
+        self._args = args
+        self._kwargs = kwargs
+
+    def __call__(self):
+        self._cond.acquire()
+        try:
+            self._waiting -= 1
+            if self._waiting == 0:
+                try:
+                    self._method(*self._args, **self._kwargs)
+                finally:
+                    self._done = True
+                    self._cond.notifyAll()
+            else:
+                while not self._done:
+                    self._cond.wait()
+        finally:
+            self._cond.release()
 
 class AsyncStorage:
     """
     Interface for asynchronous storing Storage
+
+    Actions are processed by 'writers' threads. With more than one writer,
+    keyed actions (see keyedqueuemethod) are dispatched according to their
+    key and all other actions act as barriers: they are processed once all
+    previously queued actions are done, and before any action queued
+    after them.
+
+    The time spent by actions in the queue and executing them is accounted
+    in the StorageStats available as '_stats', see getStorageStats().
     """
 
-    def __init__(self, async=True):
+    def __init__(self, async=True, writers=1):
         self._async = async
+        # subclasses may have created it already, to account what happens
+        # while they're being set up
+        if getattr(self, "_stats", None) == None:
+            self._stats = StorageStats()
+        # pending actions : time they were queued at
+        self.__pending = {}
+        self.__pendinglock = threading.Lock()
         if self._async:
-            self._actionthread = ActionQueueThread()
-            self._actionthread.start()
+            self._actionthreads = [ActionQueueThread() for i in range(max(1, writers))]
+            self._actionthread = self._actionthreads[0]
+            for thread in self._actionthreads:
+                thread.start()
 
     @property
     def async(self):
         """True if write operations are asynchronous"""
         return self._async
 
+    def getStorageStats(self):
+        """
+        Returns a dictionnary of metrics about the storage:
+        * queue-depth : the number of pending actions
+        * oldest-pending-age : how long the oldest pending action has been
+          waiting (in seconds)
+        * rows : the number of rows written, per table
+        * queue-wait, actions, commits, lock-wait, queries : timings (see
+          StorageStats.getTimings()) of respectively the time actions
+          spent in the queue, the execution of actions (per action name),
+          commits/syncs, waits for the storage lock and read queries (per
+          normalized query)
+        """
+        self.__pendinglock.acquire()
+        try:
+            depth = len(self.__pending)
+            oldest = min(self.__pending.values() or [None])
+        finally:
+            self.__pendinglock.release()
+        res = {"queue-depth" : depth,
+               "oldest-pending-age" : oldest and time.time() - oldest or 0.0,
+               "rows" : self._stats.getRows()}
+        for category in (QUEUE_WAIT, ACTION, COMMIT, LOCK_WAIT, QUERY):
+            res[category] = self._stats.getTimings(category)
+        return res
+
+    def _actionStarted(self, action):
+        """
+        Called by the actions when they start executing
+        """
+        self.__pendinglock.acquire()
+        try:
+            queued = self.__pending.pop(action, None)
+        finally:
+            self.__pendinglock.release()
+        if queued != None:
+            self._stats.addTiming(QUEUE_WAIT, "wait", time.time() - queued)
+
+    def __timedAction(self, cb):
+        action = _TimedAction(self, cb)
+        self.__pendinglock.acquire()
+        try:
+            self.__pending[action] = time.time()
+        finally:
+            self.__pendinglock.release()
+        return action
+
     def queueAction(self, cb, *args, **kwargs):
         if self._async:
-            self._actionthread.queueAction(cb, *args, **kwargs)
+            cb = self.__timedAction(cb)
+            if len(self._actionthreads) == 1:
+                self._actionthread.queueAction(cb, *args, **kwargs)
+                return
+            barrier = _BarrierAction(len(self._actionthreads), cb, args, kwargs)
+            for thread in self._actionthreads:
+                thread.queueAction(barrier)
 
-    def queueFinalAction(self, cb, *args, **kwargs):
+    def queueKeyedAction(self, key, cb, *args, **kwargs):
         if self._async:
-            self._actionthread.queueFinalAction(cb, *args, **kwargs)
+            cb = self.__timedAction(cb)
+            index = hash(key) % len(self._actionthreads)
+            self._actionthreads[index].queueAction(cb, *args, **kwargs)
 
+    def queueFinalAction(self, cb, *args, **kwargs):
+        if self._async:
+            cb = self.__timedAction(cb)
+            if len(self._actionthreads) == 1:
+                self._actionthread.queueFinalAction(cb, *args, **kwargs)
+                return
+            barrier = _BarrierAction(len(self._actionthreads), cb, args, kwargs)
+            for thread in self._actionthreads:
+                thread.queueFinalAction(barrier)
@@ -0,0 +1,99 @@
+# GStreamer QA system
+#
+#       storage/checklist.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Checklist bitmasks
+
+Every test entry stores two bitmasks summarizing its checklist:
+* validatedmask : the checks for which there is a result
+* passedmask : the checks which were successfully validated
+
+The bit used for a given check is its ordinal in the class hierarchy. The
+checks of the root class come first, then the ones of its subclass, etc...
+Within a class the checks are ordered by name. Since the checklist of a
+stored class never changes, the ordinal of a check is stable, and it is the
+same for a class and all its subclasses (i.e. 'no-timeout' always uses the
+same bit).
+
+This module must not depend on anything else than the python standard
+library, since it is also used by the web frontend.
+"""
+
+# bit 63 would make the masks negative in 64bit signed SQL integers
+MAX_CHECKLIST_BITS = 63
+
+def compute_checklist_ordinals(classes, checks):
+    """
+    Computes the ordinal of all checks.
+
+    classes is a list of (classid, classtype, parenttype)
+    checks is a list of (checkid, classid, checkname)
+
+    Returns a dictionnary of checkid : ordinal
+    """
+    bytype = {}
+    for classid, ctype, parent in classes:
+        bytype[ctype] = (classid, parent)
+    own = {}
+    for checkid, classid, name in checks:
+        own.setdefault(classid, []).append((name, checkid))
+    for items in own.itervalues():
+        items.sort()
+
+    bases = {}
+    def get_base(ctype):
+        # number of checks defined by the parents of ctype
+        if ctype in bases:
+            return bases[ctype]
+        classid, parent = bytype[ctype]
+        if parent and parent in bytype:
+            base = get_base(parent) + len(own.get(bytype[parent][0], []))
+        else:
+            base = 0
+        bases[ctype] = base
+        return base
+
+    res = {}
+    for ctype, (classid, parent) in bytype.iteritems():
+        base = get_base(ctype)
+        for i, (name, checkid) in enumerate(own.get(classid, [])):
+            res[checkid] = base + i
+    return res
+
+def compute_checklist_bitmasks(ordinals, checklist):
+    """
+    Returns the (validatedmask, passedmask) for the given checklist.
+
+    ordinals is the dictionnary of check : ordinal
+    checklist is a list of (check, value)
+
+    Checks with an ordinal greater than what the masks can hold are ignored.
+    """
+    validated = 0
+    passed = 0
+    for check, value in checklist:
+        ordinal = ordinals.get(check)
+        if ordinal == None or ordinal >= MAX_CHECKLIST_BITS:
+            continue
+        validated |= 1 << ordinal
+        if value:
+            passed |= 1 << ordinal
+    return (validated, passed)
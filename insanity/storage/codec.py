@@ -0,0 +1,288 @@
+# GStreamer QA system
+#
+#       storage/codec.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Value codecs used to store non-scalar values in DBStorage blob columns.
+
+The CompactCodec produces a versioned, type-tagged binary representation:
+
+  '\\x00' <format version> <flags> <payload>
+
+The leading NUL byte can never start a cPickle stream, which allows both
+the legacy pickled rows and the new ones to live in the same database.
+
+The encoding is deterministic : two equal values (dictionnaries included,
+whose items are sorted) will always be encoded to the same string, which
+allows comparing values directly in SQL.
+
+This module must not depend on anything else than the python standard
+library, since it is also used by the web frontend.
+"""
+
+import zlib
+import struct
+from cPickle import dumps, loads
+
+# Marker of CompactCodec blobs
+MAGIC = "\x00"
+# Current version of the compact format
+FORMAT_VERSION = 1
+
+# flags
+FLAG_ZLIB = 1 << 0
+
+# type tags
+TAG_NONE = "N"
+TAG_TRUE = "T"
+TAG_FALSE = "F"
+TAG_INT = "I"
+TAG_FLOAT = "D"
+TAG_STR = "S"
+TAG_UNICODE = "U"
+TAG_LIST = "L"
+TAG_TUPLE = "A"
+TAG_DICT = "M"
+TAG_SET = "E"
+TAG_PICKLE = "P"
+
+class ValueCodec:
+    """
+    Converts python values to strings suitable for storage in a blob
+    column, and back.
+    """
+
+    def encode(self, value):
+        """
+        Returns the string representation of value
+        """
+        raise NotImplementedError
+
+    def decode(self, blob):
+        """
+        Returns the value stored in the blob string
+        """
+        raise NotImplementedError
+
+    def isNative(self, blob):
+        """
+        Returns True if blob was encoded with this codec (and not a previous
+        one).
+        """
+        return True
+
+class PickleCodec(ValueCodec):
+    """
+    The legacy codec, storing values as cPickle (protocol 0) strings.
+    """
+
+    def encode(self, value):
+        return str(dumps(value))
+
+    def decode(self, blob):
+        return loads(str(blob))
+
+class CompactCodec(ValueCodec):
+    """
+    Deterministic type-tagged binary codec.
+
+    Payloads bigger than 'threshold' bytes are compressed with zlib (at
+    the given 'level') if it makes them smaller.
+
+    Blobs which weren't encoded with this codec are decoded as legacy
+    cPickle strings.
+
+    Supported types are None, bool, int, long, float, str, unicode, list,
+    tuple, dict, set and frozenset. Any other value is stored pickled, in
+    which case the determinism isn't guaranteed anymore.
+
+    Note: unicode strings only containing ASCII characters are stored as
+    str, so that u'foo' and 'foo' (which are equal) have the same encoding.
+    """
+
+    def __init__(self, threshold=256, level=6):
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, value):
+        payload = "".join(_encode(value, []))
+        flags = 0
+        if self.threshold != None and len(payload) > self.threshold:
+            compressed = zlib.compress(payload, self.level)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= FLAG_ZLIB
+        return MAGIC + chr(FORMAT_VERSION) + chr(flags) + payload
+
+    def decode(self, blob):
+        blob = str(blob)
+        if not self.isNative(blob):
+            return loads(blob)
+        version, flags = ord(blob[1]), ord(blob[2])
+        if version > FORMAT_VERSION:
+            raise ValueError("Unsupported value format version %d" % version)
+        payload = blob[3:]
+        if flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        value, pos = _decode(payload, 0)
+        if pos != len(payload):
+            raise ValueError("Trailing data after encoded value")
+        return value
+
+    def isNative(self, blob):
+        return str(blob[:1]) == MAGIC
+
+def _encode_varint(value):
+    # unsigned LEB128
+    res = []
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            res.append(chr(byte | 0x80))
+        else:
+            res.append(chr(byte))
+            return "".join(res)
+
+def _decode_varint(data, pos):
+    res = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        res |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return res, pos
+        shift += 7
+
+def _encode(value, out):
+    # bool needs to be checked before int, since it's a subclass of it
+    if value is None:
+        out.append(TAG_NONE)
+    elif value is True:
+        out.append(TAG_TRUE)
+    elif value is False:
+        out.append(TAG_FALSE)
+    elif isinstance(value, (int, long)):
+        # zig-zag encoding of arbitrary precision integers
+        if value >= 0:
+            zz = value << 1
+        else:
+            zz = ((-value) << 1) - 1
+        out.append(TAG_INT + _encode_varint(zz))
+    elif isinstance(value, float):
+        out.append(TAG_FLOAT + struct.pack(">d", value))
+    elif isinstance(value, unicode):
+        try:
+            data = value.encode("ascii")
+            tag = TAG_STR
+        except UnicodeEncodeError:
+            data = value.encode("utf-8")
+            tag = TAG_UNICODE
+        out.append(tag + _encode_varint(len(data)) + data)
+    elif isinstance(value, str):
+        out.append(TAG_STR + _encode_varint(len(value)) + value)
+    elif isinstance(value, tuple):
+        out.append(TAG_TUPLE + _encode_varint(len(value)))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, list):
+        out.append(TAG_LIST + _encode_varint(len(value)))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        # sort the items by their encoded keys
+        items = [("".join(_encode(k, [])), v) for k, v in value.iteritems()]
+        items.sort(key=lambda x: x[0])
+        out.append(TAG_DICT + _encode_varint(len(items)))
+        for key, val in items:
+            out.append(key)
+            _encode(val, out)
+    elif isinstance(value, (set, frozenset)):
+        items = ["".join(_encode(k, [])) for k in value]
+        items.sort()
+        out.append(TAG_SET + _encode_varint(len(items)))
+        out.extend(items)
+    else:
+        data = dumps(value, 2)
+        out.append(TAG_PICKLE + _encode_varint(len(data)) + data)
+    return out
+
+def _decode(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == TAG_NONE:
+        return None, pos
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_INT:
+        zz, pos = _decode_varint(data, pos)
+        if zz & 1:
+            return -((zz + 1) >> 1), pos
+        return zz >> 1, pos
+    if tag == TAG_FLOAT:
+        return struct.unpack(">d", data[pos:pos + 8])[0], pos + 8
+    if tag in (TAG_STR, TAG_UNICODE, TAG_PICKLE):
+        length, pos = _decode_varint(data, pos)
+        chunk = data[pos:pos + length]
+        if len(chunk) != length:
+            raise ValueError("Truncated value")
+        pos += length
+        if tag == TAG_UNICODE:
+            return chunk.decode("utf-8"), pos
+        if tag == TAG_PICKLE:
+            return loads(chunk), pos
+        return chunk, pos
+    if tag in (TAG_LIST, TAG_TUPLE, TAG_SET):
+        length, pos = _decode_varint(data, pos)
+        items = []
+        for i in xrange(length):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        if tag == TAG_TUPLE:
+            return tuple(items), pos
+        if tag == TAG_SET:
+            return set(items), pos
+        return items, pos
+    if tag == TAG_DICT:
+        length, pos = _decode_varint(data, pos)
+        res = {}
+        for i in xrange(length):
+            key, pos = _decode(data, pos)
+            res[key], pos = _decode(data, pos)
+        return res, pos
+    raise ValueError("Unknown type tag %r" % tag)
+
+# codec used by default by DBStorage
+DEFAULT_CODEC = CompactCodec()
+
+def encode_value(value):
+    """
+    Encodes value with the default codec
+    """
+    return DEFAULT_CODEC.encode(value)
+
+def decode_value(blob):
+    """
+    Decodes blob (either legacy pickled or encoded by the default codec)
+    """
+    return DEFAULT_CODEC.decode(blob)
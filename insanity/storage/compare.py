@@ -0,0 +1,160 @@
+# GStreamer QA system
+#
+#       storage/compare.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Testrun comparison
+
+Compares the (non-scenario) tests of two testruns by joining them on their
+fingerprints. The tests are processed by chunks of consecutive ids, so that
+comparing big testruns only requires a few queries and never loads the whole
+testruns in memory.
+
+Tests without fingerprints (unfinished tests, or tests stored by previous
+versions which weren't updated) don't match any other test.
+
+This module must not depend on anything else than the python standard
+library, since it is also used by the web frontend.
+"""
+
+# status of a test from the second testrun
+NEW = "new"
+REMOVED = "removed"
+IMPROVED = "improved"
+REGRESSED = "regressed"
+UNCHANGED = "unchanged"
+
+_LEAFTEST = "%s.id NOT IN (SELECT scenarioid FROM subtests)"
+
+def _chunk_ids(fetchall, testrunid, batchsize, extra="", extraargs=()):
+    """
+    Yields the (first, last) ids of chunks of at most batchsize leaf tests
+    of the given testrun.
+    """
+    searchstr = """
+    SELECT t.id FROM test t
+    WHERE t.testrunid=? AND t.id > ? AND %s %s
+    ORDER BY t.id LIMIT %d""" % (_LEAFTEST % "t", extra, batchsize)
+    lastid = -1
+    while True:
+        res = fetchall(searchstr, (testrunid, lastid) + tuple(extraargs))
+        if not res:
+            break
+        yield (res[0][0], res[-1][0])
+        lastid = res[-1][0]
+
+def iter_testrun_comparison(fetchall, testrun1, testrun2, withmonitors=False,
+                            batchsize=1000):
+    """
+    Compares testrun2 against testrun1 and yields, for every leaf test of
+    both testruns, a (status, testid, previousids) tuple:
+    * status : one of NEW, REMOVED, IMPROVED, REGRESSED, UNCHANGED
+    * testid : the test id (from testrun2, or from testrun1 for REMOVED tests)
+    * previousids : the list of equivalent test ids from testrun1 (empty for
+      NEW and REMOVED tests)
+
+    The tests from testrun2 are yielded first (by increasing id), then the
+    removed tests of testrun1.
+
+    fetchall is a callable taking a SQL query (using '?' placeholders) and a
+    tuple of arguments and returning the list of result rows.
+
+    If withmonitors is True, tests only match if they were run with the same
+    monitors.
+    """
+    column = withmonitors and "monitorsfingerprint" or "fingerprint"
+
+    mapstr = """
+    SELECT t2.id, t2.resultpercentage, t1.id, t1.resultpercentage
+    FROM test t2
+    LEFT JOIN test t1
+    ON t1.%s=t2.%s AND t1.testrunid=? AND %s
+    WHERE t2.testrunid=? AND t2.id BETWEEN ? AND ? AND %s
+    ORDER BY t2.id, t1.id""" % (column, column, _LEAFTEST % "t1",
+                                _LEAFTEST % "t2")
+    for first, last in _chunk_ids(fetchall, testrun2, batchsize):
+        current = None
+        for newid, newperc, oldid, oldperc in fetchall(mapstr,
+                                                       (testrun1, testrun2,
+                                                        first, last)):
+            if current == None or current[0] != newid:
+                if current != None:
+                    yield _testStatus(*current)
+                current = (newid, newperc, [], oldperc)
+            if oldid != None:
+                current[2].append(oldid)
+        if current != None:
+            yield _testStatus(*current)
+
+    removed = """
+    AND NOT EXISTS (SELECT 1 FROM test t2
+                    WHERE t2.%s=t.%s AND t2.testrunid=?)""" % (column, column)
+    for first, last in _chunk_ids(fetchall, testrun1, batchsize,
+                                  removed, (testrun2, )):
+        res = fetchall("""
+        SELECT t.id FROM test t
+        WHERE t.testrunid=? AND t.id BETWEEN ? AND ? AND %s %s
+        ORDER BY t.id""" % (_LEAFTEST % "t", removed),
+                       (testrun1, first, last, testrun2))
+        for (oldid, ) in res:
+            yield (REMOVED, oldid, [])
+
+def _testStatus(newid, newperc, oldids, oldperc):
+    """
+    Returns the comparison tuple of a test from the second testrun.
+
+    oldperc is the result percentage of the first equivalent test.
+    """
+    if oldids == []:
+        return (NEW, newid, oldids)
+    if newperc == None or oldperc == None or newperc == oldperc:
+        return (UNCHANGED, newid, oldids)
+    if newperc > oldperc:
+        return (IMPROVED, newid, oldids)
+    return (REGRESSED, newid, oldids)
+
+def compare_testruns(fetchall, testrun1, testrun2, withmonitors=False,
+                     batchsize=1000):
+    """
+    Compares testrun2 against testrun1.
+
+    See iter_testrun_comparison() for the arguments.
+
+    Returns a tuple of 5 values:
+    * list of testid in testrun2 which are not in testrun1
+    * list of testid in testrun1 which are not in testrun2
+    * list of testid in testrun2 which have improved
+    * list of testid in testrun2 which have regressed
+    * a dictionnary mapping of:
+      * testid from testrun2
+      * list of corresponding testid from testrun1
+    """
+    lists = {NEW : [], REMOVED : [], IMPROVED : [], REGRESSED : []}
+    mapping = {}
+    for status, testid, oldids in iter_testrun_comparison(fetchall, testrun1,
+                                                          testrun2,
+                                                          withmonitors,
+                                                          batchsize):
+        if status in lists:
+            lists[status].append(testid)
+        if oldids:
+            mapping[testid] = oldids
+    return (lists[NEW], lists[REMOVED], lists[IMPROVED], lists[REGRESSED],
+            mapping)
@@ -25,12 +25,22 @@ Database DataStorage for python modules supporting the DB-API v2.0
 
 import time
 import threading
-from cPickle import dumps, loads
 from weakref import WeakKeyDictionary
-from insanity.log import error, warning, debug
+from insanity.log import error, warning, info, debug
 from insanity.utils import reverse_dict, map_dict, map_list
 from insanity.storage.storage import DataStorage
-from insanity.storage.async import AsyncStorage, queuemethod
+from insanity.storage.async import AsyncStorage, queuemethod, keyedqueue
+from insanity.storage.codec import CompactCodec, PickleCodec
+from insanity.storage.checklist import compute_checklist_ordinals, \
+     compute_checklist_bitmasks
+from insanity.storage.fingerprint import compute_fingerprint, \
+     compute_value_digest, compute_snapshot_digest
+from insanity.storage.outcome import compute_test_outcome, \
+     OUTCOME_EXTRAINFOS, OUTCOME_CHECKS
+from insanity.storage.compare import compare_testruns, iter_testrun_comparison
+from insanity.storage.stats import StorageStats, TimedLock, COMMIT, QUERY, \
+     written_table, normalize_sql, format_storage_stats, \
+     summarize_storage_stats
 
 class DBStorage(DataStorage, AsyncStorage):
     """
@@ -38,22 +48,43 @@ class DBStorage(DataStorage, AsyncStorage):
     (anyone recognized by Python DB-API (PEP 249))
 
     Don't use this class directly, but one of its subclasses
+
+    Values which are neither integers nor strings are stored in blob
+    columns, encoded with the given 'codec' (a ValueCodec instance,
+    CompactCodec by default).
+
+    Subclasses supporting concurrent connections (see _concurrentWrites)
+    can process asynchronous writes with several 'writers' threads.
     """
 
-    def __init__(self, async=True, *args, **kwargs):
+    # set to True in subclasses which can be written to from several
+    # threads at once
+    _concurrentWrites = False
+
+    def __init__(self, async=True, codec=None, writers=1, *args, **kwargs):
+        if writers > 1 and not self._concurrentWrites:
+            raise ValueError("%s only supports one writer thread" % type(self).__name__)
 
         # public
         # db-api Connection
         self.con = None
+        # ValueCodec used for blob values
+        self.codec = codec or CompactCodec()
 
         # protected
+        # metrics (see AsyncStorage.getStorageStats())
+        self._stats = StorageStats()
         # threading lock
-        self._lock = threading.Lock()
+        self._lock = TimedLock(threading.Lock(), self._stats)
 
         # private
         # key: testrun, value: testrunid
         self.__testruns = WeakKeyDictionary()
         self.__tests = WeakKeyDictionary()
+        # key: monitor, value: monitorid
+        self.__monitors = WeakKeyDictionary()
+        # protects the creation of crash buckets
+        self.__crashlock = threading.Lock()
         self.__clients = WeakKeyDictionary()
 
         # cache of mappings for testclassinfo
@@ -62,9 +93,20 @@ class DBStorage(DataStorage, AsyncStorage):
         # cache of mappings for testclassinfo
         # { 'testtype' : { 'dictname' : mapping } }
         self.__mcmapping = {}
+        # cache of checklist ordinals
+        # { checkid : ordinal }
+        self.__checkordinals = None
+        # serializes the insertion of test/monitor class information
+        self.__classlock = threading.RLock()
+        # cache of environment snapshots (which never change)
+        # { snapshotid : environment }
+        self.__snapshots = {}
+        # testrun ids (None for all of them) whose finished tests are known
+        # to have fingerprints, new tests always get them
+        self.__fingerprinted = set()
 
         DataStorage.__init__(self, *args, **kwargs)
-        AsyncStorage.__init__(self, async)
+        AsyncStorage.__init__(self, async, writers)
 
     def merge(self, otherdb, testruns=None):
         """
@@ -73,17 +115,23 @@ class DBStorage(DataStorage, AsyncStorage):
         If no list of testrun id from otherdb are specified, then all testruns
         from otherdb are merged into ourselves.
 
-        Currently only supports DBStorage as other database.
+        otherdb can be any DataStorage implementing the retrieval API
+        (like another DBStorage or a JournalReader).
         """
-        # FIXME : Add option to only merge some testruns
-        if not isinstance(otherdb, DBStorage):
-            raise TypeError("otherdb is not a DBStorage !")
+        if not isinstance(otherdb, DataStorage):
+            raise TypeError("otherdb is not a DataStorage !")
         # testruns needs to be a list or tuple
         if not testruns == None:
             if not isinstance(testruns, list) and not isinstance(testruns, tuple):
                 raise TypeError("testruns needs to be a list of testrun id")
         if self.async:
             raise Exception("Can not merge into an Asynchronous DBStorage, use async=False")
+        # tests without fingerprints might be copied
+        self.__fingerprinted = set()
+        if self._fastMerge(otherdb, testruns):
+            # class information might have been added
+            self.__checkordinals = None
+            return
         self.__merge(otherdb, testruns=testruns)
 
     # DataStorage methods implementation
@@ -152,14 +200,22 @@ class DBStorage(DataStorage, AsyncStorage):
     def endTestRun(self, testrun):
         self.__endTestRun(testrun)
 
-    @queuemethod
+    @keyedqueue(1)
     def newTestStarted(self, testrun, test, commit=True):
         self.__newTestStarted(testrun, test, commit)
 
-    @queuemethod
+    @keyedqueue(1)
     def newTestFinished(self, testrun, test):
         self.__newTestFinished(testrun, test)
 
+    @keyedqueue(1)
+    def addMonitorOutputFile(self, testrun, test, monitor, key, value):
+        self.__addMonitorOutputFile(monitor, key, value)
+
+    @keyedqueue(1)
+    def newTestCrash(self, testrun, test, signature, signum, frames):
+        self.__newTestCrash(testrun, test, signature, signum, frames)
+
     def listTestRuns(self):
         liststr = "SELECT id FROM testrun"
         res = self._FetchAll(liststr)
@@ -181,11 +237,16 @@ class DBStorage(DataStorage, AsyncStorage):
             return (None, None, None)
         return res
 
-    def getNbTestsForTestrun(self, testrunid, withscenarios=True, failedonly=False):
+    def getNbTestsForTestrun(self, testrunid, withscenarios=True, failedonly=False,
+                             crashedonly=False, timedoutonly=False):
         debug("testrunid:%d", testrunid)
         liststr = "SELECT COUNT(*) FROM test WHERE testrunid=?"
         if failedonly:
             liststr += " AND resultpercentage <> 100.0"
+        if crashedonly:
+            liststr += " AND crashed=1"
+        if timedoutonly:
+            liststr += " AND timedout=1"
         res = self._FetchOne(liststr, (testrunid, ))
         if not res:
             return 0
@@ -235,7 +296,119 @@ class DBStorage(DataStorage, AsyncStorage):
 
     def getEnvironmentForTestRun(self, testrunid):
         debug("testrunid:%d", testrunid)
-        return self.__getDict("testrun_environment_dict", testrunid)
+        env = dict(self.__getEnvironmentSnapshot(self.getEnvironmentSnapshotForTestRun(testrunid)))
+        env.update(self.__getDict("testrun_environment_dict", testrunid))
+        return env
+
+    def getEnvironmentSnapshotForTestRun(self, testrunid):
+        """
+        Returns the id of the environment snapshot of the given testrun, or
+        None if it doesn't have any.
+
+        Testruns with the same snapshot id were run in the same environment
+        (except for the testrun specific entries, see
+        TESTRUN_ENVIRONMENT_KEYS).
+        """
+        res = self._FetchOne("SELECT environmentid FROM testrun WHERE id=?",
+                             (testrunid, ))
+        if not res:
+            return None
+        return res[0]
+
+    def getDuplicatesForTestRun(self, testrunid):
+        debug("testrunid:%d", testrunid)
+        res = {}
+        for value, duplicate in self._FetchAll("""
+        SELECT value, duplicate FROM testrun_duplicate
+        WHERE testrunid=? ORDER BY id""", (testrunid, )):
+            res.setdefault(value, []).append(duplicate)
+        return res
+
+    def getCrashBucketsForTestRun(self, testrunid):
+        debug("testrunid:%d", testrunid)
+        res = {}
+        for bucketid, testid in self._FetchAll("""
+        SELECT c.bucketid, c.testid FROM test_crash c
+        INNER JOIN test t ON t.id=c.testid
+        WHERE t.testrunid=? ORDER BY c.bucketid, c.testid""", (testrunid, )):
+            res.setdefault(bucketid, []).append(testid)
+        return res
+
+    def getCrashBucketInfo(self, bucketid):
+        res = self._FetchOne("""
+        SELECT signature, signum, frames FROM crash_bucket WHERE id=?""",
+                             (bucketid, ))
+        if res == None:
+            return None
+        signature, signum, frames = res
+        return (signature, signum, frames.split("\n"))
+
+    def getCrashBucketForTest(self, testid):
+        res = self._FetchOne("SELECT bucketid FROM test_crash WHERE testid=?",
+                             (testid, ))
+        if res == None:
+            return None
+        return res[0]
+
+    def getCrashBucketSize(self, signature):
+        res = self._FetchOne("""
+        SELECT COUNT(*) FROM test_crash c
+        INNER JOIN crash_bucket b ON b.id=c.bucketid
+        WHERE b.signature=?""", (signature, ))
+        return res[0]
+
+    def diffEnvironments(self, testrunid1, testrunid2):
+        """
+        Compares the environment of testrunid2 against the one of
+        testrunid1.
+
+        Returns a tuple of 3 dictionnaries:
+        * the entries only present in testrunid2 (name : value)
+        * the entries only present in testrunid1 (name : value)
+        * the entries which changed (name : (value1, value2))
+
+        Only the values which differ between the two snapshots are read.
+        The entries specific to each testrun (see TESTRUN_ENVIRONMENT_KEYS)
+        aren't compared.
+        """
+        snap1 = self.getEnvironmentSnapshotForTestRun(testrunid1)
+        snap2 = self.getEnvironmentSnapshotForTestRun(testrunid2)
+        env1, env2 = {}, {}
+        if snap1 != snap2:
+            diffstr = """
+            SELECT v.name, v.intvalue, v.txtvalue, v.blobvalue
+            FROM environment_snapshot_values sv
+            INNER JOIN environment_value v ON v.id=sv.valueid
+            WHERE sv.snapshotid=? AND sv.valueid NOT IN
+                  (SELECT valueid FROM environment_snapshot_values
+                   WHERE snapshotid=?)"""
+            for env, args in ((env1, (snap1, snap2)), (env2, (snap2, snap1))):
+                for name, ival, tval, bval in self._FetchAll(diffstr, args):
+                    env[name] = self.__rowValue(ival, tval, bval)
+        # the testrun specific entries override the snapshot ones, so the
+        # snapshot values of those entries are needed
+        own1 = self.__getDict("testrun_environment_dict", testrunid1)
+        own2 = self.__getDict("testrun_environment_dict", testrunid2)
+        names = own1.keys() + own2.keys()
+        for env, snap, own in ((env1, snap1, own1), (env2, snap2, own2)):
+            for name in names:
+                env.pop(name, None)
+            if names:
+                env.update(self.__getEnvironmentSnapshot(snap, names))
+            env.update(own)
+        for env in (env1, env2):
+            for name in TESTRUN_ENVIRONMENT_KEYS:
+                env.pop(name, None)
+        added, removed, changed = {}, {}, {}
+        for name, value in env2.iteritems():
+            if not name in env1:
+                added[name] = value
+            elif env1[name] != value:
+                changed[name] = (env1[name], value)
+        for name, value in env1.iteritems():
+            if not name in env2:
+                removed[name] = value
+        return (added, removed, changed)
 
     def getFailedTestsForTestRun(self, testrunid):
         debug("testrunid:%d", testrunid)
@@ -248,6 +421,46 @@ class DBStorage(DataStorage, AsyncStorage):
             return []
         return list(zip(*res)[0])
 
+    def getCrashedTestsForTestRun(self, testrunid):
+        """
+        Returns the list of tests of the given testrun whose subprocess
+        crashed (i.e. was killed by a signal without timing out)
+        """
+        debug("testrunid:%d", testrunid)
+        res = self._FetchAll("""
+        SELECT id FROM test WHERE crashed=1 AND testrunid=?""", (testrunid, ))
+        if not res:
+            return []
+        return list(zip(*res)[0])
+
+    def getTimedOutTestsForTestRun(self, testrunid):
+        """
+        Returns the list of tests of the given testrun which timed out
+        """
+        debug("testrunid:%d", testrunid)
+        res = self._FetchAll("""
+        SELECT id FROM test WHERE timedout=1 AND testrunid=?""", (testrunid, ))
+        if not res:
+            return []
+        return list(zip(*res)[0])
+
+    def getTestOutcome(self, testid):
+        """
+        Returns a tuple with the following info about the given test:
+        * the subprocess return code
+        * the total duration (in seconds)
+        * 1 if the test timed out, else 0
+        * 1 if the subprocess crashed, else 0
+
+        Values which aren't known for that test are None.
+        """
+        res = self._FetchOne("""
+        SELECT returncode, duration, timedout, crashed FROM test WHERE id=?""",
+                             (testid, ))
+        if not res:
+            return (None, None, None, None)
+        return res
+
     def getSucceededTestsForTestRun(self, testrunid):
         debug("testrunid:%d", testrunid)
         liststr = """
@@ -318,7 +531,7 @@ class DBStorage(DataStorage, AsyncStorage):
         FROM testclassinfo WHERE type=?"""
         res = self._FetchOne(searchstr, (testtype, ))
         if not res:
-            return (None, None, None, None, None, None)
+            return (None, None, None, None, None, None, None)
         tcid, parent, desc, fulldesc = res
         args = self.__getDict("testclassinfo_arguments_dict", tcid, blobonly=True)
         checks = self.__getDict("testclassinfo_checklist_dict", tcid, txtonly=True)
@@ -347,6 +560,35 @@ class DBStorage(DataStorage, AsyncStorage):
 
         return (desc, fulldesc, args, checks, extras, outputfiles)
 
+    def getTestClassCheckListOrdinals(self, testtype):
+        """
+        Returns a dictionnary of checkname : ordinal for the given testtype
+        (including the checks of the parent classes).
+
+        The ordinal is the bit used for that check in the validatedmask and
+        passedmask columns of the test table.
+        """
+        ordinals = self.__getCheckListOrdinals()
+        res = {}
+        for name, checkid in self.__getTestClassCheckListMapping(testtype).iteritems():
+            if checkid in ordinals:
+                res[name] = ordinals[checkid]
+        return res
+
+    def getCheckListBitmasksForTestRun(self, testrunid, withscenarios=True):
+        """
+        Returns a list of (testid, testtype, validatedmask, passedmask) for
+        all tests of the given testrun.
+        """
+        debug("testrunid:%d", testrunid)
+        liststr = """
+        SELECT test.id,testclassinfo.type,test.validatedmask,test.passedmask
+        FROM test,testclassinfo
+        WHERE test.testrunid=? AND test.type=testclassinfo.id"""
+        if withscenarios == False:
+            liststr += " AND NOT test.id in (SELECT scenarioid FROM subtests)"
+        return self._FetchAll(liststr, (testrunid, ))
+
     def getMonitorClassInfoFull(self, monitortype, withparents=True):
         searchstr = """SELECT id,parent,description
         FROM monitorclassinfo WHERE type=?"""
@@ -474,7 +716,143 @@ class DBStorage(DataStorage, AsyncStorage):
             res.append((mid, mtype, mperc, args, results, extras, outputfiles))
         return res
 
-    def findTestsByArgument(self, testtype, arguments, testrunid=None, monitorids=None, previd=None):
+    def findEquivalentTests(self, testid, testrunid=None, withmonitors=True):
+        """
+        Returns the list of test ids (excluding testid) which have the same
+        type and arguments as testid, optionally only in the given testrun.
+
+        If withmonitors is True, the tests also need to have been run with
+        the same monitors (and monitor arguments).
+        """
+        fingerprint, monitorsfingerprint = self.__getTestFingerprints(testid)
+        if fingerprint == None:
+            return []
+        self.__ensureFingerprints(testrunid)
+        if withmonitors:
+            searchstr = "SELECT id FROM test WHERE monitorsfingerprint=? AND id<>?"
+            args = [monitorsfingerprint, testid]
+        else:
+            searchstr = "SELECT id FROM test WHERE fingerprint=? AND id<>?"
+            args = [fingerprint, testid]
+        if not testrunid == None:
+            searchstr += " AND testrunid=?"
+            args.append(testrunid)
+        return [x[0] for x in self._FetchAll(searchstr, tuple(args))]
+
+    def fillFingerprints(self, testrunid=None, batchsize=500):
+        """
+        Computes the fingerprints of the finished tests which don't have
+        any (i.e. stored before the fingerprints were introduced).
+
+        If testrunid is specified, only the tests of that testrun are
+        processed.
+
+        Returns the number of updated tests.
+        """
+        searchstr = """
+        SELECT id FROM test
+        WHERE fingerprint IS NULL AND resultpercentage IS NOT NULL AND id > ?"""
+        args = []
+        if not testrunid == None:
+            searchstr += " AND testrunid=?"
+            args.append(testrunid)
+        searchstr += " ORDER BY id LIMIT %d" % batchsize
+        updatestr = """
+        UPDATE test SET fingerprint=?, monitorsfingerprint=? WHERE id=?"""
+        lastid = -1
+        updated = 0
+        while True:
+            res = self._FetchAll(searchstr, tuple([lastid] + args))
+            if not res:
+                break
+            tocommit = []
+            for (testid, ) in res:
+                fp, mfp = self.__computeStoredTestFingerprints(testid)
+                tocommit.append((fp, mfp, testid))
+            lastid = res[-1][0]
+            self._ExecuteMany(updatestr, tocommit)
+            updated += len(tocommit)
+        return updated
+
+    def compareTestRuns(self, testrun1, testrun2, withmonitors=False,
+                        batchsize=1000):
+        """
+        Compares the (non-scenario) tests of testrun2 against the ones of
+        testrun1.
+
+        If withmonitors is True, tests only match if they were run with the
+        same monitors.
+
+        Returns a tuple of 5 values:
+        * list of testid in testrun2 which are not in testrun1
+        * list of testid in testrun1 which are not in testrun2
+        * list of testid in testrun2 which have improved
+        * list of testid in testrun2 which have regressed
+        * a dictionnary mapping of:
+          * testid from testrun2
+          * list of corresponding testid from testrun1
+        """
+        self.__ensureFingerprints(testrun1)
+        self.__ensureFingerprints(testrun2)
+        return compare_testruns(self._FetchAll, testrun1, testrun2,
+                                withmonitors, batchsize)
+
+    def iterTestRunComparison(self, testrun1, testrun2, withmonitors=False,
+                              batchsize=1000):
+        """
+        Same as compareTestRuns, but yields a (status, testid, previousids)
+        tuple per test as soon as it is available.
+
+        See insanity.storage.compare.iter_testrun_comparison for details.
+        """
+        self.__ensureFingerprints(testrun1)
+        self.__ensureFingerprints(testrun2)
+        return iter_testrun_comparison(self._FetchAll, testrun1, testrun2,
+                                       withmonitors, batchsize)
+
+    def findTestsByArgument(self, testtype, arguments, testrunid=None, monitorids=None, previd=None,
+                            exact=False):
+        """
+        Returns the ids of the tests of type testtype whose arguments
+        include the given ones.
+
+        If exact is True, the tests need to have exactly the given
+        arguments, which is a single lookup of their fingerprints.
+
+        If previd or monitorids are specified, the matching tests also need
+        to have the same monitors (with the same arguments) as test previd
+        or as the given monitors.
+
+        testtype and the keys of arguments can either be names or ids.
+        """
+        if exact:
+            self.__ensureFingerprints(testrunid)
+            return self.__findTestsByFingerprint(testtype, arguments,
+                                                 testrunid, monitorids, previd)
+        # the query below works on ids, convert the names
+        typename = None
+        if not isinstance(testtype, (int, long)):
+            typename = testtype
+            testtype = self._getTestTypeID(typename)
+            if testtype == None:
+                return []
+        if [x for x in arguments if isinstance(x, basestring)]:
+            if typename == None:
+                res = self._FetchOne("SELECT type FROM testclassinfo WHERE id=?",
+                                     (testtype, ))
+                if not res:
+                    return []
+                typename = res[0]
+            mapping = self.__getTestClassArgumentMapping(typename)
+            args = {}
+            for key, val in arguments.iteritems():
+                if isinstance(key, basestring):
+                    if not key in mapping:
+                        # no test can have that argument
+                        return []
+                    key = mapping[key]
+                args[key] = val
+            arguments = args
         searchstr = """
         SELECT DISTINCT test.id
         FROM test, test_arguments_dict
@@ -502,25 +880,28 @@ class DBStorage(DataStorage, AsyncStorage):
         args = initialsearchargs[:]
 
         for key, val in arguments.iteritems():
-            value = val
+            values = [val]
             if isinstance(val, int):
                 valstr = "intvalue"
             elif isinstance(val, basestring):
                 valstr = "txtvalue"
             else:
                 valstr = "blobvalue"
-                value = str(dumps(val))
-            tmpsearch = "AND test_arguments_dict.name=? AND test_arguments_dict.%s=? " % valstr
+                # rows stored before the codec was introduced (and not
+                # converted yet) are still pickled
+                values = [self._blobParameter(self._encodeValue(val)),
+                          PickleCodec().encode(val)]
+            tmpsearch = "AND test_arguments_dict.name=? AND test_arguments_dict.%s IN (%s) " % (valstr, ",".join(["?"] * len(values)))
             if firsttime:
                 tmpargs = initialsearchargs[:]
-                tmpargs.extend([key, value])
+                tmpargs.extend([key] + values)
                 fullquery = initialsearchstr + tmpsearch
                 args = tmpargs
                 firsttime = False
             else:
                 # nest the previous query
                 fullquery = searchstr + tmpsearch + "AND test.id IN (" + fullquery + ")"
-                args = [key, value] + args
+                args = [key] + values + args
 
         # do the query
         try:
@@ -561,6 +942,260 @@ class DBStorage(DataStorage, AsyncStorage):
             res = tmp
         return res
 
+    def convertBlobValues(self, batchsize=500):
+        """
+        Re-encodes all blob values which weren't stored with the current
+        codec (like the cPickle values of databases created by previous
+        versions).
+
+        The conversion is done in batches of 'batchsize' rows, each batch
+        being committed separately.
+
+        Returns the number of converted values.
+        """
+        if self.async:
+            raise Exception("Can not convert an Asynchronous DBStorage, use async=False")
+        converted = 0
+        for table in BLOB_TABLES:
+            debug("Converting blob values of %s", table)
+            searchstr = """
+            SELECT id, blobvalue FROM %s
+            WHERE id > ? AND blobvalue IS NOT NULL
+            ORDER BY id LIMIT %d""" % (table, batchsize)
+            updatestr = "UPDATE %s SET blobvalue=? WHERE id=?" % table
+            lastid = -1
+            while True:
+                rows = self._FetchAll(searchstr, (lastid, ))
+                if not rows:
+                    break
+                lastid = rows[-1][0]
+                tocommit = []
+                for rowid, blob in rows:
+                    if self.codec.isNative(str(blob)):
+                        continue
+                    try:
+                        value = self._decodeValue(blob)
+                    except:
+                        warning("Couldn't decode value %d of %s", rowid, table)
+                        continue
+                    tocommit.append((self._blobParameter(self._encodeValue(value)),
+                                     rowid))
+                if tocommit:
+                    self._ExecuteMany(updatestr, tocommit)
+                    converted += len(tocommit)
+        return converted
+
+    def convertEnvironments(self):
+        """
+        Moves the environments of testruns stored by previous versions to
+        environment snapshots.
+
+        Each testrun is converted (and committed) separately.
+
+        Returns the number of converted testruns.
+        """
+        if self.async:
+            raise Exception("Can not convert an Asynchronous DBStorage, use async=False")
+        res = self._FetchAll("""
+        SELECT id FROM testrun WHERE environmentid IS NULL
+        AND id IN (SELECT containerid FROM testrun_environment_dict)""")
+        for (testrunid, ) in res:
+            debug("Converting environment of testrun %d", testrunid)
+            env = self.__getDict("testrun_environment_dict", testrunid)
+            self._ExecuteCommit("DELETE FROM testrun_environment_dict WHERE containerid=?",
+                                (testrunid, ), commit=False)
+            self.__storeEnvironment(testrunid, env)
+        return len(res)
+
+    def deleteTestRuns(self, testrunids, batchsize=500):
+        """
+        Deletes the given testruns, along with all their tests, monitors
+        and related information. Clients which don't have any testrun left
+        are also removed.
+
+        The tests are deleted in batches of 'batchsize' tests, each batch
+        being committed separately.
+
+        Returns the number of deleted tests.
+        """
+        if self.async:
+            raise Exception("Can not delete from an Asynchronous DBStorage, use async=False")
+        deleted = 0
+        for testrunid in testrunids:
+            debug("Deleting testrun %d", testrunid)
+            while True:
+                res = self._FetchAll("""
+                SELECT id FROM test WHERE testrunid=? ORDER BY id LIMIT %d""" % batchsize,
+                                     (testrunid, ))
+                if not res:
+                    break
+                tests = tuple([x[0] for x in res])
+                self.__deleteTests(tests)
+                deleted += len(tests)
+            self._ExecuteCommit("DELETE FROM testrun_environment_dict WHERE containerid=?",
+                                (testrunid, ), commit=False)
+            self._ExecuteCommit("DELETE FROM testrun_duplicate WHERE testrunid=?",
+                                (testrunid, ), commit=False)
+            self._ExecuteCommit("DELETE FROM testrun WHERE id=?", (testrunid, ))
+        self.__deleteOrphans("crash_bucket", "id", """
+        NOT EXISTS (SELECT 1 FROM test_crash WHERE test_crash.bucketid=crash_bucket.id)""",
+                             batchsize)
+        self.__deleteOrphans("client", "id", """
+        NOT EXISTS (SELECT 1 FROM testrun WHERE testrun.clientid=client.id)""",
+                             batchsize)
+        # environment snapshots and values no longer used
+        self.__deleteOrphans("environment_snapshot", "id", """
+        NOT EXISTS (SELECT 1 FROM testrun
+                    WHERE testrun.environmentid=environment_snapshot.id)""",
+                             batchsize)
+        self.__deleteOrphans("environment_snapshot_values", "snapshotid", """
+        NOT EXISTS (SELECT 1 FROM environment_snapshot
+                    WHERE environment_snapshot.id=environment_snapshot_values.snapshotid)""",
+                             batchsize)
+        self.__deleteOrphans("environment_value", "id", """
+        NOT EXISTS (SELECT 1 FROM environment_snapshot_values
+                    WHERE environment_snapshot_values.valueid=environment_value.id)""",
+                             batchsize)
+        self.__snapshots = {}
+        return deleted
+
+    def reclaimSpace(self, maxpages=None):
+        """
+        Gives back to the system the space freed by deleted rows (if the
+        database supports doing it incrementally), at most 'maxpages'
+        pages if specified.
+
+        Returns the number of reclaimed pages, or None if not supported.
+        """
+        return None
+
+    def __deleteTests(self, tests):
+        """
+        Deletes the given tests (and their monitors) in one transaction
+        """
+        inlist = ",".join(["?"] * len(tests))
+        for table in MONITOR_CONTAINER_TABLES:
+            self._ExecuteCommit("""
+            DELETE FROM %s WHERE containerid IN
+            (SELECT id FROM monitor WHERE testid IN (%s))""" % (table, inlist),
+                                tests, commit=False)
+        self._ExecuteCommit("DELETE FROM monitor WHERE testid IN (%s)" % inlist,
+                            tests, commit=False)
+        for table in TEST_CONTAINER_TABLES:
+            self._ExecuteCommit("DELETE FROM %s WHERE containerid IN (%s)" % (table, inlist),
+                                tests, commit=False)
+        # separately, so that the number of parameters stays the one of
+        # the other statements (SQLite used to only allow 999 of them)
+        self._ExecuteCommit("DELETE FROM subtests WHERE testid IN (%s)" % inlist,
+                            tests, commit=False)
+        self._ExecuteCommit("DELETE FROM subtests WHERE scenarioid IN (%s)" % inlist,
+                            tests, commit=False)
+        self._ExecuteCommit("DELETE FROM test_crash WHERE testid IN (%s)" % inlist,
+                            tests, commit=False)
+        self._ExecuteCommit("DELETE FROM test WHERE id IN (%s)" % inlist, tests)
+
+    def __deleteOrphans(self, table, column, condition, batchsize):
+        """
+        Deletes the rows of table matching condition, in batches of
+        'batchsize' values of column (walked in increasing order), each
+        batch being committed separately.
+        """
+        searchstr = """
+        SELECT DISTINCT %s FROM %s WHERE %s > ? AND %s
+        ORDER BY %s LIMIT %d""" % (column, table, column, condition,
+                                    column, batchsize)
+        last = -1
+        while True:
+            res = self._FetchAll(searchstr, (last, ))
+            if not res:
+                break
+            values = tuple([x[0] for x in res])
+            self._ExecuteCommit("DELETE FROM %s WHERE %s IN (%s)"
+                                % (table, column, ",".join(["?"] * len(values))),
+                                values)
+            last = values[-1]
+
+    def __ensureFingerprints(self, testrunid=None):
+        """
+        Fills the missing fingerprints of the finished tests (of the given
+        testrun), only checking them once.
+        """
+        if None in self.__fingerprinted or testrunid in self.__fingerprinted:
+            return
+        self.fillFingerprints(testrunid)
+        self.__fingerprinted.add(testrunid)
+
+    def __findTestsByFingerprint(self, testtype, arguments, testrunid=None,
+                                 monitorids=None, previd=None):
+        if isinstance(testtype, (int, long)):
+            res = self._FetchOne("SELECT type FROM testclassinfo WHERE id=?",
+                                 (testtype, ))
+            if not res:
+                return []
+            testtype = res[0]
+        # convert argument ids to names
+        revmap = reverse_dict(self.__getTestClassArgumentMapping(testtype))
+        args = {}
+        for key, value in arguments.iteritems():
+            args[revmap.get(key, key)] = value
+
+        if previd == None and monitorids == None:
+            searchstr = "SELECT id FROM test WHERE fingerprint=?"
+            fingerprint = compute_fingerprint(testtype, args)
+        else:
+            if monitorids == None:
+                monitors = [(mtype, margs) for mid, mtype, mperc, margs, a, b, c
+                            in self.getFullMonitorsInfoForTest(previd, onlyargs=True)]
+            else:
+                monitors = [self.getFullMonitorInfo(x)[1:3] for x in monitorids]
+            searchstr = "SELECT id FROM test WHERE monitorsfingerprint=?"
+            fingerprint = compute_fingerprint(testtype, args, monitors)
+        searchargs = [fingerprint]
+        if not testrunid == None:
+            searchstr += " AND testrunid=?"
+            searchargs.append(testrunid)
+        return [x[0] for x in self._FetchAll(searchstr, tuple(searchargs))]
+
+    def __getTestFingerprints(self, testid):
+        """
+        Returns the (fingerprint, monitorsfingerprint) of the given test
+        """
+        res = self._FetchOne("""
+        SELECT fingerprint, monitorsfingerprint FROM test WHERE id=?""",
+                             (testid, ))
+        if not res:
+            return (None, None)
+        if res[0] == None:
+            return self.__computeStoredTestFingerprints(testid)
+        return res
+
+    def __computeStoredTestFingerprints(self, testid):
+        """
+        Computes the (fingerprint, monitorsfingerprint) of a stored test
+        """
+        testrunid, ttype, args = self.getFullTestInfo(testid, onlyargs=True)[:3]
+        monitors = [(mtype, margs) for mid, mtype, mperc, margs, a, b, c
+                    in self.getFullMonitorsInfoForTest(testid, onlyargs=True)]
+        return (compute_fingerprint(ttype, args),
+                compute_fingerprint(ttype, args, monitors))
+
+    def __computeTestFingerprints(self, testtype, arguments, monitors):
+        """
+        Computes the (fingerprint, monitorsfingerprint) of a test, only taking
+        into account the arguments which will be stored.
+
+        monitors is a list of (monitortype, arguments)
+        """
+        maps = self.__getTestClassArgumentMapping(testtype)
+        args = dict([(k, v) for k, v in arguments.iteritems() if k in maps])
+        mons = []
+        for mtype, margs in monitors:
+            mmaps = self.__getMonitorClassArgumentMapping(mtype)
+            mons.append((mtype, dict([(k, v) for k, v in margs.iteritems()
+                                      if k in mmaps])))
+        return (compute_fingerprint(testtype, args),
+                compute_fingerprint(testtype, args, mons))
+
     # Methods to be implemented in subclasses
     # DBAPI implementation specific
 
@@ -587,6 +1222,27 @@ class DBStorage(DataStorage, AsyncStorage):
         """
         raise NotImplementedError
 
+    def _getEnvironmentSnapshotScheme(self):
+        """
+        Returns the script creating the environment snapshot tables (and
+        their indexes)
+        """
+        raise NotImplementedError
+
+    def _getDuplicateScheme(self):
+        """
+        Returns the script creating the testrun duplicate table (and its
+        index)
+        """
+        raise NotImplementedError
+
+    def _getCrashBucketScheme(self):
+        """
+        Returns the script creating the crash bucket tables (and their
+        indexes)
+        """
+        raise NotImplementedError
+
     # Optional overrides
 
     def _updateTables(self, fromversion, toversion):
@@ -597,6 +1253,18 @@ class DBStorage(DataStorage, AsyncStorage):
         # FIXME : This could most likely have a default implementation
         if fromversion < 2:
             self.__updateDatabaseFrom1To2()
+        if fromversion < 3:
+            self.__updateDatabaseFrom2To3()
+        if fromversion < 4:
+            self.__updateDatabaseFrom3To4()
+        if fromversion < 5:
+            self.__updateDatabaseFrom4To5()
+        if fromversion < 6:
+            self.__updateDatabaseFrom5To6()
+        if fromversion < 7:
+            self.__updateDatabaseFrom6To7()
+        if fromversion < 8:
+            self.__updateDatabaseFrom7To8()
 
         # finally update the db version
         cmstr = "UPDATE version SET version=?,modificationtime=? WHERE version=?"
@@ -621,9 +1289,40 @@ class DBStorage(DataStorage, AsyncStorage):
             debug("Closing database Connection")
             self.con.close()
 
+    def _fastMerge(self, otherdb, testruns=None):
+        """
+        Merges the given testruns of otherdb (all of them if None) using
+        database specific bulk operations.
+
+        Returns True if the merge was done, or False if it isn't possible
+        with otherdb, in which case the generic (and slower) merge is used.
+        """
+        return False
+
     # PROTECTED METHODS
     # Usable by subclasses
 
+    def _encodeValue(self, value):
+        """
+        Returns the string to store in a blob column for value
+        """
+        return self.codec.encode(value)
+
+    def _decodeValue(self, blob):
+        """
+        Returns the value stored in a blob column
+        """
+        return self.codec.decode(str(blob))
+
+    def _blobParameter(self, blob):
+        """
+        Returns the query parameter to use for the given encoded blob.
+
+        Subclasses can override this if their DB-API module needs binary
+        strings to be wrapped.
+        """
+        return blob
+
     def _ExecuteScript(self, instructions, *args, **kwargs):
         """
         Executes the given script.
@@ -646,13 +1345,40 @@ class DBStorage(DataStorage, AsyncStorage):
         try:
             cur = self.con.cursor()
             cur.execute(instruction, *args, **kwargs)
+            self.__countRows(instruction, cur.rowcount)
             if commit:
-                self.con.commit()
+                self._commit()
         finally:
             if not threadsafe:
                 self._lock.release()
         return cur.lastrowid
 
+    def _commit(self):
+        """
+        Commits the current transaction, the lock must be taken.
+        """
+        start = time.time()
+        self.con.commit()
+        self._stats.addTiming(COMMIT, "commit", time.time() - start)
+
+    def __countRows(self, instruction, rowcount):
+        if rowcount < 0:
+            return
+        table = written_table(instruction)
+        if table != None:
+            self._stats.addRows(table, rowcount)
+
+    def _InsertMany(self, table, columns, rows, commit=True, threadsafe=False):
+        """
+        Inserts the given rows (a list of tuples of values for the given
+        columns) in table.
+        """
+        insertstr = "INSERT INTO %s (%s) VALUES (%s)" % (table,
+                                                         ", ".join(columns),
+                                                         ", ".join(["?"] * len(columns)))
+        self._ExecuteMany(insertstr, rows, commit=commit,
+                          threadsafe=threadsafe)
+
     def _ExecuteMany(self, instruction, *args, **kwargs):
         commit = kwargs.pop("commit", True)
         threadsafe = kwargs.pop("threadsafe", False)
@@ -661,8 +1387,9 @@ class DBStorage(DataStorage, AsyncStorage):
         try:
             cur = self.con.cursor()
             cur.executemany(instruction, *args, **kwargs)
+            self.__countRows(instruction, cur.rowcount)
             if commit:
-                self.con.commit()
+                self._commit()
         finally:
             if not threadsafe:
                 self._lock.release()
@@ -679,9 +1406,12 @@ class DBStorage(DataStorage, AsyncStorage):
         debug("kwargs: %r", kwargs)
         self._lock.acquire()
         try:
+            start = time.time()
             cur = self.con.cursor()
             cur.execute(instruction, *args, **kwargs)
             res = cur.fetchall()
+            self._stats.addTiming(QUERY, normalize_sql(instruction),
+                                  time.time() - start)
         finally:
             self._lock.release()
         debug("returning %r", res)
@@ -699,9 +1429,12 @@ class DBStorage(DataStorage, AsyncStorage):
         debug("kwargs: %r", kwargs)
         self._lock.acquire()
         try:
+            start = time.time()
             cur = self.con.cursor()
             cur.execute(instruction, *args, **kwargs)
             res = cur.fetchone()
+            self._stats.addTiming(QUERY, normalize_sql(instruction),
+                                  time.time() - start)
         finally:
             self._lock.release()
         debug("returning %r", res)
@@ -765,7 +1498,144 @@ class DBStorage(DataStorage, AsyncStorage):
         """
         # Add usedtests_testrun table and index
         self._ExecuteScript(create1to2)
-        self.con.commit()
+        self._commit()
+
+    def __updateDatabaseFrom2To3(self):
+        # Add the checklist bitmasks to the test table
+        self._ExecuteCommit("ALTER TABLE test ADD COLUMN validatedmask BIGINT")
+        self._ExecuteCommit("ALTER TABLE test ADD COLUMN passedmask BIGINT")
+        self.__fillCheckListBitmasks()
+
+    def __updateDatabaseFrom3To4(self):
+        # Add the test fingerprints, existing tests need to be filled
+        # with fillFingerprints()
+        self._ExecuteCommit("ALTER TABLE test ADD COLUMN fingerprint VARCHAR(40)")
+        self._ExecuteCommit("ALTER TABLE test ADD COLUMN monitorsfingerprint VARCHAR(40)")
+        self._ExecuteCommit("""
+        CREATE INDEX test_fingerprint_idx ON test (fingerprint, testrunid)""")
+        self._ExecuteCommit("""
+        CREATE INDEX test_monitorsfingerprint_idx
+        ON test (monitorsfingerprint, testrunid)""")
+
+    def __updateDatabaseFrom4To5(self):
+        # Add the test outcome columns and fill them from the extra
+        # information and checklists of existing tests
+        self._ExecuteCommit("ALTER TABLE test ADD COLUMN returncode INTEGER")
+        self._ExecuteCommit("ALTER TABLE test ADD COLUMN duration FLOAT")
+        self._ExecuteCommit("ALTER TABLE test ADD COLUMN timedout INTEGER")
+        self._ExecuteCommit("ALTER TABLE test ADD COLUMN crashed INTEGER")
+        self._ExecuteCommit("""
+        CREATE INDEX test_returncode_idx ON test (returncode, testrunid)""")
+        self._ExecuteCommit("""
+        CREATE INDEX test_duration_idx ON test (testrunid, duration)""")
+        self._ExecuteCommit("""
+        CREATE INDEX test_timedout_idx ON test (timedout, testrunid)""")
+        self._ExecuteCommit("""
+        CREATE INDEX test_crashed_idx ON test (crashed, testrunid)""")
+        self.__fillTestOutcomes()
+
+    def __updateDatabaseFrom5To6(self):
+        # Add the environment snapshots, existing environments need to be
+        # converted with convertEnvironments()
+        self._ExecuteScript(self._getEnvironmentSnapshotScheme())
+        self._ExecuteCommit("ALTER TABLE testrun ADD COLUMN environmentid INTEGER")
+        self._ExecuteCommit("""
+        CREATE INDEX testrun_environmentid_idx ON testrun (environmentid)""")
+
+    def __updateDatabaseFrom6To7(self):
+        # Add the duplicates of testruns
+        self._ExecuteScript(self._getDuplicateScheme())
+
+    def __updateDatabaseFrom7To8(self):
+        # Add the crash buckets
+        self._ExecuteScript(self._getCrashBucketScheme())
+
+    def __fillTestOutcomes(self, batchsize=1000):
+        """
+        Computes the outcome columns of all existing tests
+        """
+        debug("Filling test outcomes")
+        minid, maxid = self._FetchOne("SELECT MIN(id), MAX(id) FROM test")
+        if minid == None:
+            return
+        # the ids of the relevant extra information and checks (for all
+        # classes)
+        def getnames(tablename, names):
+            return dict(self._FetchAll("""
+            SELECT id, name FROM %s WHERE name IN (%s)""" % (tablename,
+                                                             ",".join(["?"] * len(names))),
+                                       names))
+        extranames = getnames("testclassinfo_extrainfo_dict", OUTCOME_EXTRAINFOS)
+        checknames = getnames("testclassinfo_checklist_dict", OUTCOME_CHECKS)
+        if not extranames and not checknames:
+            return
+        extrastr = """
+        SELECT containerid, name, intvalue, txtvalue, blobvalue
+        FROM test_extrainfo_dict
+        WHERE containerid >= ? AND containerid < ? AND name IN (%s)""" % \
+            ",".join([str(x) for x in extranames.keys()] or ["NULL"])
+        checkstr = """
+        SELECT containerid, name, intvalue FROM test_checklist_list
+        WHERE containerid >= ? AND containerid < ? AND name IN (%s)""" % \
+            ",".join([str(x) for x in checknames.keys()] or ["NULL"])
+        updatestr = """
+        UPDATE test SET returncode=?, duration=?, timedout=?, crashed=?
+        WHERE id=?"""
+        start = minid
+        while start <= maxid:
+            extras = {}
+            for testid, name, ival, tval, bval in self._FetchAll(extrastr,
+                                                                 (start, start + batchsize)):
+                if ival != None:
+                    val = ival
+                elif tval != None:
+                    val = tval
+                else:
+                    val = self._decodeValue(bval)
+                extras.setdefault(testid, {})[extranames[name]] = val
+            checks = {}
+            for testid, name, value in self._FetchAll(checkstr,
+                                                      (start, start + batchsize)):
+                checks.setdefault(testid, []).append((checknames[name], value))
+            tocommit = []
+            for testid in set(extras.keys() + checks.keys()):
+                outcome = compute_test_outcome(checks.get(testid, []),
+                                               extras.get(testid, {}))
+                tocommit.append(outcome + (testid, ))
+            if tocommit:
+                self._ExecuteMany(updatestr, tocommit)
+            start += batchsize
+
+    def __fillCheckListBitmasks(self, batchsize=1000):
+        """
+        Computes the checklist bitmasks of all existing tests
+        """
+        debug("Filling checklist bitmasks")
+        ordinals = self.__getCheckListOrdinals()
+        minid, maxid = self._FetchOne("SELECT MIN(id), MAX(id) FROM test")
+        if minid == None:
+            return
+        searchstr = """
+        SELECT containerid, name, intvalue FROM test_checklist_list
+        WHERE containerid >= ? AND containerid < ?"""
+        updatestr = "UPDATE test SET validatedmask=?, passedmask=? WHERE id=?"
+        start = minid
+        while start <= maxid:
+            checks = {}
+            for testid, name, value in self._FetchAll(searchstr,
+                                                      (start, start + batchsize)):
+                checks.setdefault(testid, []).append((name, value))
+            tocommit = []
+            for testid, checklist in checks.iteritems():
+                validated, passed = compute_checklist_bitmasks(ordinals, checklist)
+                tocommit.append((validated, passed, testid))
+            if tocommit:
+                self._ExecuteMany(updatestr, tocommit)
+            start += batchsize
+        # finished tests without any checklist
+        self._ExecuteCommit("""
+        UPDATE test SET validatedmask=0, passedmask=0
+        WHERE validatedmask IS NULL AND resultpercentage IS NOT NULL""")
 
     def __merge(self, otherdb, testruns=None):
         # FIXME : This is a straight-forward method that could be optimized
@@ -800,7 +1670,8 @@ class DBStorage(DataStorage, AsyncStorage):
         # 3. Environment
         env = otherdb.getEnvironmentForTestRun(othertrid)
         if env:
-            self._storeEnvironmentDict(trid, env)
+            self.__storeEnvironment(trid, env)
+        self.__storeDuplicates(trid, otherdb.getDuplicatesForTestRun(othertrid))
 
         debug("Ensuring all TestClassInfo are present in self")
         # We need to figure out which test and monitor types are being used
@@ -817,8 +1688,8 @@ class DBStorage(DataStorage, AsyncStorage):
                 self.__mergeMonitorClassInfo(mclass, otherdb)
 
         debug("Getting Class/Monitor mappings")
-        testclassmap = self.__getTestClassRemoteMapping(otherdb)
-        monitorclassmap = self.__getMonitorClassRemoteMapping(otherdb)
+        testclassmap = self.__getClassIDs("testclassinfo", testclasses)
+        monitorclassmap = self.__getClassIDs("monitorclassinfo", monitorclasses)
         testmapping = {}
 
         debug("Inserting tests")
@@ -829,19 +1700,20 @@ class DBStorage(DataStorage, AsyncStorage):
             newtestid = self.__mergeTest(otherdb, othertestid, trid,
                                          testclassmap, monitorclassmap)
             testmapping[othertestid] = newtestid
+            bucketid = otherdb.getCrashBucketForTest(othertestid)
+            if bucketid != None:
+                signature, signum, frames = otherdb.getCrashBucketInfo(bucketid)
+                self.__storeTestCrash(newtestid, signature, signum, frames)
 
         debug("Merging subtest table")
         # Finnally move all subtests using the testmapping
-        selectstr = """
-        SELECT testid, scenarioid FROM subtests
-        WHERE testid IN ( %s )""" % ','.join([str(x) for x in testmapping.keys()])
         insertstr = """
         INSERT INTO subtests (testid, scenarioid) VALUES (?, ?)"""
-        subtests = otherdb._FetchAll(selectstr, ())
         # convert the subtests from old testid to new testid
         tocommit = []
-        for testid, scenarioid in subtests:
-            tocommit.append((testmapping[testid], testmapping[scenarioid]))
+        for scenarioid, subtests in otherdb.getScenariosForTestRun(othertrid).iteritems():
+            for testid in subtests:
+                tocommit.append((testmapping[testid], testmapping[scenarioid]))
         self._ExecuteMany(insertstr, tocommit)
 
         debug("done merging testrun")
@@ -855,17 +1727,27 @@ class DBStorage(DataStorage, AsyncStorage):
         """
         debug("otid:%d, testrunid:%d", otid, testrunid)
         insertstr = """
-        INSERT INTO test (testrunid, type, resultpercentage)
-        VALUES (?, ?, ?)
+        INSERT INTO test (testrunid, type, resultpercentage,
+                          validatedmask, passedmask,
+                          fingerprint, monitorsfingerprint,
+                          returncode, duration, timedout, crashed)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
 
         oldtr, testname, args, checks, resperc, extras, outputfiles = otherdb.getFullTestInfo(otid)
         # convert testname (str) to testtype (int)
         debug("testname %s", testname)
-        tmp = testclassmap[testname]
-        ttype = tmp[0]
-
-        newtid = self._ExecuteCommit(insertstr, (testrunid, ttype, resperc))
+        ttype = testclassmap[testname]
+
+        validated, passed = self.__getCheckListBitmasks(testname, checks)
+        monitors = otherdb.getFullMonitorsInfoForTest(otid)
+        fingerprint, mfingerprint = self.__computeTestFingerprints(testname, args,
+                                                                   [(m[1], m[3]) for m in monitors])
+        outcome = compute_test_outcome(checks, extras)
+        newtid = self._ExecuteCommit(insertstr, (testrunid, ttype, resperc,
+                                                 validated, passed,
+                                                 fingerprint, mfingerprint)
+                                     + outcome)
 
         # store the dictionnaries
         self.__storeTestArgumentsDict(newtid, args, testname)
@@ -874,18 +1756,10 @@ class DBStorage(DataStorage, AsyncStorage):
         self.__storeTestOutputFileDict(newtid, outputfiles, testname)
 
         # and on to the monitors
-        monitorids = otherdb.getMonitorsIDForTest(otid)
-        for oldmid in monitorids:
-            un_tid, omtype, margs, mres, mresperc, mextras, moutputs = otherdb.getFullMonitorInfo(oldmid)
+        for oldmid, omtype, mresperc, margs, mres, mextras, moutputs in monitors:
             # convert omtype to self
             debug("omtype:%r", omtype)
-            debug("monitorclassmap:%r", monitorclassmap)
-            monitorname = None
-            for mname,mtypes in monitorclassmap.iteritems():
-                if omtype == mname:
-                    id_self, id_other = mtypes
-                    mtype = id_self
-                    break
+            mtype = monitorclassmap[omtype]
             self.__rawStoreMonitor(newtid, mtype, omtype,
                                    mresperc, margs, mres, mextras, moutputs)
         return newtid
@@ -925,39 +1799,18 @@ class DBStorage(DataStorage, AsyncStorage):
         self.__rawInsertMonitorClassInfo(ttype, ptype, desc, args, checks, extras,
                                          outputfiles)
 
-    def __getRemoteMapping(self, tablename, otherdb, field1='type', field2='id'):
-        # field1 is the common field
-        # field2 is the one that varies
-        getstr = """SELECT %s, %s FROM %s""" % (field1, field2, tablename)
-        selfcl = dict(self._FetchAll(getstr, ( )))
-        othercl = dict(otherdb._FetchAll(getstr, ( )))
-        # we now have two dicts with name:id
+    def __getClassIDs(self, tablename, types):
+        """
+        Returns a dictionnary of type name : id in self for the given class
+        types (from the testclassinfo or monitorclassinfo table)
+        """
         res = {}
-        for selftype, selfid in selfcl.iteritems():
-            if othercl.has_key(selftype):
-                res[selftype] = (selfid, othercl[selftype])
+        getstr = "SELECT id FROM %s WHERE type=?" % tablename
+        for ctype in types:
+            res[ctype] = self._FetchOne(getstr, (ctype, ))[0]
         debug("returning mapping %r", res)
         return res
 
-    def __getTestClassRemoteMapping(self, otherdb):
-        """
-        Returns the mapping of all common testclassinfo between self and otherdb
-
-        Key : testname
-        Value : (id in selfdb, id in otherdb)
-        """
-        return self.__getRemoteMapping("testclassinfo", otherdb)
-        # now that we have the class mappings, we can get the maps for 
-
-    def __getMonitorClassRemoteMapping(self, otherdb):
-        """
-        Returns a mapping of all common monitorclassinfo between self and otherdb.
-
-        Key : monitorname
-        Value : (id in selfdb, id in otherdb)
-        """
-        return self.__getRemoteMapping("monitorclassinfo", otherdb)
-
     def __rawStartNewTestRun(self, clientid, starttime):
         insertstr = """
         INSERT INTO testrun (clientid, starttime) VALUES (?, ?)
@@ -975,9 +1828,11 @@ class DBStorage(DataStorage, AsyncStorage):
         else:
             clientid = self.__clients.get(testrun, 0)
         testrunid = self.__rawStartNewTestRun(clientid, testrun._starttime)
+        # the metrics stored at the end are the ones of this testrun
+        self._stats.reset()
         envdict = testrun.getEnvironment()
         if envdict:
-            self._storeEnvironmentDict(testrunid, envdict)
+            self.__storeEnvironment(testrunid, envdict)
         self.__testruns[testrun] = testrunid
         debug("Got testrun id %d", testrunid)
         return testrunid
@@ -991,8 +1846,17 @@ class DBStorage(DataStorage, AsyncStorage):
         if not testrun in self.__testruns.keys():
             # add the testrun since it wasn't done before
             self.__startNewTestRun(testrun, None)
-        self.__rawEndTestRun(self.__testruns[testrun],
-                             testrun._stoptime)
+        testrunid = self.__testruns[testrun]
+        # keep the storage metrics along with the testrun, to be able to
+        # diagnose slow runs
+        stats = self.getStorageStats()
+        for line in format_storage_stats(stats):
+            info("storage stats: %s", line)
+        self._storeEnvironmentDict(testrunid,
+                                   {"storage-stats" : summarize_storage_stats(stats)})
+        self.__storeDuplicates(testrunid, testrun.getDuplicates())
+        # this also commits the metrics
+        self.__rawEndTestRun(testrunid, testrun._stoptime)
         debug("updated")
 
     def __rawNewTestStarted(self, testrunid, testtype, commit=True):
@@ -1037,6 +1901,7 @@ class DBStorage(DataStorage, AsyncStorage):
         self.__storeMonitorCheckListDict(mid, checks, monitorname)
         self.__storeMonitorExtraInfoDict(mid, extras, monitorname)
         self.__storeMonitorOutputFileDict(mid, outputfiles, monitorname)
+        return mid
 
     def __storeMonitor(self, monitor, testid):
         debug("monitor:%r:%d", monitor, testid)
@@ -1044,12 +1909,34 @@ class DBStorage(DataStorage, AsyncStorage):
         self.__storeMonitorClassInfo(monitor)
 
         monitortype = self._getMonitorTypeID(monitor.__monitor_name__)
-        self.__rawStoreMonitor(testid, monitortype, monitor.__monitor_name__,
-                               monitor.getSuccessPercentage(),
-                               monitor.getArguments(),
-                               monitor.getCheckList(),
-                               monitor.getExtraInfo(),
-                               monitor.getOutputFiles())
+        mid = self.__rawStoreMonitor(testid, monitortype, monitor.__monitor_name__,
+                                     monitor.getSuccessPercentage(),
+                                     monitor.getArguments(),
+                                     monitor.getCheckList(),
+                                     monitor.getExtraInfo(),
+                                     monitor.getOutputFiles())
+        self.__monitors[monitor] = mid
+
+    def __addMonitorOutputFile(self, monitor, key, value):
+        debug("monitor:%r, %s:%s", monitor, key, value)
+        if not self.__monitors.has_key(monitor):
+            # the monitor isn't stored yet, it will be along with the
+            # output file
+            debug("monitor isn't stored yet")
+            return
+        mid = self.__monitors[monitor]
+        name = monitor.__monitor_name__
+        mapping = self.__getMonitorClassOutputFileMapping(name)
+        if mapping.get(key) in self.__getDict("monitor_outputfiles_dict", mid,
+                                              txtonly=True):
+            debug("output file was already stored")
+            return
+        self.__storeMonitorOutputFileDict(mid, {key : value}, name)
+        self._lock.acquire()
+        try:
+            self._commit()
+        finally:
+            self._lock.release()
 
     def __newTestFinished(self, testrun, test):
         debug("testrun:%r, test:%r", testrun, test)
@@ -1075,6 +1962,10 @@ class DBStorage(DataStorage, AsyncStorage):
                                                 self.__tests[test]))
             debug("done adding subtests")
 
+        # the monitor class infos are needed for the fingerprints
+        for monitor in test._monitorinstances:
+            self.__storeMonitorClassInfo(monitor)
+
         # store the dictionnaries
         self.__storeTestArgumentsDict(tid, test.getArguments(),
                                      test.__test_name__)
@@ -1085,10 +1976,26 @@ class DBStorage(DataStorage, AsyncStorage):
         self.__storeTestOutputFileDict(tid, test.getOutputFiles(),
                                       test.__test_name__)
 
-        # finally update the test
-        updatestr = "UPDATE test SET resultpercentage=? WHERE id=?"
+        # finally update the test, along with its checklist summary.
+        # This commits the dictionnaries stored above.
+        updatestr = """
+        UPDATE test SET resultpercentage=?, validatedmask=?, passedmask=?,
+        fingerprint=?, monitorsfingerprint=?,
+        returncode=?, duration=?, timedout=?, crashed=?
+        WHERE id=?"""
         resultpercentage = test.getSuccessPercentage()
-        self._ExecuteCommit(updatestr, (resultpercentage, tid))
+        validated, passed = self.__getCheckListBitmasks(test.__test_name__,
+                                                        test.getCheckList())
+        monitors = [(m.__monitor_name__, m.getArguments())
+                    for m in test._monitorinstances]
+        fingerprint, mfingerprint = self.__computeTestFingerprints(test.__test_name__,
+                                                                   test.getArguments(),
+                                                                   monitors)
+        outcome = compute_test_outcome(test.getCheckList(),
+                                       test.getExtraInfo())
+        self._ExecuteCommit(updatestr, (resultpercentage, validated, passed,
+                                        fingerprint, mfingerprint)
+                            + outcome + (tid, ))
 
         # and on to the monitors
         for monitor in test._monitorinstances:
@@ -1096,6 +2003,30 @@ class DBStorage(DataStorage, AsyncStorage):
         debug("done adding information for test %d", tid)
 
 
+    def __newTestCrash(self, testrun, test, signature, signum, frames):
+        debug("test:%r, signature:%s", test, signature)
+        if not self.__tests.has_key(test):
+            self.__newTestStarted(testrun, test)
+        self.__storeTestCrash(self.__tests[test], signature, signum, frames)
+
+    def __storeTestCrash(self, testid, signature, signum, frames):
+        # several writers might find the same new signature
+        self.__crashlock.acquire()
+        try:
+            res = self._FetchOne("SELECT id FROM crash_bucket WHERE signature=?",
+                                 (signature, ))
+            if res == None:
+                bucketid = self._ExecuteCommit("""
+                INSERT INTO crash_bucket (signature, signum, frames, creationtime)
+                VALUES (?, ?, ?, ?)""", (signature, signum, "\n".join(frames),
+                                         int(time.time())))
+            else:
+                bucketid = res[0]
+        finally:
+            self.__crashlock.release()
+        self._ExecuteCommit("INSERT INTO test_crash (testid, bucketid) VALUES (?, ?)",
+                            (testid, bucketid))
+
     def __getTestClassMapping(self, testtype, dictname):
         return self.__getClassMapping(self.__tcmapping,
                                       "testclassinfo",
@@ -1136,6 +2067,23 @@ class DBStorage(DataStorage, AsyncStorage):
         return mapping[classtype][dictname]
 
 
+    def __getCheckListOrdinals(self):
+        if self.__checkordinals == None:
+            classes = self._FetchAll("SELECT id, type, parent FROM testclassinfo")
+            checks = self._FetchAll("""
+            SELECT id, containerid, name FROM testclassinfo_checklist_dict""")
+            self.__checkordinals = compute_checklist_ordinals(classes, checks)
+        return self.__checkordinals
+
+    def __getCheckListBitmasks(self, testtype, checklist):
+        """
+        Returns the (validatedmask, passedmask) of the given checklist
+        (a list of (checkname, value)).
+        """
+        maps = self.__getTestClassCheckListMapping(testtype)
+        return compute_checklist_bitmasks(self.__getCheckListOrdinals(),
+                                          map_list(checklist, maps))
+
     def __getTestClassArgumentMapping(self, testtype):
         return self.__getTestClassMapping(testtype, "testclassinfo_arguments_dict")
     def __getTestClassCheckListMapping(self, testtype):
@@ -1170,26 +2118,20 @@ class DBStorage(DataStorage, AsyncStorage):
             debug("Empty list, returning")
             return
 
+        # consecutive rows using the same value column are inserted at once
+        groups = []
+        for key, value in pdict:
+            debug("Adding key:%s , value:%r", key, value)
+            valstr, val = self.__typedValue(value)
+            if not groups or groups[-1][0] != valstr:
+                groups.append((valstr, []))
+            groups[-1][1].append((containerid, key, val))
+
         self._lock.acquire()
         try:
-            cur = self.con.cursor()
-            insertstr = """INSERT INTO %s (containerid, name, %s)
-            VALUES (?, ?, ?)"""
-            for key, value in pdict:
-                debug("Adding key:%s , value:%r", key, value)
-                val = value
-                if isinstance(value, int):
-                    valstr = "intvalue"
-                elif isinstance(value, basestring):
-                    valstr = "txtvalue"
-                else:
-                    valstr = "blobvalue"
-                    val = str(dumps(value))
-                comstr = insertstr % (dicttable, valstr)
-                #debug("instruction:%s", comstr)
-                #debug("%s, %s, %s", containerid, key, val)
-                self._ExecuteCommit(comstr, (containerid, key, val),
-                                    commit=False, threadsafe=True)
+            for valstr, rows in groups:
+                self._InsertMany(dicttable, ("containerid", "name", valstr),
+                                 rows, commit=False, threadsafe=True)
         finally:
             self._lock.release()
 
@@ -1210,19 +2152,154 @@ class DBStorage(DataStorage, AsyncStorage):
             if intonly or txtonly:
                 val = row[3]
             elif blobonly:
-                val = loads(str(row[3]))
+                val = self._decodeValue(row[3])
             else:
                 # we need to figure it out
-                ival, tval, bval = row[3:]
-                if not ival == None:
-                    val = ival
-                elif not tval == None:
-                    val = str(tval)
-                else:
-                    val = loads(str(bval))
+                val = self.__rowValue(*row[3:])
             dc.append((row[2], val))
         return dc
 
+    def __typedValue(self, value):
+        """
+        Returns the value column to use for value, and the parameter to
+        store in it.
+        """
+        if isinstance(value, int):
+            return ("intvalue", value)
+        if isinstance(value, basestring):
+            return ("txtvalue", value)
+        return ("blobvalue", self._blobParameter(self._encodeValue(value)))
+
+    def __rowValue(self, ival, tval, bval):
+        """
+        Returns the value stored in a row with intvalue, txtvalue and
+        blobvalue columns
+        """
+        if not ival == None:
+            return ival
+        if not tval == None:
+            return str(tval)
+        return self._decodeValue(bval)
+
+    def __storeEnvironment(self, testrunid, env):
+        """
+        Stores the environment of a testrun: the testrun specific entries
+        (see TESTRUN_ENVIRONMENT_KEYS) in testrun_environment_dict and the
+        other ones as a (shared) environment snapshot.
+        """
+        own = {}
+        snapshot = {}
+        for name, value in env.iteritems():
+            if name in TESTRUN_ENVIRONMENT_KEYS:
+                own[name] = value
+            else:
+                snapshot[name] = value
+        if own:
+            self._storeEnvironmentDict(testrunid, own)
+        snapshotid = None
+        if snapshot:
+            snapshotid = self.__storeEnvironmentSnapshot(snapshot)
+        # this also commits everything stored above
+        self._ExecuteCommit("UPDATE testrun SET environmentid=? WHERE id=?",
+                            (snapshotid, testrunid))
+
+    def __storeEnvironmentSnapshot(self, env):
+        """
+        Returns the id of the snapshot of the given environment, storing it
+        (and the values which weren't stored yet) if needed.
+
+        Snapshots and values are identified by digests of their contents.
+        Concurrent writers might store the same value or snapshot twice,
+        which is harmless since the first one is always used.
+        """
+        values = {}
+        for name, value in env.iteritems():
+            values[compute_value_digest(name, value)] = (name, value)
+        digest = compute_snapshot_digest(values.keys())
+        res = self._FetchOne("""
+        SELECT MIN(id) FROM environment_snapshot WHERE hash=?""", (digest, ))
+        if res and res[0] != None:
+            debug("Environment snapshot %s already stored", digest)
+            return res[0]
+
+        valueids = self.__getEnvironmentValueIDs(values.keys())
+        missing = [x for x in values.keys() if not x in valueids]
+        if missing:
+            debug("Storing %d new environment values", len(missing))
+            groups = {}
+            for valuedigest in missing:
+                name, value = values[valuedigest]
+                valstr, val = self.__typedValue(value)
+                groups.setdefault(valstr, []).append((valuedigest, name, val))
+            for valstr, rows in groups.iteritems():
+                self._InsertMany("environment_value", ("hash", "name", valstr),
+                                 rows, commit=False)
+            valueids.update(self.__getEnvironmentValueIDs(missing))
+
+        snapshotid = self._ExecuteCommit("""
+        INSERT INTO environment_snapshot (hash) VALUES (?)""", (digest, ),
+                                         commit=False)
+        self._InsertMany("environment_snapshot_values", ("snapshotid", "valueid"),
+                         [(snapshotid, x) for x in valueids.itervalues()],
+                         commit=False)
+        return snapshotid
+
+    def __getEnvironmentValueIDs(self, digests, batchsize=500):
+        """
+        Returns a dictionnary of value digest : environment_value id for
+        the given digests which are stored.
+        """
+        res = {}
+        for i in range(0, len(digests), batchsize):
+            chunk = digests[i:i + batchsize]
+            res.update(dict(self._FetchAll("""
+            SELECT hash, MIN(id) FROM environment_value
+            WHERE hash IN (%s) GROUP BY hash""" % ",".join(["?"] * len(chunk)),
+                                           tuple(chunk))))
+        return res
+
+    def __getEnvironmentSnapshot(self, snapshotid, names=None):
+        """
+        Returns the environment dictionnary of the given snapshot (or only
+        the given names of it).
+        """
+        if snapshotid == None:
+            return {}
+        if names != None:
+            env = self.__snapshots.get(snapshotid)
+            if env != None:
+                return dict([(x, env[x]) for x in names if x in env])
+            res = self._FetchAll("""
+            SELECT v.name, v.intvalue, v.txtvalue, v.blobvalue
+            FROM environment_snapshot_values sv
+            INNER JOIN environment_value v ON v.id=sv.valueid
+            WHERE sv.snapshotid=? AND v.name IN (%s)""" % ",".join(["?"] * len(names)),
+                                 (snapshotid, ) + tuple(names))
+            return dict([(name, self.__rowValue(ival, tval, bval))
+                         for name, ival, tval, bval in res])
+        env = self.__snapshots.get(snapshotid)
+        if env == None:
+            res = self._FetchAll("""
+            SELECT v.name, v.intvalue, v.txtvalue, v.blobvalue
+            FROM environment_snapshot_values sv
+            INNER JOIN environment_value v ON v.id=sv.valueid
+            WHERE sv.snapshotid=?""", (snapshotid, ))
+            env = dict([(name, self.__rowValue(ival, tval, bval))
+                        for name, ival, tval, bval in res])
+            if len(self.__snapshots) >= ENVIRONMENT_CACHE_SIZE:
+                self.__snapshots = {}
+            self.__snapshots[snapshotid] = env
+        return env
+
+    def __storeDuplicates(self, testrunid, duplicates):
+        rows = []
+        for value, values in duplicates.iteritems():
+            rows.extend([(testrunid, value, x) for x in values])
+        if rows:
+            self._InsertMany("testrun_duplicate",
+                             ("testrunid", "value", "duplicate"),
+                             rows, commit=False)
+
     def __storeTestArgumentsDict(self, testid, dic, testtype):
         # transform the dictionnary from names to ids
         maps = self.__getTestClassArgumentMapping(testtype)
@@ -1311,6 +2388,8 @@ class DBStorage(DataStorage, AsyncStorage):
         # store the dicts
         self.__storeTestClassArgumentsDict(tcid, args)
         self.__storeTestClassCheckListDict(tcid, checklist)
+        # the checklist ordinals need to be re-computed
+        self.__checkordinals = None
         self.__storeTestClassExtraInfoDict(tcid, extrainfo)
         self.__storeTestClassOutputFileDict(tcid, outputfiles)
 
@@ -1352,14 +2431,18 @@ class DBStorage(DataStorage, AsyncStorage):
         from insanity.test import Test
         # check if we don't already have info for this class
         debug("test name: %s", testinstance.__test_name__)
-        if self.__hasTestClassInfo(testinstance.__test_name__):
-            return
-        # we need an inverted mro (so we can know the parent class)
-        for cl in testinstance.__class__.mro():
-            if not self.__insertTestClassInfo(cl):
-                break
-            if cl == Test:
-                break
+        self.__classlock.acquire()
+        try:
+            if self.__hasTestClassInfo(testinstance.__test_name__):
+                return
+            # we need an inverted mro (so we can know the parent class)
+            for cl in testinstance.__class__.mro():
+                if not self.__insertTestClassInfo(cl):
+                    break
+                if cl == Test:
+                    break
+        finally:
+            self.__classlock.release()
 
     def __hasMonitorClassInfo(self, monitortype):
         existstr = "SELECT * FROM monitorclassinfo WHERE type=?"
@@ -1406,16 +2489,48 @@ class DBStorage(DataStorage, AsyncStorage):
     def __storeMonitorClassInfo(self, monitorinstance):
         from insanity.monitor import Monitor
         # check if we don't already have info for this class
-        if self.__hasMonitorClassInfo(monitorinstance.__monitor_name__):
-            return
-        # we need an inverted mro (so we can now the parent class)
-        for cl in monitorinstance.__class__.mro():
-            if not self.__insertMonitorClassInfo(cl):
-                break
-            if cl == Monitor:
-                break
+        self.__classlock.acquire()
+        try:
+            if self.__hasMonitorClassInfo(monitorinstance.__monitor_name__):
+                return
+            # we need an inverted mro (so we can now the parent class)
+            for cl in monitorinstance.__class__.mro():
+                if not self.__insertMonitorClassInfo(cl):
+                    break
+                if cl == Monitor:
+                    break
+        finally:
+            self.__classlock.release()
+
+
+
+
+DB_SCHEME_VERSION = 8
+
+# environment entries specific to a testrun, which are stored in
+# testrun_environment_dict instead of the (shared) environment snapshots
+TESTRUN_ENVIRONMENT_KEYS = ["storage-stats", "arguments-expansions"]
 
+# number of environment snapshots kept in memory
+ENVIRONMENT_CACHE_SIZE = 16
 
+# tables whose containerid is a test.id
+TEST_CONTAINER_TABLES = ["test_arguments_dict",
+                         "test_checklist_list",
+                         "test_extrainfo_dict",
+                         "test_outputfiles_dict"]
 
+# tables whose containerid is a monitor.id
+MONITOR_CONTAINER_TABLES = ["monitor_arguments_dict",
+                            "monitor_checklist_dict",
+                            "monitor_extrainfo_dict",
+                            "monitor_outputfiles_dict"]
 
-DB_SCHEME_VERSION = 2
+# tables containing a blobvalue column
+BLOB_TABLES = ["testrun_environment_dict",
+               "environment_value",
+               "test_arguments_dict",
+               "test_extrainfo_dict",
+               "monitor_arguments_dict",
+               "monitor_extrainfo_dict",
+               "testclassinfo_arguments_dict"]
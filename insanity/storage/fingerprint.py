@@ -0,0 +1,91 @@
+# GStreamer QA system
+#
+#       storage/fingerprint.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Test fingerprints
+
+A fingerprint identifies a test by its type and arguments (and optionally
+the types and arguments of the monitors applied to it). Two tests with the
+same fingerprint are equivalent, whatever testrun or database they come
+from.
+
+Environment entries and snapshots are identified the same way, by digests
+of their contents.
+"""
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from insanity.storage.codec import CompactCodec
+
+# no compression, the encoding only needs to be deterministic
+_codec = CompactCodec(threshold=None)
+
+def normalize_value(value):
+    """
+    Returns value in the form it would have once read back from a
+    DBStorage (unicode strings as UTF-8 strings, booleans as integers).
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, tuple):
+        return tuple([normalize_value(x) for x in value])
+    if isinstance(value, list):
+        return [normalize_value(x) for x in value]
+    if isinstance(value, dict):
+        return dict([(normalize_value(k), normalize_value(v))
+                     for k, v in value.iteritems()])
+    return value
+
+def compute_fingerprint(testtype, arguments, monitors=None):
+    """
+    Returns the fingerprint (a 40 characters hexadecimal string) of a test.
+
+    testtype is the name of the test class
+    arguments is the dictionnary of argument name : value
+    monitors, if not None, is a list of (monitortype, arguments)
+    """
+    data = [normalize_value(testtype), normalize_value(arguments)]
+    if monitors != None:
+        mons = [_codec.encode(normalize_value((mtype, margs)))
+                for mtype, margs in monitors]
+        mons.sort()
+        data.append(mons)
+    return sha1(_codec.encode(data)).hexdigest()
+
+def compute_value_digest(name, value):
+    """
+    Returns the digest (a 40 characters hexadecimal string) of an
+    environment entry.
+    """
+    return sha1(_codec.encode(normalize_value((name, value)))).hexdigest()
+
+def compute_snapshot_digest(digests):
+    """
+    Returns the digest of an environment snapshot, given the digests of
+    its entries (in any order).
+    """
+    digests = list(digests)
+    digests.sort()
+    return sha1("".join(digests)).hexdigest()
@@ -0,0 +1,702 @@
+# GStreamer QA system
+#
+#       storage/journal.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Append-only journal storage
+
+JournalStorage records testruns in a directory of journal segments, without
+any database, to make storing results as cheap as possible during runs.
+The journal can be imported afterwards into a DBStorage with
+DBStorage.merge() and a JournalReader (see insanity-dbmerge --journal).
+
+Segments are named <number>.journal and start with JOURNAL_MAGIC. Each
+record is made of:
+* the length of the payload (4 bytes, big endian)
+* the CRC32 of the payload (4 bytes, big endian)
+* the payload, a tuple encoded with a ValueCodec whose first item is the
+  record type.
+
+Records are written by a single thread and flushed straight away, segments
+are fsync'ed at most 'syncinterval' seconds after a write. Reading stops at
+the first incomplete or corrupted record, so a journal interrupted by a
+crash can still be read up to the last complete record.
+"""
+
+import os
+import time
+import struct
+import threading
+import zlib
+from weakref import WeakKeyDictionary
+from insanity.log import error, warning, debug
+from insanity.storage.storage import FileStorage
+from insanity.storage.async import AsyncStorage, queuemethod
+from insanity.storage.codec import CompactCodec
+from insanity.storage.fingerprint import compute_fingerprint
+from insanity.storage.stats import StorageStats, TimedLock, COMMIT
+
+JOURNAL_MAGIC = "INSANITY-JOURNAL\x01"
+JOURNAL_SUFFIX = ".journal"
+
+# segments are rotated once they get bigger than this
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+_header = struct.Struct(">II")
+
+# record types
+REC_CLIENT = "client"
+REC_TESTCLASS = "testclass"
+REC_MONITORCLASS = "monitorclass"
+REC_TESTRUN_START = "testrun-start"
+REC_TESTRUN_END = "testrun-end"
+REC_TEST_START = "test-start"
+REC_TEST_FINISH = "test-finish"
+REC_MONITOR_OUTPUTFILE = "monitor-outputfile"
+REC_TEST_CRASH = "test-crash"
+
+def list_segments(path):
+    """
+    Returns the sorted list of (number, filename) of the journal segments
+    in the given directory.
+    """
+    res = []
+    if not os.path.isdir(path):
+        return res
+    for name in os.listdir(path):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        try:
+            number = int(name[:-len(JOURNAL_SUFFIX)])
+        except ValueError:
+            continue
+        res.append((number, os.path.join(path, name)))
+    res.sort()
+    return res
+
+def read_segment(filename, codec):
+    """
+    Yields the records of the given segment.
+
+    Stops at the first incomplete or corrupted record.
+    """
+    f = open(filename, "rb")
+    try:
+        if f.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            warning("%s is not a journal segment", filename)
+            return
+        while True:
+            header = f.read(_header.size)
+            if not header:
+                return
+            if len(header) < _header.size:
+                warning("%s : truncated record header", filename)
+                return
+            length, crc = _header.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                warning("%s : truncated record", filename)
+                return
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                warning("%s : corrupted record", filename)
+                return
+            yield codec.decode(payload)
+    finally:
+        f.close()
+
+class JournalStorage(FileStorage, AsyncStorage):
+    """
+    Stores data in append-only journal segments in the 'path' directory.
+
+    This storage can only be written to, use a JournalReader to access the
+    stored information.
+
+    If the directory already contains a journal, new records are appended
+    to it (in new segments).
+    """
+
+    def __init__(self, path, async=True, segmentsize=DEFAULT_SEGMENT_SIZE,
+                 syncinterval=1.0, codec=None, *args, **kwargs):
+        # public
+        self.segmentsize = segmentsize
+        self.syncinterval = syncinterval
+        # ValueCodec used for the records
+        self.codec = codec or CompactCodec()
+
+        # protected
+        # metrics (see AsyncStorage.getStorageStats())
+        self._stats = StorageStats()
+        # threading lock, protecting the current segment
+        self._lock = TimedLock(threading.Lock(), self._stats)
+
+        # private
+        self.__file = None
+        self.__segment = 0
+        self.__synctimer = None
+        # key: testrun, value: testrunid
+        self.__testruns = WeakKeyDictionary()
+        self.__tests = WeakKeyDictionary()
+        # key: monitor, value: (testid, position of the monitor in the test)
+        self.__monitors = WeakKeyDictionary()
+        self.__clients = WeakKeyDictionary()
+        # key: (software, name, user), value: clientid
+        self.__clientids = {}
+        self.__testclasses = set()
+        self.__monitorclasses = set()
+        self.__lastclientid = 0
+        self.__lasttestrunid = 0
+        self.__lasttestid = 0
+
+        FileStorage.__init__(self, path, *args, **kwargs)
+        AsyncStorage.__init__(self, async)
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self), self.path)
+
+    def _setUp(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # identifiers need to stay unique amongst all the records of
+        # the journal
+        existing = JournalReader(self.path, codec=self.codec)
+        for clientid, info in existing._clients.iteritems():
+            self.__clientids[info] = clientid
+        self.__lastclientid = max([0] + existing._clients.keys())
+        self.__lasttestrunid = max([0] + existing._testruns.keys())
+        self.__lasttestid = max([0] + existing._tests.keys())
+        self.__testclasses.update(existing._testclasses.keys())
+        self.__monitorclasses.update(existing._monitorclasses.keys())
+        segments = list_segments(self.path)
+        if segments:
+            self.__segment = segments[-1][0] + 1
+
+    def close(self, callback=None, *args, **kwargs):
+        """
+        Close the journal, the callback will be called once all pending
+        records have been written.
+        """
+        if self.async:
+            self.queueFinalAction(self.__close, callback, *args, **kwargs)
+        else:
+            self.__close(callback, *args, **kwargs)
+
+    def setClientInfo(self, softwarename, clientname, user):
+        debug("softwarename:%s, clientname:%s, user:%s",
+              softwarename, clientname, user)
+        key = (softwarename, clientname, user)
+        if key in self.__clientids:
+            return self.__clientids[key]
+        self.__lastclientid += 1
+        self.__clientids[key] = self.__lastclientid
+        if self.async:
+            self.queueAction(self.__writeRecord, REC_CLIENT,
+                             self.__lastclientid, softwarename, clientname,
+                             user)
+        else:
+            self.__writeRecord(REC_CLIENT, self.__lastclientid, softwarename,
+                               clientname, user)
+        return self.__lastclientid
+
+    @queuemethod
+    def startNewTestRun(self, testrun, clientid):
+        self.__startNewTestRun(testrun, clientid)
+
+    @queuemethod
+    def endTestRun(self, testrun):
+        self.__endTestRun(testrun)
+
+    @queuemethod
+    def newTestStarted(self, testrun, test, commit=True):
+        self.__newTestStarted(testrun, test)
+
+    @queuemethod
+    def newTestFinished(self, testrun, test):
+        self.__newTestFinished(testrun, test)
+
+    @queuemethod
+    def addMonitorOutputFile(self, testrun, test, monitor, key, value):
+        self.__addMonitorOutputFile(monitor, key, value)
+
+    @queuemethod
+    def newTestCrash(self, testrun, test, signature, signum, frames):
+        self.__newTestCrash(testrun, test, signature, signum, frames)
+
+    # private methods
+
+    def __writeRecord(self, *record):
+        payload = self.codec.encode(record)
+        data = _header.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+        self._lock.acquire()
+        try:
+            if self.__file == None:
+                self.__openSegment()
+            self.__file.write(data + payload)
+            self._stats.addRows(record[0], 1)
+            # make the record visible, even if the process crashes
+            self.__file.flush()
+            if self.__file.tell() >= self.segmentsize:
+                self.__closeSegment()
+            elif self.__synctimer == None:
+                self.__synctimer = threading.Timer(self.syncinterval,
+                                                   self.__syncTimeout)
+                self.__synctimer.setDaemon(True)
+                self.__synctimer.start()
+        finally:
+            self._lock.release()
+
+    def __openSegment(self):
+        filename = os.path.join(self.path, "%08d%s" % (self.__segment,
+                                                      JOURNAL_SUFFIX))
+        debug("opening segment %s", filename)
+        self.__segment += 1
+        self.__file = open(filename, "wb")
+        self.__file.write(JOURNAL_MAGIC)
+
+    def __closeSegment(self):
+        # lock must be taken
+        if self.__file == None:
+            return
+        self.__file.flush()
+        self.__fsync()
+        self.__file.close()
+        self.__file = None
+
+    def __sync(self):
+        self._lock.acquire()
+        try:
+            if self.__file != None:
+                self.__file.flush()
+                self.__fsync()
+        finally:
+            self._lock.release()
+
+    def __fsync(self):
+        # lock must be taken
+        start = time.time()
+        os.fsync(self.__file.fileno())
+        self._stats.addTiming(COMMIT, "fsync", time.time() - start)
+
+    def __syncTimeout(self):
+        self._lock.acquire()
+        self.__synctimer = None
+        self._lock.release()
+        try:
+            self.__sync()
+        except:
+            error("Couldn't sync journal %s", self.path)
+
+    def __close(self, callback, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            if self.__synctimer != None:
+                self.__synctimer.cancel()
+                self.__synctimer = None
+            self.__closeSegment()
+        finally:
+            self._lock.release()
+        if callable(callback):
+            callback(*args, **kwargs)
+
+    def __startNewTestRun(self, testrun, clientid):
+        debug("testrun:%r", testrun)
+        if testrun in self.__testruns.keys():
+            warning("Testrun already started !")
+            return
+        if clientid:
+            self.__clients[testrun] = clientid
+        else:
+            clientid = self.__clients.get(testrun, 0)
+        self.__lasttestrunid += 1
+        testrunid = self.__lasttestrunid
+        self.__writeRecord(REC_TESTRUN_START, testrunid, clientid,
+                           testrun._starttime, testrun.getEnvironment())
+        self.__testruns[testrun] = testrunid
+        return testrunid
+
+    def __endTestRun(self, testrun):
+        debug("testrun:%r", testrun)
+        if not testrun in self.__testruns.keys():
+            self.__startNewTestRun(testrun, None)
+        self.__writeRecord(REC_TESTRUN_END, self.__testruns[testrun],
+                           testrun._stoptime, testrun.getDuplicates())
+        self.__sync()
+
+    def __newTestStarted(self, testrun, test):
+        from insanity.test import Test
+        if not isinstance(test, Test):
+            raise TypeError("test isn't a Test instance !")
+        if not testrun in self.__testruns.keys():
+            self.__startNewTestRun(testrun, None)
+        debug("test:%r", test)
+        self.__storeTestClassInfo(test)
+        self.__lasttestid += 1
+        self.__writeRecord(REC_TEST_START, self.__lasttestid,
+                           self.__testruns[testrun], test.__test_name__)
+        self.__tests[test] = self.__lasttestid
+
+    def __newTestFinished(self, testrun, test):
+        debug("testrun:%r, test:%r", testrun, test)
+        if not testrun in self.__testruns.keys():
+            self.__startNewTestRun(testrun, None)
+        if not self.__tests.has_key(test):
+            self.__newTestStarted(testrun, test)
+        tid = self.__tests[test]
+
+        from insanity.scenario import Scenario
+        subtests = []
+        if isinstance(test, Scenario):
+            for sub in test.tests:
+                self.__newTestFinished(testrun, sub)
+                subtests.append(self.__tests[sub])
+
+        monitors = []
+        for monitor in test._monitorinstances:
+            self.__storeMonitorClassInfo(monitor)
+            self.__monitors[monitor] = (tid, len(monitors))
+            monitors.append((monitor.__monitor_name__,
+                             monitor.getSuccessPercentage(),
+                             monitor.getArguments(),
+                             monitor.getCheckList(),
+                             monitor.getExtraInfo(),
+                             monitor.getOutputFiles()))
+        self.__writeRecord(REC_TEST_FINISH, tid, test.getSuccessPercentage(),
+                           test.getArguments(), test.getCheckList(),
+                           test.getExtraInfo(), test.getOutputFiles(),
+                           subtests, monitors)
+
+    def __addMonitorOutputFile(self, monitor, key, value):
+        if not self.__monitors.has_key(monitor):
+            # it will be written along with the monitor
+            return
+        tid, position = self.__monitors[monitor]
+        self.__writeRecord(REC_MONITOR_OUTPUTFILE, tid, position, key, value)
+
+    def __newTestCrash(self, testrun, test, signature, signum, frames):
+        if not self.__tests.has_key(test):
+            self.__newTestStarted(testrun, test)
+        self.__writeRecord(REC_TEST_CRASH, self.__tests[test], signature,
+                           signum, list(frames))
+
+    def __storeTestClassInfo(self, testinstance):
+        from insanity.test import Test
+        for cl in testinstance.__class__.mro():
+            ctype = cl.__dict__.get("__test_name__").strip()
+            if ctype in self.__testclasses:
+                break
+            fdesc = cl.__dict__.get("__test_full_description__")
+            if fdesc:
+                fdesc = fdesc.strip()
+            if cl == Test:
+                parent = None
+            else:
+                parent = cl.__base__.__dict__.get("__test_name__").strip()
+            self.__writeRecord(REC_TESTCLASS, ctype, parent,
+                               cl.__dict__.get("__test_description__").strip(),
+                               fdesc,
+                               cl.__dict__.get("__test_arguments__"),
+                               cl.__dict__.get("__test_checklist__"),
+                               cl.__dict__.get("__test_extra_infos__"),
+                               cl.__dict__.get("__test_output_files__"))
+            self.__testclasses.add(ctype)
+            if cl == Test:
+                break
+
+    def __storeMonitorClassInfo(self, monitorinstance):
+        from insanity.monitor import Monitor
+        for cl in monitorinstance.__class__.mro():
+            ctype = cl.__dict__.get("__monitor_name__").strip()
+            if ctype in self.__monitorclasses:
+                break
+            if cl == Monitor:
+                parent = None
+            else:
+                parent = cl.__base__.__dict__.get("__monitor_name__").strip()
+            self.__writeRecord(REC_MONITORCLASS, ctype, parent,
+                               cl.__dict__.get("__monitor_description__").strip(),
+                               cl.__dict__.get("__monitor_arguments__"),
+                               cl.__dict__.get("__monitor_checklist__"),
+                               cl.__dict__.get("__monitor_extra_infos__"),
+                               cl.__dict__.get("__monitor_output_files__"))
+            self.__monitorclasses.add(ctype)
+            if cl == Monitor:
+                break
+
+class JournalReader(FileStorage):
+    """
+    Read-only access to the contents of a journal written by a
+    JournalStorage.
+
+    The whole journal is loaded when the reader is created. It implements
+    the retrieval API used by DBStorage.merge(), test and class types are
+    always returned as names.
+    """
+
+    def __init__(self, path, codec=None, *args, **kwargs):
+        self.codec = codec or CompactCodec()
+        FileStorage.__init__(self, path, *args, **kwargs)
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self), self.path)
+
+    def _setUp(self):
+        # clientid : (software, name, user)
+        self._clients = {}
+        # testrunid : [clientid, starttime, stoptime, environment,
+        #              duplicates]
+        self._testruns = {}
+        # testid : [testrunid, type, resultpercentage, arguments, checklist,
+        #           extrainfo, outputfiles, subtests, monitorids]
+        self._tests = {}
+        # monitorid : (testid, type, resultpercentage, arguments, checklist,
+        #              extrainfo, outputfiles)
+        self._monitors = {}
+        # bucketid : (signature, signum, frames)
+        self._crashbuckets = {}
+        # signature : bucketid
+        self._crashsignatures = {}
+        # testid : bucketid
+        self._testcrashes = {}
+        # type : (parent, description, fulldescription, arguments,
+        #         checklist, extrainfo, outputfiles)
+        self._testclasses = {}
+        # type : (parent, description, arguments, checklist, extrainfo,
+        #         outputfiles)
+        self._monitorclasses = {}
+        for number, filename in list_segments(self.path):
+            debug("reading segment %s", filename)
+            for record in read_segment(filename, self.codec):
+                try:
+                    self.__replay(record)
+                except:
+                    warning("Invalid record in %s : %r", filename, record[:2])
+
+    def __replay(self, record):
+        rtype = record[0]
+        if rtype == REC_CLIENT:
+            self._clients[record[1]] = tuple(record[2:5])
+        elif rtype == REC_TESTCLASS:
+            self._testclasses[record[1]] = tuple(record[2:])
+        elif rtype == REC_MONITORCLASS:
+            self._monitorclasses[record[1]] = tuple(record[2:])
+        elif rtype == REC_TESTRUN_START:
+            testrunid, clientid, starttime, env = record[1:]
+            self._testruns[testrunid] = [clientid, starttime, None, env, {}]
+        elif rtype == REC_TESTRUN_END:
+            self._testruns[record[1]][2] = record[2]
+            # older journals don't have the duplicates
+            if len(record) > 3:
+                self._testruns[record[1]][4] = record[3]
+        elif rtype == REC_TEST_START:
+            testid, testrunid, ttype = record[1:]
+            if not testrunid in self._testruns:
+                warning("test %d belongs to an unknown testrun", testid)
+                return
+            self._tests[testid] = [testrunid, ttype, None, {}, [], {}, {},
+                                   [], []]
+        elif rtype == REC_TEST_FINISH:
+            testid = record[1]
+            if not testid in self._tests:
+                warning("test %d was never started", testid)
+                return
+            test = self._tests[testid]
+            test[2:8] = record[2:8]
+            for mtype, mperc, margs, mchecks, mextras, mouts in record[8]:
+                mid = len(self._monitors) + 1
+                self._monitors[mid] = (testid, mtype, mperc, margs, mchecks,
+                                       mextras, mouts)
+                test[8].append(mid)
+        elif rtype == REC_MONITOR_OUTPUTFILE:
+            testid, position, key, value = record[1:]
+            mid = self._tests[testid][8][position]
+            monitor = self._monitors[mid]
+            outputfiles = dict(monitor[6] or {})
+            outputfiles[key] = value
+            self._monitors[mid] = monitor[:6] + (outputfiles, )
+        elif rtype == REC_TEST_CRASH:
+            testid, signature, signum, frames = record[1:]
+            if not signature in self._crashsignatures:
+                bucketid = len(self._crashbuckets) + 1
+                self._crashbuckets[bucketid] = (signature, signum, frames)
+                self._crashsignatures[signature] = bucketid
+            self._testcrashes[testid] = self._crashsignatures[signature]
+        else:
+            warning("Unknown record type %r", rtype)
+
+    # DataStorage retrieval API
+
+    def close(self, callback=None, *args, **kwargs):
+        if callable(callback):
+            callback(*args, **kwargs)
+
+    def listTestRuns(self):
+        return sorted(self._testruns.keys())
+
+    def getTestRun(self, testrunid):
+        if not testrunid in self._testruns:
+            return (None, None, None)
+        return tuple(self._testruns[testrunid][:3])
+
+    def getTestsForTestRun(self, testrunid, withscenarios=True, failedonly=False):
+        res = []
+        for testid in sorted(self._tests.keys()):
+            test = self._tests[testid]
+            if test[0] != testrunid:
+                continue
+            if failedonly and test[2] == 100.0:
+                continue
+            if withscenarios == False and test[7]:
+                continue
+            res.append(testid)
+        return res
+
+    def getScenariosForTestRun(self, testrunid):
+        res = {}
+        for testid, test in self._tests.iteritems():
+            if test[0] == testrunid and test[7]:
+                res[testid] = list(test[7])
+        return res
+
+    def getClientInfoForTestRun(self, testrunid):
+        clientid = self._testruns[testrunid][0]
+        return self._clients.get(clientid, (None, None, None))
+
+    def getEnvironmentForTestRun(self, testrunid):
+        return self._testruns[testrunid][3] or {}
+
+    def getDuplicatesForTestRun(self, testrunid):
+        return self._testruns[testrunid][4]
+
+    def getCrashBucketsForTestRun(self, testrunid):
+        res = {}
+        for testid in self.getTestsForTestRun(testrunid):
+            if testid in self._testcrashes:
+                res.setdefault(self._testcrashes[testid], []).append(testid)
+        return res
+
+    def getCrashBucketInfo(self, bucketid):
+        return self._crashbuckets.get(bucketid)
+
+    def getCrashBucketForTest(self, testid):
+        return self._testcrashes.get(testid)
+
+    def getCrashBucketSize(self, signature):
+        bucketid = self._crashsignatures.get(signature)
+        return len([x for x in self._testcrashes.itervalues() if x == bucketid])
+
+    def getFailedTestsForTestRun(self, testrunid):
+        return [x for x in self.getTestsForTestRun(testrunid)
+                if self._tests[x][2] != 100.0]
+
+    def getSucceededTestsForTestRun(self, testrunid):
+        return [x for x in self.getTestsForTestRun(testrunid)
+                if self._tests[x][2] == 100.0]
+
+    def getTestTypeUsed(self, testrunid):
+        res = set([test[1] for test in self._tests.itervalues()
+                   if test[0] == testrunid])
+        return list(res)
+
+    def getMonitorTypesUsed(self, testrunid):
+        res = set([self._monitors[mid][1]
+                   for test in self._tests.itervalues()
+                   if test[0] == testrunid
+                   for mid in test[8]])
+        return list(res)
+
+    def getTestInfo(self, testid, rawinfo=False):
+        if not testid in self._tests:
+            return (None, None, None)
+        return tuple(self._tests[testid][:3])
+
+    def getFullTestInfo(self, testid, rawinfo=False, onlyargs=False):
+        if not testid in self._tests:
+            return (None, None, None, None, None, None, None)
+        trid, ttype, resperc, args, checks, extras, ofs = self._tests[testid][:7]
+        if onlyargs:
+            checks, extras, ofs = [], [], {}
+        return (trid, ttype, args, checks, resperc, extras, ofs)
+
+    def getTestClassInfoFull(self, testtype, withparents=True):
+        if not testtype in self._testclasses:
+            return (None, None, None, None, None, None, None)
+        parent, desc, fdesc, args, checks, extras, ofs = self._testclasses[testtype]
+        args, checks = dict(args or {}), dict(checks or {})
+        extras, ofs = dict(extras or {}), dict(ofs or {})
+        if withparents:
+            rp = parent
+            while rp in self._testclasses:
+                pinfo = self._testclasses[rp]
+                args.update(pinfo[3] or {})
+                checks.update(pinfo[4] or {})
+                extras.update(pinfo[5] or {})
+                ofs.update(pinfo[6] or {})
+                rp = pinfo[0]
+        return (desc, fdesc, args, checks, extras, ofs, parent)
+
+    def getTestClassInfo(self, testtype, withparents=True):
+        return self.getTestClassInfoFull(testtype, withparents)[:6]
+
+    def getMonitorClassInfoFull(self, monitortype, withparents=True):
+        if not monitortype in self._monitorclasses:
+            return (None, None, None, None, None, None)
+        parent, desc, args, checks, extras, ofs = self._monitorclasses[monitortype]
+        args, checks = dict(args or {}), dict(checks or {})
+        extras, ofs = dict(extras or {}), dict(ofs or {})
+        if withparents:
+            rp = parent
+            while rp in self._monitorclasses:
+                pinfo = self._monitorclasses[rp]
+                args.update(pinfo[2] or {})
+                checks.update(pinfo[3] or {})
+                extras.update(pinfo[4] or {})
+                ofs.update(pinfo[5] or {})
+                rp = pinfo[0]
+        return (desc, args, checks, extras, ofs, parent)
+
+    def getMonitorsIDForTest(self, testid):
+        return list(self._tests[testid][8])
+
+    def getMonitorInfo(self, monitorid, rawinfo=False):
+        return self._monitors[monitorid][:3]
+
+    def getFullMonitorInfo(self, monitorid, rawinfo=False):
+        tid, mtype, mperc, margs, mchecks, mextras, mouts = self._monitors[monitorid]
+        return (tid, mtype, margs, mchecks, mperc, mextras, mouts)
+
+    def getFullMonitorsInfoForTest(self, testid, rawinfo=False, onlyargs=False):
+        res = []
+        for mid in self.getMonitorsIDForTest(testid):
+            tid, mtype, mperc, margs, mchecks, mextras, mouts = self._monitors[mid]
+            res.append((mid, mtype, mperc, margs, mchecks, mextras, mouts))
+        return res
+
+    def findEquivalentTests(self, testid, testrunid=None, withmonitors=True):
+        def fingerprint(tid):
+            ttype, args = self._tests[tid][1], self._tests[tid][3]
+            if not withmonitors:
+                return compute_fingerprint(ttype, args)
+            return compute_fingerprint(ttype, args,
+                                       [(m[1], m[3]) for m in
+                                        self.getFullMonitorsInfoForTest(tid)])
+        ref = fingerprint(testid)
+        return [tid for tid in sorted(self._tests.keys())
+                if tid != testid
+                and (testrunid == None or self._tests[tid][0] == testrunid)
+                and fingerprint(tid) == ref]
@@ -26,15 +26,28 @@ Requires the mysql-python module
 http://mysql-python.sourceforge.net/
 """
 
+import threading
 from insanity.log import error, warning, debug
 from insanity.storage.dbstorage import DBStorage
+from insanity.storage.stats import TimedLock
 import MySQLdb
 
 class MySQLStorage(DBStorage):
     """
     MySQL based DBStorage
+
+    Every thread uses its own connection, so that readers and the writer
+    threads (see the 'writers' argument of DBStorage) don't wait for each
+    other.
     """
 
+    _concurrentWrites = True
+
+    # maximum number of rows inserted by a single statement
+    _insertBatchSize = 500
+    # maximum number of translated statements kept around
+    _statementCacheSize = 1024
+
     _default_host = "localhost"
     _default_user = "insanity"
     _default_pass = "madness"
@@ -93,6 +106,13 @@ class MySQLStorage(DBStorage):
         self.__username = username
         self.__passwd = passwd
         self.__dbname = dbname
+        # per-thread connection and lock
+        self.__local = threading.local()
+        # all opened connections
+        self.__connections = []
+        self.__connectionslock = threading.Lock()
+        # translated statements
+        self.__statements = {}
         DBStorage.__init__(self, *args, **kwargs)
 
     def __repr__(self):
@@ -109,6 +129,70 @@ class MySQLStorage(DBStorage):
                               db=self.__dbname)
         return con
 
+    def __getConnection(self):
+        con = getattr(self.__local, "con", None)
+        if con == None:
+            debug("opening new connection for %r", threading.currentThread())
+            con = self._openDatabase()
+            self.__setConnection(con)
+        return con
+
+    def __setConnection(self, con):
+        self.__local.con = con
+        if con == None:
+            return
+        self.__connectionslock.acquire()
+        try:
+            self.__connections.append(con)
+        finally:
+            self.__connectionslock.release()
+
+    con = property(__getConnection, __setConnection,
+                   doc="The db-api Connection of the current thread")
+
+    def __getLock(self):
+        lock = getattr(self.__local, "lock", None)
+        if lock == None:
+            lock = self.__local.lock = TimedLock(threading.Lock(), self._stats)
+        return lock
+
+    def __setLock(self, lock):
+        # connections aren't shared, one lock per thread is enough
+        pass
+
+    _lock = property(__getLock, __setLock)
+
+    def __translate(self, instruction, args):
+        """
+        Returns the given instruction using the MySQLdb paramstyle.
+        """
+        # MySQLdb only does the string formatting if there are arguments
+        hasargs = len(args) > 0 and args[0] != None
+        key = (instruction, hasargs)
+        res = self.__statements.get(key)
+        if res == None:
+            res = instruction
+            if hasargs:
+                res = res.replace('%', '%%')
+            res = res.replace('?', '%s')
+            if len(self.__statements) >= self._statementCacheSize:
+                self.__statements.clear()
+            self.__statements[key] = res
+        return res
+
+    def _shutDown(self):
+        self.__connectionslock.acquire()
+        try:
+            debug("Closing %d database connections", len(self.__connections))
+            for con in self.__connections:
+                try:
+                    con.close()
+                except MySQLdb.Error:
+                    warning("Couldn't close connection %r", con)
+            self.__connections = []
+        finally:
+            self.__connectionslock.release()
+
     def _getDatabaseSchemeVersion(self):
         """
         Returns the scheme version of the currently loaded databse
@@ -149,11 +233,11 @@ class MySQLStorage(DBStorage):
 
         Threadsafe
         """
-        instruction = instruction.replace('?', '%s')
+        instruction = self.__translate(instruction, args)
         return DBStorage._ExecuteCommit(self, instruction, *args, **kwargs)
 
     def _ExecuteMany(self, instruction, *args, **kwargs):
-        instruction = instruction.replace('?', '%s')
+        instruction = self.__translate(instruction, args)
         return DBStorage._ExecuteMany(self, instruction, *args, **kwargs)
 
     def _FetchAll(self, instruction, *args, **kwargs):
@@ -163,7 +247,7 @@ class MySQLStorage(DBStorage):
 
         Threadsafe
         """
-        instruction = instruction.replace('?', '%s')
+        instruction = self.__translate(instruction, args)
         return DBStorage._FetchAll(self, instruction, *args, **kwargs)
 
     def _FetchOne(self, instruction, *args, **kwargs):
@@ -173,12 +257,49 @@ class MySQLStorage(DBStorage):
 
         Threadsafe
         """
-        instruction = instruction.replace('?', '%s')
+        instruction = self.__translate(instruction, args)
         return DBStorage._FetchOne(self, instruction, *args, **kwargs)
 
+    def _InsertMany(self, table, columns, rows, commit=True, threadsafe=False):
+        """
+        Inserts the rows with multi-row INSERT statements
+        """
+        if not threadsafe:
+            self._lock.acquire()
+        try:
+            for i in range(0, len(rows), self._insertBatchSize):
+                chunk = rows[i:i + self._insertBatchSize]
+                key = (table, tuple(columns), len(chunk))
+                insertstr = self.__statements.get(key)
+                if insertstr == None:
+                    values = "(%s)" % ", ".join(["%s"] * len(columns))
+                    insertstr = "INSERT INTO %s (%s) VALUES %s" % (table,
+                                                                   ", ".join(columns),
+                                                                   ", ".join([values] * len(chunk)))
+                    self.__statements[key] = insertstr
+                args = []
+                for row in chunk:
+                    args.extend(row)
+                DBStorage._ExecuteCommit(self, insertstr, args, commit=False,
+                                         threadsafe=True)
+            if commit:
+                self._commit()
+        finally:
+            if not threadsafe:
+                self._lock.release()
+
     def _getDBScheme(self):
         return DB_SCHEME
 
+    def _getEnvironmentSnapshotScheme(self):
+        return ENVIRONMENT_SNAPSHOT_SCHEME
+
+    def _getDuplicateScheme(self):
+        return DUPLICATE_SCHEME
+
+    def _getCrashBucketScheme(self):
+        return CRASH_BUCKET_SCHEME
+
 
 DB_SCHEME = """
 CREATE TABLE version (
@@ -190,7 +311,8 @@ CREATE TABLE testrun (
    id integer NOT NULL AUTO_INCREMENT PRIMARY KEY,
    clientid INTEGER,
    starttime INTEGER,
-   stoptime INTEGER
+   stoptime INTEGER,
+   environmentid INTEGER
 );
 
 CREATE TABLE client (
@@ -204,7 +326,15 @@ CREATE TABLE test (
    id integer NOT NULL AUTO_INCREMENT PRIMARY KEY,
    testrunid INTEGER,
    type INTEGER,
-   resultpercentage FLOAT
+   resultpercentage FLOAT,
+   validatedmask BIGINT,
+   passedmask BIGINT,
+   fingerprint VARCHAR(40),
+   monitorsfingerprint VARCHAR(40),
+   returncode INTEGER,
+   duration FLOAT,
+   timedout INTEGER,
+   crashed INTEGER
 );
 
 CREATE TABLE subtests (
@@ -369,6 +499,7 @@ CREATE INDEX monitor_testid_idx ON monitor(testid);
 CREATE INDEX testclassinfo_parent_idx ON testclassinfo (parent);
 CREATE INDEX monitorclassinfo_parent_idx ON monitorclassinfo (parent);
 CREATE INDEX testrun_env_dict_container_idx ON testrun_environment_dict (containerid);
+CREATE INDEX testrun_environmentid_idx ON testrun (environmentid);
 
 CREATE INDEX t_a_dict_containerid_idx ON test_arguments_dict (containerid, name);
 CREATE INDEX t_c_list_containerid_idx ON test_checklist_list (containerid, name);
@@ -391,4 +522,79 @@ CREATE INDEX mc_ei_dict_c_idx ON monitorclassinfo_extrainfo_dict (containerid);
 CREATE INDEX mc_of_dict_c_idx ON monitorclassinfo_outputfiles_dict (containerid);
 
 CREATE INDEX test_type_idx ON test (type);
+CREATE INDEX test_fingerprint_idx ON test (fingerprint, testrunid);
+CREATE INDEX test_monitorsfingerprint_idx ON test (monitorsfingerprint, testrunid);
+CREATE INDEX test_returncode_idx ON test (returncode, testrunid);
+CREATE INDEX test_duration_idx ON test (testrunid, duration);
+CREATE INDEX test_timedout_idx ON test (timedout, testrunid);
+CREATE INDEX test_crashed_idx ON test (crashed, testrunid);
 """
+
+# environments shared by testruns, each value and snapshot is only stored
+# once (identified by the digest of its contents)
+ENVIRONMENT_SNAPSHOT_SCHEME = """
+CREATE TABLE environment_value (
+   id integer NOT NULL AUTO_INCREMENT PRIMARY KEY,
+   hash VARCHAR(40),
+   name TEXT,
+   intvalue INTEGER,
+   txtvalue TEXT,
+   blobvalue BLOB
+);
+
+CREATE TABLE environment_snapshot (
+   id integer NOT NULL AUTO_INCREMENT PRIMARY KEY,
+   hash VARCHAR(40)
+);
+
+CREATE TABLE environment_snapshot_values (
+   snapshotid INTEGER,
+   valueid INTEGER
+);
+
+CREATE INDEX env_value_hash_idx ON environment_value (hash);
+CREATE INDEX env_snapshot_hash_idx ON environment_snapshot (hash);
+CREATE INDEX env_snapshot_values_idx ON environment_snapshot_values (snapshotid, valueid);
+CREATE INDEX env_snapshot_valueid_idx ON environment_snapshot_values (valueid);
+"""
+
+DB_SCHEME += ENVIRONMENT_SNAPSHOT_SCHEME
+
+# argument values which weren't tested in a testrun because they are
+# identical to a tested one
+DUPLICATE_SCHEME = """
+CREATE TABLE testrun_duplicate (
+   id integer NOT NULL AUTO_INCREMENT PRIMARY KEY,
+   testrunid INTEGER,
+   value TEXT,
+   duplicate TEXT
+);
+
+CREATE INDEX testrun_duplicate_testrunid_idx ON testrun_duplicate (testrunid);
+"""
+
+DB_SCHEME += DUPLICATE_SCHEME
+
+# tests whose process crashed, grouped by crash signature (see
+# insanity.crash)
+CRASH_BUCKET_SCHEME = """
+CREATE TABLE crash_bucket (
+   id integer NOT NULL AUTO_INCREMENT PRIMARY KEY,
+   signature VARCHAR(40),
+   signum INTEGER,
+   frames TEXT,
+   creationtime INTEGER
+);
+
+CREATE TABLE test_crash (
+   id integer NOT NULL AUTO_INCREMENT PRIMARY KEY,
+   testid INTEGER,
+   bucketid INTEGER
+);
+
+CREATE UNIQUE INDEX crash_bucket_signature_idx ON crash_bucket (signature);
+CREATE INDEX test_crash_testid_idx ON test_crash (testid);
+CREATE INDEX test_crash_bucketid_idx ON test_crash (bucketid);
+"""
+
+DB_SCHEME += CRASH_BUCKET_SCHEME
@@ -0,0 +1,68 @@
+# GStreamer QA system
+#
+#       storage/outcome.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Test outcome columns
+
+The most queried extra information and checks of a test are also stored
+in dedicated (indexed) columns of the test table:
+* returncode : the 'subprocess-return-code' extra information
+* duration : the 'test-total-duration' extra information (in seconds)
+* timedout : 1 if the 'no-timeout' check failed, 0 if it passed
+* crashed : 1 if the subprocess was killed by a signal without timing
+  out, 0 if it returned normally
+
+Columns for which the information isn't available are NULL.
+
+This module must not depend on anything else than the python standard
+library, since it is also used by the web frontend.
+"""
+
+RETURNCODE_EXTRAINFO = "subprocess-return-code"
+DURATION_EXTRAINFO = "test-total-duration"
+TIMEOUT_CHECK = "no-timeout"
+
+# extra information and checks the outcome is computed from
+OUTCOME_EXTRAINFOS = (RETURNCODE_EXTRAINFO, DURATION_EXTRAINFO)
+OUTCOME_CHECKS = (TIMEOUT_CHECK, )
+
+def compute_test_outcome(checklist, extrainfo):
+    """
+    Returns the (returncode, duration, timedout, crashed) of a test.
+
+    checklist is a list of (checkname, value)
+    extrainfo is a dictionnary of extra information (using names as keys,
+    it can be restricted to OUTCOME_EXTRAINFOS)
+    """
+    returncode = extrainfo.get(RETURNCODE_EXTRAINFO)
+    if returncode != None:
+        returncode = int(returncode)
+    duration = extrainfo.get(DURATION_EXTRAINFO)
+    if duration != None:
+        duration = float(duration)
+    timedout = None
+    for name, value in checklist:
+        if name == TIMEOUT_CHECK:
+            timedout = int(not value)
+    crashed = None
+    if returncode != None:
+        crashed = int(returncode < 0 and not timedout)
+    return (returncode, duration, timedout, crashed)
@@ -24,7 +24,7 @@ SQLite based DBStorage
 """
 
 from insanity.log import error, warning, debug
-from insanity.storage.dbstorage import DBStorage
+from insanity.storage.dbstorage import DBStorage, DB_SCHEME_VERSION
 
 try:
     # In Python 2.5, this is part of the standard library:
@@ -59,6 +59,10 @@ class SQLiteStorage(DBStorage):
         con.text_factory = str
         return con
 
+    def _blobParameter(self, blob):
+        # encoded values aren't valid UTF8 strings, store them as real BLOBs
+        return sqlite.Binary(blob)
+
     def _ExecuteScript(self, instructions, *args, **kwargs):
         """
         Executes the given script.
@@ -72,13 +76,277 @@ class SQLiteStorage(DBStorage):
             cur = self.con.cursor()
             cur.executescript(instructions, *args, **kwargs)
             if commit:
-                self.con.commit()
+                self._commit()
         finally:
             if not threadsafe:
                 self._lock.release()
         return cur.lastrowid
 
 
+    def _createTables(self):
+        # allow reclaiming the space of deleted rows with reclaimSpace(),
+        # this has to be set before the first table is created
+        self.con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        DBStorage._createTables(self)
+
+    def reclaimSpace(self, maxpages=None, step=1000):
+        """
+        Reclaims free pages 'step' pages at a time, so that the database
+        is never locked for long.
+
+        Returns None if the database wasn't created with incremental
+        vacuum enabled (see enableIncrementalVacuum()).
+        """
+        if self._FetchOne("PRAGMA auto_vacuum")[0] != 2:
+            warning("%s doesn't use incremental vacuum", self.path)
+            return None
+        reclaimed = 0
+        while maxpages == None or reclaimed < maxpages:
+            free = self._FetchOne("PRAGMA freelist_count")[0]
+            if not free:
+                break
+            nb = min(free, step)
+            if maxpages != None:
+                nb = min(nb, maxpages - reclaimed)
+            debug("reclaiming %d of %d free pages", nb, free)
+            self._FetchAll("PRAGMA incremental_vacuum(%d)" % nb)
+            reclaimed += nb
+        return reclaimed
+
+    def enableIncrementalVacuum(self):
+        """
+        Switches a database created by previous versions to incremental
+        vacuum.
+
+        This requires a full VACUUM, which can take a long time and locks
+        the database while it runs.
+        """
+        self._lock.acquire()
+        try:
+            self._commit()
+            self.con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.con.execute("VACUUM")
+        finally:
+            self._lock.release()
+
+    def _fastMerge(self, otherdb, testruns=None):
+        """
+        Merges another SQLite database by attaching it and copying all rows
+        with INSERT ... SELECT statements (remapping the ids through
+        temporary tables), in one transaction.
+        """
+        if not isinstance(otherdb, SQLiteStorage) or otherdb.path == ":memory:":
+            return False
+        if otherdb._getDatabaseSchemeVersion() != DB_SCHEME_VERSION:
+            return False
+        debug("Bulk merging %s", otherdb.path)
+        self._lock.acquire()
+        try:
+            # ATTACH and DDL statements can't be run within a transaction
+            self._commit()
+            cur = self.con.cursor()
+            cur.execute("ATTACH DATABASE ? AS mergesrc", (otherdb.path, ))
+            try:
+                cur.executescript(MERGE_TABLES)
+                try:
+                    self.__bulkMerge(cur, testruns)
+                    self._commit()
+                except:
+                    self.con.rollback()
+                    raise
+            finally:
+                cur.executescript(MERGE_TABLES_CLEANUP)
+                cur.execute("DETACH DATABASE mergesrc")
+        finally:
+            self._lock.release()
+        return True
+
+    def __bulkMerge(self, cur, testruns):
+        srcruns = [x[0] for x in cur.execute("SELECT id FROM mergesrc.testrun ORDER BY id").fetchall()]
+        if testruns != None:
+            srcruns = [x for x in srcruns if x in testruns]
+        if not srcruns:
+            return
+
+        # clients
+        cur.execute("""
+        INSERT INTO client (software, name, user)
+        SELECT DISTINCT s.software, s.name, s.user FROM mergesrc.client s
+        WHERE s.id IN (SELECT clientid FROM mergesrc.testrun WHERE id IN (%s))
+        AND NOT EXISTS (SELECT 1 FROM client d
+                        WHERE d.software IS s.software AND d.name IS s.name
+                        AND d.user IS s.user)""" % ",".join([str(x) for x in srcruns]))
+        cur.execute("""
+        INSERT INTO merge_client (oldid, newid)
+        SELECT s.id, (SELECT MIN(d.id) FROM client d
+                      WHERE d.software IS s.software AND d.name IS s.name
+                      AND d.user IS s.user)
+        FROM mergesrc.client s""")
+
+        # test and monitor classes we don't have yet, along with their
+        # dictionnaries
+        for classtable, maptable, dicttables in MERGE_CLASSES:
+            lastid = cur.execute("SELECT MAX(id) FROM %s" % classtable).fetchone()[0] or 0
+            columns = classtable == "testclassinfo" and "type, parent, description, fulldescription" \
+                      or "type, parent, description"
+            cur.execute("""
+            INSERT INTO %s (%s) SELECT %s FROM mergesrc.%s s
+            WHERE NOT EXISTS (SELECT 1 FROM %s d WHERE d.type=s.type)
+            ORDER BY s.id""" % (classtable, columns, columns, classtable,
+                                classtable))
+            cur.execute("""
+            INSERT INTO %s (oldid, newid)
+            SELECT s.id, (SELECT MIN(d.id) FROM %s d WHERE d.type=s.type)
+            FROM mergesrc.%s s""" % (maptable, classtable, classtable))
+            for dicttable, valuecolumn in dicttables:
+                cur.execute("""
+                INSERT INTO %s (containerid, name, %s)
+                SELECT m.newid, s.name, s.%s FROM mergesrc.%s s
+                INNER JOIN %s m ON m.oldid=s.containerid
+                WHERE m.newid > ? ORDER BY s.id""" % (dicttable, valuecolumn,
+                                                     valuecolumn, dicttable,
+                                                     maptable),
+                            (lastid, ))
+                # the instance dictionnaries use the class dictionnary
+                # entries as names
+                cur.execute("""
+                INSERT INTO merge_name (tablename, oldid, newid)
+                SELECT ?, s.id, MIN(d.id) FROM mergesrc.%s s
+                INNER JOIN %s m ON m.oldid=s.containerid
+                INNER JOIN %s d ON d.containerid=m.newid AND d.name=s.name
+                GROUP BY s.id""" % (dicttable, maptable, dicttable),
+                            (dicttable, ))
+
+        # environment snapshots and values we don't have yet
+        runsstr = ",".join([str(x) for x in srcruns])
+        cur.execute("""
+        INSERT INTO environment_value (hash, name, intvalue, txtvalue, blobvalue)
+        SELECT s.hash, s.name, s.intvalue, s.txtvalue, s.blobvalue
+        FROM mergesrc.environment_value s
+        WHERE s.id IN (SELECT sv.valueid FROM mergesrc.environment_snapshot_values sv
+                       INNER JOIN mergesrc.testrun t ON t.environmentid=sv.snapshotid
+                       WHERE t.id IN (%s))
+        AND NOT EXISTS (SELECT 1 FROM environment_value d WHERE d.hash=s.hash)
+        ORDER BY s.id""" % runsstr)
+        lastid = cur.execute("SELECT MAX(id) FROM environment_snapshot").fetchone()[0] or 0
+        cur.execute("""
+        INSERT INTO environment_snapshot (hash)
+        SELECT DISTINCT s.hash FROM mergesrc.environment_snapshot s
+        WHERE s.id IN (SELECT environmentid FROM mergesrc.testrun WHERE id IN (%s))
+        AND NOT EXISTS (SELECT 1 FROM environment_snapshot d WHERE d.hash=s.hash)
+        ORDER BY s.id""" % runsstr)
+        cur.execute("""
+        INSERT INTO merge_snapshot (oldid, newid)
+        SELECT s.id, (SELECT MIN(d.id) FROM environment_snapshot d WHERE d.hash=s.hash)
+        FROM mergesrc.environment_snapshot s
+        WHERE s.id IN (SELECT environmentid FROM mergesrc.testrun WHERE id IN (%s))""" % runsstr)
+        cur.execute("""
+        INSERT INTO environment_snapshot_values (snapshotid, valueid)
+        SELECT DISTINCT m.newid, (SELECT MIN(d.id) FROM environment_value d
+                                  WHERE d.hash=v.hash)
+        FROM mergesrc.environment_snapshot_values sv
+        INNER JOIN merge_snapshot m ON m.oldid=sv.snapshotid
+        INNER JOIN mergesrc.environment_value v ON v.id=sv.valueid
+        WHERE m.newid > ?""", (lastid, ))
+
+        # testruns and their environment
+        for oldid in srcruns:
+            cur.execute("""
+            INSERT INTO testrun (clientid, starttime, stoptime, environmentid)
+            SELECT m.newid, s.starttime, s.stoptime, ms.newid FROM mergesrc.testrun s
+            LEFT JOIN merge_client m ON m.oldid=s.clientid
+            LEFT JOIN merge_snapshot ms ON ms.oldid=s.environmentid
+            WHERE s.id=?""", (oldid, ))
+            cur.execute("INSERT INTO merge_testrun (oldid, newid) VALUES (?, ?)",
+                        (oldid, cur.lastrowid))
+        cur.execute("""
+        INSERT INTO testrun_environment_dict (containerid, name, intvalue,
+                                              txtvalue, blobvalue)
+        SELECT m.newid, s.name, s.intvalue, s.txtvalue, s.blobvalue
+        FROM mergesrc.testrun_environment_dict s
+        INNER JOIN merge_testrun m ON m.oldid=s.containerid
+        ORDER BY s.id""")
+        cur.execute("""
+        INSERT INTO testrun_duplicate (testrunid, value, duplicate)
+        SELECT m.newid, s.value, s.duplicate FROM mergesrc.testrun_duplicate s
+        INNER JOIN merge_testrun m ON m.oldid=s.testrunid
+        ORDER BY s.id""")
+
+        # new test and monitor ids follow the existing ones
+        self.__fillIdMap(cur, "merge_test", "test", """
+        SELECT id FROM mergesrc.test
+        WHERE testrunid IN (SELECT oldid FROM merge_testrun) ORDER BY id""")
+        self.__fillIdMap(cur, "merge_monitor", "monitor", """
+        SELECT id FROM mergesrc.monitor
+        WHERE testid IN (SELECT oldid FROM merge_test) ORDER BY id""")
+
+        cur.execute("""
+        INSERT INTO test (id, testrunid, type, resultpercentage,
+                          validatedmask, passedmask,
+                          fingerprint, monitorsfingerprint,
+                          returncode, duration, timedout, crashed)
+        SELECT mt.newid, mr.newid, mc.newid, s.resultpercentage,
+               s.validatedmask, s.passedmask,
+               s.fingerprint, s.monitorsfingerprint,
+               s.returncode, s.duration, s.timedout, s.crashed
+        FROM mergesrc.test s
+        INNER JOIN merge_test mt ON mt.oldid=s.id
+        INNER JOIN merge_testrun mr ON mr.oldid=s.testrunid
+        LEFT JOIN merge_testclass mc ON mc.oldid=s.type
+        ORDER BY s.id""")
+        cur.execute("""
+        INSERT INTO subtests (testid, scenarioid)
+        SELECT a.newid, b.newid FROM mergesrc.subtests s
+        INNER JOIN merge_test a ON a.oldid=s.testid
+        INNER JOIN merge_test b ON b.oldid=s.scenarioid""")
+        cur.execute("""
+        INSERT INTO crash_bucket (signature, signum, frames, creationtime)
+        SELECT s.signature, s.signum, s.frames, s.creationtime
+        FROM mergesrc.crash_bucket s
+        WHERE s.id IN (SELECT c.bucketid FROM mergesrc.test_crash c
+                       INNER JOIN merge_test m ON m.oldid=c.testid)
+        AND NOT EXISTS (SELECT 1 FROM crash_bucket d WHERE d.signature=s.signature)
+        ORDER BY s.id""")
+        cur.execute("""
+        INSERT INTO test_crash (testid, bucketid)
+        SELECT m.newid, d.id FROM mergesrc.test_crash c
+        INNER JOIN merge_test m ON m.oldid=c.testid
+        INNER JOIN mergesrc.crash_bucket s ON s.id=c.bucketid
+        INNER JOIN crash_bucket d ON d.signature=s.signature
+        ORDER BY c.id""")
+        cur.execute("""
+        INSERT INTO monitor (id, testid, type, resultpercentage)
+        SELECT mm.newid, mt.newid, mc.newid, s.resultpercentage
+        FROM mergesrc.monitor s
+        INNER JOIN merge_monitor mm ON mm.oldid=s.id
+        INNER JOIN merge_test mt ON mt.oldid=s.testid
+        LEFT JOIN merge_monitorclass mc ON mc.oldid=s.type
+        ORDER BY s.id""")
+
+        for dicttable, maptable, classdict, valuecolumns in MERGE_DICTS:
+            cur.execute("""
+            INSERT INTO %s (containerid, name, %s)
+            SELECT mc.newid, mn.newid, %s FROM mergesrc.%s s
+            INNER JOIN %s mc ON mc.oldid=s.containerid
+            INNER JOIN merge_name mn ON mn.tablename=? AND mn.oldid=s.name
+            ORDER BY s.id""" % (dicttable, valuecolumns,
+                                ", ".join(["s." + x for x in valuecolumns.split(", ")]),
+                                dicttable, maptable),
+                        (classdict, ))
+
+    def __fillIdMap(self, cur, maptable, table, selectstr):
+        """
+        Fills maptable with the ids returned by selectstr, the new ids
+        starting after the biggest id of table.
+        """
+        lastid = cur.execute("SELECT MAX(id) FROM %s" % table).fetchone()[0] or 0
+        if lastid:
+            # the next rowid of maptable will be lastid + 1
+            cur.execute("INSERT INTO %s (newid, oldid) VALUES (?, NULL)" % maptable,
+                        (lastid, ))
+        cur.execute("INSERT INTO %s (oldid) %s" % (maptable, selectstr))
+        cur.execute("DELETE FROM %s WHERE oldid IS NULL" % maptable)
+
     def _getDatabaseSchemeVersion(self):
         """
         Returns the scheme version of the currently loaded databse
@@ -111,6 +379,75 @@ class SQLiteStorage(DBStorage):
     def _getDBScheme(self):
         return DB_SCHEME
 
+    def _getEnvironmentSnapshotScheme(self):
+        return ENVIRONMENT_SNAPSHOT_SCHEME
+
+    def _getDuplicateScheme(self):
+        return DUPLICATE_SCHEME
+
+    def _getCrashBucketScheme(self):
+        return CRASH_BUCKET_SCHEME
+
+# (classtable, maptable, [(dicttable, valuecolumn), ...])
+MERGE_CLASSES = [
+    ("testclassinfo", "merge_testclass",
+     [("testclassinfo_arguments_dict", "blobvalue"),
+      ("testclassinfo_checklist_dict", "txtvalue"),
+      ("testclassinfo_extrainfo_dict", "txtvalue"),
+      ("testclassinfo_outputfiles_dict", "txtvalue")]),
+    ("monitorclassinfo", "merge_monitorclass",
+     [("monitorclassinfo_arguments_dict", "txtvalue"),
+      ("monitorclassinfo_checklist_dict", "txtvalue"),
+      ("monitorclassinfo_extrainfo_dict", "txtvalue"),
+      ("monitorclassinfo_outputfiles_dict", "txtvalue")])
+    ]
+
+# (dicttable, container maptable, class dicttable, valuecolumns)
+MERGE_DICTS = [
+    ("test_arguments_dict", "merge_test", "testclassinfo_arguments_dict",
+     "intvalue, txtvalue, blobvalue"),
+    ("test_checklist_list", "merge_test", "testclassinfo_checklist_dict",
+     "intvalue"),
+    ("test_extrainfo_dict", "merge_test", "testclassinfo_extrainfo_dict",
+     "intvalue, txtvalue, blobvalue"),
+    ("test_outputfiles_dict", "merge_test", "testclassinfo_outputfiles_dict",
+     "txtvalue"),
+    ("monitor_arguments_dict", "merge_monitor", "monitorclassinfo_arguments_dict",
+     "intvalue, txtvalue, blobvalue"),
+    ("monitor_checklist_dict", "merge_monitor", "monitorclassinfo_checklist_dict",
+     "intvalue"),
+    ("monitor_extrainfo_dict", "merge_monitor", "monitorclassinfo_extrainfo_dict",
+     "intvalue, txtvalue, blobvalue"),
+    ("monitor_outputfiles_dict", "merge_monitor", "monitorclassinfo_outputfiles_dict",
+     "txtvalue")
+    ]
+
+# temporary id mapping tables used by the bulk merge
+MERGE_TABLES = """
+CREATE TEMP TABLE merge_client (oldid INTEGER PRIMARY KEY, newid INTEGER);
+CREATE TEMP TABLE merge_testclass (oldid INTEGER PRIMARY KEY, newid INTEGER);
+CREATE TEMP TABLE merge_monitorclass (oldid INTEGER PRIMARY KEY, newid INTEGER);
+CREATE TEMP TABLE merge_name (tablename TEXT, oldid INTEGER, newid INTEGER,
+                              PRIMARY KEY (tablename, oldid));
+CREATE TEMP TABLE merge_testrun (oldid INTEGER PRIMARY KEY, newid INTEGER);
+CREATE TEMP TABLE merge_snapshot (oldid INTEGER PRIMARY KEY, newid INTEGER);
+CREATE TEMP TABLE merge_test (newid INTEGER PRIMARY KEY, oldid INTEGER);
+CREATE TEMP TABLE merge_monitor (newid INTEGER PRIMARY KEY, oldid INTEGER);
+CREATE INDEX merge_test_oldid_idx ON merge_test (oldid);
+CREATE INDEX merge_monitor_oldid_idx ON merge_monitor (oldid);
+"""
+
+MERGE_TABLES_CLEANUP = """
+DROP TABLE IF EXISTS temp.merge_client;
+DROP TABLE IF EXISTS temp.merge_testclass;
+DROP TABLE IF EXISTS temp.merge_monitorclass;
+DROP TABLE IF EXISTS temp.merge_name;
+DROP TABLE IF EXISTS temp.merge_testrun;
+DROP TABLE IF EXISTS temp.merge_snapshot;
+DROP TABLE IF EXISTS temp.merge_test;
+DROP TABLE IF EXISTS temp.merge_monitor;
+"""
+
 DB_SCHEME = """
 CREATE TABLE version (
    version INTEGER,
@@ -121,7 +458,8 @@ CREATE TABLE testrun (
    id INTEGER PRIMARY KEY,
    clientid INTEGER,
    starttime INTEGER,
-   stoptime INTEGER
+   stoptime INTEGER,
+   environmentid INTEGER
 );
 
 CREATE TABLE client (
@@ -135,7 +473,15 @@ CREATE TABLE test (
    id INTEGER PRIMARY KEY,
    testrunid INTEGER,
    type INTEGER,
-   resultpercentage FLOAT
+   resultpercentage FLOAT,
+   validatedmask INTEGER,
+   passedmask INTEGER,
+   fingerprint TEXT,
+   monitorsfingerprint TEXT,
+   returncode INTEGER,
+   duration FLOAT,
+   timedout INTEGER,
+   crashed INTEGER
 );
 
 CREATE TABLE subtests (
@@ -300,6 +646,7 @@ CREATE INDEX monitor_testid_idx ON monitor(testid);
 CREATE INDEX testclassinfo_parent_idx ON testclassinfo (parent);
 CREATE INDEX monitorclassinfo_parent_idx ON monitorclassinfo (parent);
 CREATE INDEX testrun_env_dict_container_idx ON testrun_environment_dict (containerid);
+CREATE INDEX testrun_environmentid_idx ON testrun (environmentid);
 
 CREATE INDEX t_a_dict_containerid_idx ON test_arguments_dict (containerid, name);
 CREATE INDEX t_c_list_containerid_idx ON test_checklist_list (containerid, name);
@@ -322,4 +669,79 @@ CREATE INDEX mc_ei_dict_c_idx ON monitorclassinfo_extrainfo_dict (containerid, n
 CREATE INDEX mc_of_dict_c_idx ON monitorclassinfo_outputfiles_dict (containerid, name);
 
 CREATE INDEX test_type_idx ON test (type);
+CREATE INDEX test_fingerprint_idx ON test (fingerprint, testrunid);
+CREATE INDEX test_monitorsfingerprint_idx ON test (monitorsfingerprint, testrunid);
+CREATE INDEX test_returncode_idx ON test (returncode, testrunid);
+CREATE INDEX test_duration_idx ON test (testrunid, duration);
+CREATE INDEX test_timedout_idx ON test (timedout, testrunid);
+CREATE INDEX test_crashed_idx ON test (crashed, testrunid);
 """
+
+# environments shared by testruns, each value and snapshot is only stored
+# once (identified by the digest of its contents)
+ENVIRONMENT_SNAPSHOT_SCHEME = """
+CREATE TABLE environment_value (
+   id INTEGER PRIMARY KEY,
+   hash TEXT,
+   name TEXT,
+   intvalue INTEGER,
+   txtvalue TEXT,
+   blobvalue BLOB
+);
+
+CREATE TABLE environment_snapshot (
+   id INTEGER PRIMARY KEY,
+   hash TEXT
+);
+
+CREATE TABLE environment_snapshot_values (
+   snapshotid INTEGER,
+   valueid INTEGER
+);
+
+CREATE INDEX env_value_hash_idx ON environment_value (hash);
+CREATE INDEX env_snapshot_hash_idx ON environment_snapshot (hash);
+CREATE INDEX env_snapshot_values_idx ON environment_snapshot_values (snapshotid, valueid);
+CREATE INDEX env_snapshot_valueid_idx ON environment_snapshot_values (valueid);
+"""
+
+DB_SCHEME += ENVIRONMENT_SNAPSHOT_SCHEME
+
+# argument values which weren't tested in a testrun because they are
+# identical to a tested one
+DUPLICATE_SCHEME = """
+CREATE TABLE testrun_duplicate (
+   id INTEGER PRIMARY KEY,
+   testrunid INTEGER,
+   value TEXT,
+   duplicate TEXT
+);
+
+CREATE INDEX testrun_duplicate_testrunid_idx ON testrun_duplicate (testrunid);
+"""
+
+DB_SCHEME += DUPLICATE_SCHEME
+
+# tests whose process crashed, grouped by crash signature (see
+# insanity.crash)
+CRASH_BUCKET_SCHEME = """
+CREATE TABLE crash_bucket (
+   id INTEGER PRIMARY KEY,
+   signature TEXT,
+   signum INTEGER,
+   frames TEXT,
+   creationtime INTEGER
+);
+
+CREATE TABLE test_crash (
+   id INTEGER PRIMARY KEY,
+   testid INTEGER,
+   bucketid INTEGER
+);
+
+CREATE UNIQUE INDEX crash_bucket_signature_idx ON crash_bucket (signature);
+CREATE INDEX test_crash_testid_idx ON test_crash (testid);
+CREATE INDEX test_crash_bucketid_idx ON test_crash (bucketid);
+"""
+
+DB_SCHEME += CRASH_BUCKET_SCHEME
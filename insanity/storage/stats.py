@@ -0,0 +1,232 @@
+# GStreamer QA system
+#
+#       storage/stats.py
+#
+# Copyright (c) 2008, Edward Hervey <bilboed@bilboed.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Storage instrumentation
+
+Timings are accumulated by category (actions, commits, queries, ...) and
+key (action name, normalized SQL query, ...), along with the number of
+rows written to each table.
+"""
+
+import re
+import time
+import threading
+
+# categories of timings
+ACTION = "actions"
+QUEUE_WAIT = "queue-wait"
+COMMIT = "commits"
+LOCK_WAIT = "lock-wait"
+QUERY = "queries"
+
+# maximum number of normalized queries to keep in the cache
+_NORMALIZE_CACHE_SIZE = 1024
+
+_written_table = re.compile(r"^\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+(\w+)",
+                            re.IGNORECASE)
+_whitespace = re.compile(r"\s+")
+_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s")
+_inlist = re.compile(r"IN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_normalized = {}
+
+def written_table(instruction):
+    """
+    Returns the name of the table modified by the given SQL instruction, or
+    None if it isn't an INSERT, UPDATE or DELETE.
+    """
+    match = _written_table.match(instruction)
+    if match == None:
+        return None
+    return match.group(1)
+
+def normalize_sql(instruction):
+    """
+    Returns the given SQL query with whitespace collapsed and literals,
+    placeholders and lists of values replaced, so that all executions of
+    the same query have the same normalized form.
+    """
+    res = _normalized.get(instruction)
+    if res == None:
+        res = _whitespace.sub(" ", instruction).strip()
+        res = _literal.sub("?", res)
+        res = _inlist.sub("IN (...)", res)
+        if len(_normalized) >= _NORMALIZE_CACHE_SIZE:
+            _normalized.clear()
+        _normalized[instruction] = res
+    return res
+
+class StorageStats(object):
+    """
+    Thread-safe accumulator of storage metrics
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # { category : { key : [count, total, max] } }
+        self.__timings = {}
+        # { table : nbrows }
+        self.__rows = {}
+
+    def addTiming(self, category, key, duration):
+        """
+        Accounts an operation of the given category and key which took
+        'duration' seconds.
+        """
+        self.__lock.acquire()
+        try:
+            timing = self.__timings.setdefault(category, {}).get(key)
+            if timing == None:
+                self.__timings[category][key] = [1, duration, duration]
+            else:
+                timing[0] += 1
+                timing[1] += duration
+                if duration > timing[2]:
+                    timing[2] = duration
+        finally:
+            self.__lock.release()
+
+    def addRows(self, table, nbrows):
+        """
+        Accounts 'nbrows' rows written to the given table.
+        """
+        self.__lock.acquire()
+        try:
+            self.__rows[table] = self.__rows.get(table, 0) + nbrows
+        finally:
+            self.__lock.release()
+
+    def getTimings(self, category):
+        """
+        Returns a dictionnary of the timings of the given category:
+        * key : the key of the operations
+        * value : a dictionnary with the 'count', 'total' and 'max'
+          durations (in seconds)
+        """
+        self.__lock.acquire()
+        try:
+            return dict([(key, {"count" : count, "total" : total, "max" : mx})
+                         for key, (count, total, mx)
+                         in self.__timings.get(category, {}).iteritems()])
+        finally:
+            self.__lock.release()
+
+    def getRows(self):
+        """
+        Returns a dictionnary of the number of rows written per table
+        """
+        self.__lock.acquire()
+        try:
+            return dict(self.__rows)
+        finally:
+            self.__lock.release()
+
+    def reset(self):
+        """
+        Forgets all accumulated metrics
+        """
+        self.__lock.acquire()
+        try:
+            self.__timings = {}
+            self.__rows = {}
+        finally:
+            self.__lock.release()
+
+class TimedLock(object):
+    """
+    Lock accounting the time spent waiting to acquire it
+    """
+
+    def __init__(self, lock, stats, key="lock"):
+        self.__lock = lock
+        self.__stats = stats
+        self.__key = key
+
+    def acquire(self, blocking=True):
+        start = time.time()
+        res = self.__lock.acquire(blocking)
+        self.__stats.addTiming(LOCK_WAIT, self.__key, time.time() - start)
+        return res
+
+    def release(self):
+        self.__lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def summarize_timing(timing):
+    """
+    Returns a one-line description of a timing dictionnary
+    """
+    if not timing or not timing["count"]:
+        return "none"
+    return "%d in %.3fs (avg %.2fms, max %.2fms)" % (timing["count"],
+                                                     timing["total"],
+                                                     1000.0 * timing["total"] / timing["count"],
+                                                     1000.0 * timing["max"])
+
+def total_timing(timings):
+    """
+    Returns the timing dictionnary adding up all the given timings (a
+    dictionnary of key : timing)
+    """
+    res = {"count" : 0, "total" : 0.0, "max" : 0.0}
+    for timing in timings.itervalues():
+        res["count"] += timing["count"]
+        res["total"] += timing["total"]
+        res["max"] = max(res["max"], timing["max"])
+    return res
+
+def summarize_storage_stats(stats):
+    """
+    Returns the given storage statistics (as returned by
+    AsyncStorage.getStorageStats()) with each category of timings replaced
+    by its total, so that its size doesn't depend on the queries done.
+    """
+    res = dict(stats)
+    for category in (QUEUE_WAIT, ACTION, COMMIT, LOCK_WAIT, QUERY):
+        res[category] = total_timing(stats[category])
+    return res
+
+def format_storage_stats(stats, nbqueries=5):
+    """
+    Returns a list of lines summarizing the given storage statistics (as
+    returned by AsyncStorage.getStorageStats()), including the 'nbqueries'
+    slowest queries.
+    """
+    lines = ["queue depth: %d, oldest pending action: %.3fs" % (stats["queue-depth"],
+                                                                 stats["oldest-pending-age"]),
+             "queue wait: %s" % summarize_timing(total_timing(stats[QUEUE_WAIT])),
+             "actions: %s" % summarize_timing(total_timing(stats[ACTION])),
+             "commits: %s" % summarize_timing(total_timing(stats[COMMIT])),
+             "lock wait: %s" % summarize_timing(total_timing(stats[LOCK_WAIT])),
+             "rows written: %d (%s)" % (sum(stats["rows"].values()),
+                                        ", ".join(["%s:%d" % x for x in sorted(stats["rows"].items())])),
+             "queries: %s" % summarize_timing(total_timing(stats[QUERY]))]
+    queries = stats[QUERY].items()
+    queries.sort(key=lambda x: x[1]["total"], reverse=True)
+    for query, timing in queries[:nbqueries]:
+        lines.append("  %s : %s" % (summarize_timing(timing), query))
+    return lines
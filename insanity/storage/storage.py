@@ -34,13 +34,42 @@ class DataStorage(object):
     def _setUp(self):
         raise NotImplementedError
 
-    def findTestsByArgument(self, testtype, arguments, testrunid=None, monitors=None):
+    def findTestsByArgument(self, testtype, arguments, testrunid=None, monitors=None,
+                            exact=False):
         """
-        Return all test ids of type <testtype> and with arguments <arguments>
+        Return all test ids of type <testtype> and whose arguments include
+        <arguments>
 
         arguments is a dictionnary
         If specified, only tests belonging to the given testrunid will be
         returned.
+        If exact is True, the tests need to have exactly <arguments>.
+        """
+        raise NotImplementedError
+
+    def findEquivalentTests(self, testid, testrunid=None, withmonitors=True):
+        """
+        Return all test ids with the same type and arguments as <testid>
+
+        If specified, only tests belonging to the given testrunid will be
+        returned.
+        If withmonitors is True, the tests also need to have been run with
+        the same monitors.
+        """
+        raise NotImplementedError
+
+    def compareTestRuns(self, testrun1, testrun2, withmonitors=False):
+        """
+        Compares the tests of testrun2 against the tests of testrun1.
+
+        Returns a tuple of 5 values:
+        * list of testid in testrun2 which are not in testrun1
+        * list of testid in testrun1 which are not in testrun2
+        * list of testid in testrun2 which have improved
+        * list of testid in testrun2 which have regressed
+        * a dictionnary mapping of:
+          * testid from testrun2
+          * list of corresponding testid from testrun1
         """
         raise NotImplementedError
 
@@ -95,6 +124,16 @@ class DataStorage(object):
         has finished."""
         raise NotImplementedError
 
+    def addMonitorOutputFile(self, testrun, test, monitor, key, value):
+        """Inform the DataStorage that the given monitor of the given test
+        produced an output file after the test finished."""
+        pass
+
+    def newTestCrash(self, testrun, test, signature, signum, frames):
+        """Inform the DataStorage that the process of the given test
+        crashed, with the given signature (see insanity.crash)."""
+        pass
+
     # public retrieval API
 
     def listTestRuns(self):
@@ -152,6 +191,43 @@ class DataStorage(object):
         """
         raise NotImplementedError
 
+    def getDuplicatesForTestRun(self, testrunid):
+        """
+        Returns a dictionnary of the argument values which weren't tested
+        in the given testrunid because they are identical to a tested one:
+        * key : the tested value
+        * value : the list of identical values
+        """
+        return {}
+
+    def getCrashBucketsForTestRun(self, testrunid):
+        """
+        Returns a dictionnary of the crashed tests of the given testrunid,
+        grouped by crash signature:
+        * key : the crash bucket id
+        * value : the list of tests whose process crashed that way
+        """
+        return {}
+
+    def getCrashBucketInfo(self, bucketid):
+        """
+        Returns the (signature, signum, frames) of the given crash bucket
+        """
+        raise NotImplementedError
+
+    def getCrashBucketForTest(self, testid):
+        """
+        Returns the crash bucket id of the given test, or None if it
+        didn't crash (or if its crash wasn't analyzed).
+        """
+        return None
+
+    def getCrashBucketSize(self, signature):
+        """
+        Returns the number of tests which crashed with the given signature
+        """
+        return 0
+
     def getFailedTestsForTestRun(self, testrunid):
         """
         Returns the list of failed tests in the given testrun
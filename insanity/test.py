@@ -671,6 +671,9 @@ class DBusTest(Test, dbus.service.Object):
             self._stdin = None
             self._stdout = None
             self._stderr = None
+            # working directory of the subprocess (default : the one of
+            # the testrun)
+            self._cwd = None
             self._preargs = []
             self._environ = env or {}
             self._environ.update(os.environ.copy())
@@ -721,7 +724,7 @@ class DBusTest(Test, dbus.service.Object):
             pargs = self._preargs
             pargs.extend(self.get_remote_launcher_args())
 
-            cwd = self._testrun.getWorkingDirectory()
+            cwd = self._cwd or self._testrun.getWorkingDirectory()
 
             self._environ["PRIVATE_DBUS_ADDRESS"] = self._bus_address
             info("Setting PRIVATE_DBUS_ADDRESS : %r" % self._bus_address)
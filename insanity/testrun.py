@@ -124,6 +124,13 @@ class TestRun(gobject.GObject):
         # _environment are the environment information
         # _environ are the environment variables (env)
         self._environment = {}
+        # values skipped by the generators of the arguments, see
+        # getDuplicates()
+        self._duplicates = {}
+        # number of operations the end of the testrun has to wait for, see
+        # addPendingOperation()
+        self._pendingoperations = 0
+        self._waitingoperations = False
         self._env = os.environ.copy()
         if env:
             self._env.update(env)
@@ -160,6 +167,31 @@ class TestRun(gobject.GObject):
         """
         self._storage = storage
 
+    def getStorage(self):
+        """
+        Returns the storage used for this TestRun
+        """
+        return self._storage
+
+    def addPendingOperation(self):
+        """
+        Informs the TestRun that an operation related to one of its tests
+        (like a monitor post-processing its results) is still running.
+
+        The TestRun will not end before pendingOperationDone() is called.
+        """
+        self._pendingoperations += 1
+
+    def pendingOperationDone(self):
+        """
+        Informs the TestRun that an operation added with
+        addPendingOperation() is done.
+        """
+        self._pendingoperations -= 1
+        if self._pendingoperations == 0 and self._waitingoperations:
+            self._waitingoperations = False
+            self._runNextBatch()
+
     def addTest(self, test, arguments, monitors=None):
         """
         Adds test with the given arguments (or generator) and monitors
@@ -187,6 +219,15 @@ class TestRun(gobject.GObject):
         """
         return self._environment
 
+    def getDuplicates(self):
+        """
+        Returns a dictionnary of the argument values which weren't tested
+        because they are identical to a tested one:
+        * key : the tested value
+        * value : the list of identical values
+        """
+        return self._duplicates
+
     ## PRIVATE API
 
     def _setupPrivateBus(self):
@@ -215,14 +256,24 @@ class TestRun(gobject.GObject):
         """
         Collect the environment settings, parameters, variables,...
         """
-        # we specify our own registry
-        path = self.get_temp_file(nameid="registry", category="testrun")[1]
+        # we specify our own registry, prebuilt if possible
+        fd, path = self.get_temp_file(nameid="registry", category="testrun")
+        os.close(fd)
+        environment.provideRegistry(self._env, path)
         self._env["GST_REGISTRY"] = path
         environment.collectEnvironment(self._env, self._gotEnvironment)
 
     def _gotEnvironment(self, resdict):
         info("Got environment %r", resdict)
         self._environment = resdict
+        # remember how the arguments were reduced, to be able to reproduce
+        # the testrun
+        expansions = [(test.__test_name__, args.getExpansion())
+                      for test, args, monitors in self._tests
+                      if args.getExpansion() != None]
+        if expansions:
+            self._environment = dict(resdict)
+            self._environment["arguments-expansions"] = expansions
         self.emit("start")
         self._starttime = int(time.time())
         self._storage.startNewTestRun(self, self._clientid)
@@ -295,6 +346,14 @@ class TestRun(gobject.GObject):
 
     def _runNextBatch(self):
         """ Runs the next test batch """
+        if self._currentarguments:
+            for value, duplicates in self._currentarguments.getDuplicates().iteritems():
+                known = self._duplicates.setdefault(value, [])
+                known.extend([x for x in duplicates if not x in known])
+        if len(self._tests) == 0 and self._pendingoperations:
+            info("Waiting for %d pending operations", self._pendingoperations)
+            self._waitingoperations = True
+            return False
         if len(self._tests) == 0:
             # if nothing left, stop
             info("No more tests batch to run, we're done")
@@ -310,6 +369,8 @@ class TestRun(gobject.GObject):
         self._currenttest = test
         self._currentmonitors = monitors
         self._currentarguments = args
+        # the exact length is only needed for progress reporting
+        args.countInBackground()
 
         info("Current test : %r" % test)
         info("Current monitors : %r" % monitors)
@@ -330,9 +391,12 @@ class TestRun(gobject.GObject):
     def getCurrentBatchLength(self):
         """
         Returns the size of the current batch.
+
+        While it is still being computed, an estimate of it is returned,
+        or 0 if there isn't any.
         """
         if self._currentarguments:
-            return len(self._currentarguments)
+            return self._currentarguments.estimateLength() or 0
         return 0
 
     def getWorkingDirectory(self):
@@ -188,6 +188,69 @@ class ActionQueueThread(threading.Thread):
         return res
 
 
+class WorkerPool(object):
+    """
+    Runs actions in at most nbworkers threads.
+
+    Actions are queued with queueAction(), their callback is called from
+    the main loop with the value returned by the action (None if it
+    failed).
+    """
+
+    def __init__(self, nbworkers=2):
+        self.nbworkers = nbworkers
+        self._lock = threading.Condition()
+        # list of (callback, method, args, kwargs)
+        self._queue = []
+        self._threads = []
+        # number of threads waiting for actions
+        self._idle = 0
+
+    def queueAction(self, callback, method, *args, **kwargs):
+        """
+        Queue an action, callback will be called with its result
+        """
+        debug("about to queue %r", method)
+        self._lock.acquire()
+        try:
+            self._queue.append((callback, method, args, kwargs))
+            if not self._idle and len(self._threads) < self.nbworkers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                self._threads.append(thread)
+                thread.start()
+            else:
+                self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        self._lock.acquire()
+        while True:
+            while not self._queue:
+                self._idle += 1
+                self._lock.wait()
+                self._idle -= 1
+            callback, method, args, kwargs = self._queue.pop(0)
+            self._lock.release()
+            res = None
+            try:
+                debug("about to call %r", method)
+                res = method(*args, **kwargs)
+            except:
+                error("There was a problem calling %r", method)
+                error(traceback.format_exc())
+            gobject.idle_add(self._actionDone, callback, res)
+            self._lock.acquire()
+
+    def _actionDone(self, callback, res):
+        try:
+            callback(res)
+        except:
+            error("There was a problem calling %r", callback)
+            error(traceback.format_exc())
+        return False
+
 class ThreadMaster(gobject.GObject):
     """
     Controls all thread
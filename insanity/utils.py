@@ -26,9 +26,15 @@ Miscellaneous utility functions and classes
 
 import os
 import imp
+import fcntl
+import termios
+import struct
+import threading
 from random import randint
+from collections import deque
 import gzip
-from insanity.log import exception
+import bz2
+from insanity.log import debug, exception
 
 __uuids = []
 
@@ -202,6 +208,178 @@ def compress_file(original, compfile):
     f.close()
     out.close()
 
+# codecs of compressed logs : (file extension, file class)
+COMPRESSION_CODECS = {
+    "gzip" : (".gz", gzip.GzipFile),
+    "bzip2" : (".bz2", bz2.BZ2File),
+    "none" : ("", None)
+    }
+
+class StreamCompressor(threading.Thread):
+    """
+    Thread compressing everything written to a pipe into a file, as it
+    arrives.
+
+    The write end of the pipe (fileno()) is meant to be given to a
+    subprocess (as its stderr for example). The thread stops once all the
+    writers closed it, removing the output file if nothing was written.
+
+    codec is one of COMPRESSION_CODECS, level the compression level (1-9).
+    """
+
+    # size of the blocks read from the pipe
+    BLOCKSIZE = 64 * 1024
+
+    def __init__(self, path, codec="gzip", level=6):
+        threading.Thread.__init__(self)
+        self.setName("StreamCompressor-%s" % os.path.basename(path))
+        if not codec in COMPRESSION_CODECS:
+            raise ValueError("Unknown compression codec %r" % codec)
+        self.path = path
+        self.codec = codec
+        self.level = level
+        self.nbbytes = 0
+        self._readfd, self._writefd = os.pipe()
+        # protects the closing of the read end against hasData()
+        self._readlock = threading.Lock()
+        # only the subprocess (which gets a copy of it) should keep the
+        # write end open, else we wouldn't see the end of the stream
+        for fd in (self._readfd, self._writefd):
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        """
+        Returns the write end of the pipe
+        """
+        return self._writefd
+
+    def closeWriter(self):
+        """
+        Closes our copy of the write end of the pipe
+        """
+        if self._writefd != None:
+            os.close(self._writefd)
+            self._writefd = None
+
+    def hasData(self):
+        """
+        Returns True if anything was (or is about to be) written in the
+        file.
+        """
+        if self.nbbytes:
+            return True
+        self._readlock.acquire()
+        try:
+            if self._readfd == None:
+                # everything was read
+                return self.nbbytes > 0
+            buf = fcntl.ioctl(self._readfd, termios.FIONREAD, "    ")
+            return struct.unpack("i", buf)[0] > 0
+        finally:
+            self._readlock.release()
+
+    def _closeReader(self):
+        # the fd number could be reused as soon as it's closed
+        self._readlock.acquire()
+        try:
+            os.close(self._readfd)
+            self._readfd = None
+        finally:
+            self._readlock.release()
+
+    def _openOutput(self):
+        ext, fileclass = COMPRESSION_CODECS[self.codec]
+        if fileclass:
+            return fileclass(self.path, "wb", self.level)
+        return open(self.path, "wb")
+
+    def run(self):
+        out = self._openOutput()
+        try:
+            try:
+                while True:
+                    buf = os.read(self._readfd, self.BLOCKSIZE)
+                    if not buf:
+                        break
+                    self.nbbytes += len(buf)
+                    out.write(buf)
+            finally:
+                out.close()
+                self._closeReader()
+            if not self.nbbytes:
+                debug("nothing was written, removing %s", self.path)
+                os.remove(self.path)
+        except:
+            exception("Error while compressing to %s", self.path)
+
+class RingBufferCapture(StreamCompressor):
+    """
+    Thread keeping the last 'size' bytes written to a pipe in memory.
+
+    Once all the writers closed the pipe, the kept data is either
+    compressed into the file if keep() was called, or dropped (and the
+    file removed) if discard() was called.
+    """
+
+    def __init__(self, path, size, codec="gzip", level=6):
+        StreamCompressor.__init__(self, path, codec, level)
+        self.size = size
+        # number of bytes which didn't fit in the buffer
+        self.nbdropped = 0
+        self._chunks = deque()
+        self._buffered = 0
+        self._keep = None
+        self._decided = threading.Event()
+
+    def keep(self):
+        """
+        Write the captured data to the file
+        """
+        self._keep = True
+        self._decided.set()
+
+    def discard(self):
+        """
+        Drop the captured data
+        """
+        self._keep = False
+        self._decided.set()
+
+    def run(self):
+        try:
+            try:
+                while True:
+                    buf = os.read(self._readfd, self.BLOCKSIZE)
+                    if not buf:
+                        break
+                    self.nbbytes += len(buf)
+                    self._chunks.append(buf)
+                    self._buffered += len(buf)
+                    while self._buffered - len(self._chunks[0]) >= self.size:
+                        chunk = self._chunks.popleft()
+                        self._buffered -= len(chunk)
+                        self.nbdropped += len(chunk)
+            finally:
+                self._closeReader()
+            self._decided.wait()
+            if not self._keep or not self.nbbytes:
+                debug("dropping %d captured bytes", self._buffered)
+                self._chunks.clear()
+                os.remove(self.path)
+                return
+            debug("writing %d captured bytes to %s", self._buffered, self.path)
+            out = self._openOutput()
+            try:
+                if self.nbdropped:
+                    out.write("[%d bytes dropped]\n" % self.nbdropped)
+                while self._chunks:
+                    out.write(self._chunks.popleft())
+            finally:
+                out.close()
+        except:
+            exception("Error while writing captured data to %s", self.path)
+
 def unicode_dict(adict):
     """
     Returns a copy on the given dictionnary where all string values
@@ -221,3 +399,25 @@ def unicode_dict(adict):
         else:
             res[key] = val
     return res
+
+def get_cache_directory(name=None):
+    """
+    Returns the path of the insanity cache directory (or of its 'name'
+    subdirectory), creating it if needed.
+
+    The cache directory is $XDG_CACHE_HOME/insanity, or
+    ~/.cache/insanity if XDG_CACHE_HOME isn't set.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or \
+           os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "insanity")
+    if name:
+        path = os.path.join(path, name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # might have been created by another process in the meantime
+            if not os.path.isdir(path):
+                raise
+    return path
@@ -124,9 +124,12 @@ packages = [
 scripts = [
     "bin/gst-media-test",
     "bin/insanity-compare",
+    "bin/insanity-dbprune",
+    "bin/insanity-dbupgrade",
     "bin/insanity-dumpresults",
     "bin/insanity-grouper",
     "bin/insanity-gtk",
+    "bin/insanity-mediaindex",
     "bin/insanity-run",
     ]
 
@@ -24,6 +24,7 @@ Full gnonlin scenario
 """
 
 from insanity.scenario import Scenario
+from insanity.mediaindex import get_media_index
 from tests.gnltest import GnlFileSourceTest, GnlFullFileSourceTest
 from tests.typefind import TypeFindTest
 import gst
@@ -35,6 +36,9 @@ class FullGnlFileSourceScenario(Scenario):
     __test_full_description__ = """
     Will analyze a given uri (using typefind-test) and then add a gnltest
     for each contained stream.
+
+    The typefind-test isn't run if the streams of the uri are already known
+    by the media index.
     """
     __test_name__ = "full-gnlfilesource-scenario"
 
@@ -44,8 +48,13 @@ class FullGnlFileSourceScenario(Scenario):
         if not Scenario.setUp(self):
             return False
         self.__doneTypeFindTest = False
-        # add the initial typefind test
-        self.addSubTest(TypeFindTest, self.arguments)
+        mediainfo = get_media_index().getMediaInfo(self.arguments.get("uri"))
+        if mediainfo != None and mediainfo["streams"] != None:
+            self.__doneTypeFindTest = True
+            self._addStreamSubTests(mediainfo["duration"], mediainfo["streams"])
+        else:
+            # add the initial typefind test
+            self.addSubTest(TypeFindTest, self.arguments)
         return True
 
     def subTestDone(self, test):
@@ -58,6 +67,14 @@ class FullGnlFileSourceScenario(Scenario):
         if not 'streams' in infos.keys():
             return False
 
+        # remember them for the next runs
+        streams = [(str(padname), int(length), str(caps))
+                   for padname, length, caps in infos["streams"]]
+        get_media_index().setMediaInfo(self.arguments.get("uri"),
+                                       {"mimetype" : infos.get("mimetype") and str(infos["mimetype"]),
+                                        "duration" : int(infos.get("total-uri-duration", -1)),
+                                        "streams" : streams})
+
         if not 'total-uri-duration' in infos.keys():
             return False
 
@@ -68,7 +85,16 @@ class FullGnlFileSourceScenario(Scenario):
             if checks[item] == False:
                 return False
 
-        uriduration = infos['total-uri-duration']
+        if not self._addStreamSubTests(infos['total-uri-duration'], streams):
+            return False
+        self.__doneTypeFindTest = True
+        return True
+
+    def _addStreamSubTests(self, uriduration, upstreams):
+        """
+        Adds a GnlFileSourceTest for each raw stream, returns False if there
+        weren't any.
+        """
         if uriduration <= 0:
             return False
         # pick a duration/media-start which is within the given uri duration
@@ -78,7 +104,6 @@ class FullGnlFileSourceScenario(Scenario):
             duration = mstart
 
         # we can carry on if we have some raw streams
-        upstreams = infos["streams"]
         streams = self._extractRawStreams(upstreams)
         if streams == []:
             return False
@@ -91,7 +116,6 @@ class FullGnlFileSourceScenario(Scenario):
             args["media-start"] = mstart
             args["duration"] = duration
             self.addSubTest(self._subtest_type, args)
-        self.__doneTypeFindTest = True
         return True
 
     def _extractRawStreams(self, streams):
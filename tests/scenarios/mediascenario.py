@@ -24,6 +24,7 @@ Simple media-based scenarios
 """
 
 from insanity.scenario import ListScenario
+from insanity.mediaindex import get_media_index, NON_MEDIA_TYPES
 from tests.ismedia import IsMediaTest
 
 class MediaBarrierScenario(ListScenario):
@@ -36,29 +37,38 @@ class MediaBarrierScenario(ListScenario):
     This scenario will first check the mime-type of the given uri/file
     and if it is not a useable media type, will return without executing
     the given tests.
+
+    The mime-type is only checked (with is-media-test) if it isn't
+    already known by the media index.
     """
-    __non_media_types__ = [
-        "application/x-rar",
-        "application/zip",
-        "application/x-gzip",
-        "text/plain"
-        ]
+    __non_media_types__ = NON_MEDIA_TYPES
 
     def setUp(self):
         if not ListScenario.setUp(self):
             return False
-        # first add a typefind test
-        self.addSubTest(IsMediaTest,
-                        self.arguments,
-                        [], position=0)
+        mediainfo = get_media_index().getMediaInfo(self.arguments.get("uri"))
+        if mediainfo == None or mediainfo["ismedia"] == None:
+            # first add a typefind test
+            self.addSubTest(IsMediaTest,
+                            self.arguments,
+                            [], position=0)
+        elif not mediainfo["ismedia"]:
+            # nothing to run
+            del self._tests[:]
         return True
 
     def subTestDone(self, test):
+        if isinstance(test, IsMediaTest):
+            # get the type
+            mtype = test.getExtraInfo().get("mime-type")
+            if mtype:
+                mtype = str(mtype)
+                get_media_index().setMediaInfo(self.arguments.get("uri"),
+                                               {"mimetype" : mtype,
+                                                "ismedia" : not mtype in self.__non_media_types__})
         if ListScenario.subTestDone(self, test) == False:
             return False
         if isinstance(test, IsMediaTest):
-            # get the type
-            mtype = test.getExtraInfo()["mime-type"]
             if mtype in self.__non_media_types__:
                 return False
         return True
@@ -2,11 +2,28 @@ import time
 import string
 import datetime
 import os.path
-from cPickle import dumps, loads
 from django.db import models
 from django.db.models import permalink
 from django.db import connection
 
+def _import_storage_module(name):
+    """
+    Returns the insanity.storage.<name> module
+    """
+    try:
+        return __import__("insanity.storage." + name, {}, {}, [name])
+    except ImportError:
+        # when running through manage.py, 'insanity' is this application
+        import imp
+        return imp.load_source("insanity_storage_" + name,
+                               os.path.join(os.path.dirname(__file__),
+                                            "..", "..", "insanity",
+                                            "storage", name + ".py"))
+
+decode_value = _import_storage_module("codec").decode_value
+checklist = _import_storage_module("checklist")
+compare = _import_storage_module("compare")
+
 class DateTimeIntegerField(models.IntegerField):
 
     """Like DateTimeField, but reads the value from an integer UNIX timestamp."""
@@ -186,7 +203,7 @@ class TestClassInfoArgumentsDict(models.Model):
     blobvalue = models.TextField(blank=True) # This field type is a guess.
 
     def _get_value(self):
-        return loads(str(self.blobvalue))
+        return decode_value(self.blobvalue)
     value = property(_get_value)
 
     def _get_description(self):
@@ -259,6 +276,7 @@ class TestRun(models.Model, CustomSQLInterface):
     clientid = models.ForeignKey(Client, db_column="clientid")
     starttime = DateTimeIntegerField(null=True, blank=True)
     stoptime = DateTimeIntegerField(null=True, blank=True)
+    environmentid = models.IntegerField(null=True, blank=True)
     class Meta:
         db_table = 'testrun'
 
@@ -306,40 +324,91 @@ class TestRun(models.Model, CustomSQLInterface):
 
         return [Test.objects.get(pk=i) for i in res]
 
-    # FIXME : This is insanely crufty and not performant at all
     def compare(self, other):
         """
-        Compares the tests from self and the tests from other.
+        Compares the tests from other against the tests from self.
 
         Returns a tuple of 5 values:
         * list of tests in other which are not in self
         * list of tests in self which are not in other
-        * list of tests in self which have improved compared to the one in other
-        * list of tests in self which have regressed compared to the one in other
+        * list of tests in other which have improved compared to the one in self
+        * list of tests in other which have regressed compared to the one in self
         * a dictionnary mapping of:
-          * test from self
-          * corresponding test from other
+          * test from other
+          * list of corresponding tests from self
+
+        Tests stored without fingerprints (use insanity-dbupgrade -f to
+        compute them) don't match any other test.
         """
         if not isinstance(other, TestRun):
             raise TypeError
+        def fetchall(query, args):
+            return self._fetchAll(query.replace("?", "%s"), args)
+        new, gone, imps, regs, mapping = compare.compare_testruns(fetchall,
+                                                                  self.id,
+                                                                  other.id)
+        ids = set(new + gone)
+        for testid, oldids in mapping.iteritems():
+            ids.add(testid)
+            ids.update(oldids)
+        tests = Test.objects.in_bulk(list(ids))
         newmapping = {}
-        oldinnew = []
-        newtests = []
-
-        for othert in other.test_set.all():
-            anc = self.find_test_similar_args(othert)
-            if anc == []:
-                newtests.append(othert)
-            else:
-                newmapping[othert] = anc
-                oldinnew.extend(anc)
-        testsgone = [x for x in self.test_set.all() if not x in oldinnew]
-
-        return newmapping
+        for testid, oldids in mapping.iteritems():
+            newmapping[tests[testid]] = [tests[x] for x in oldids]
+        return ([tests[x] for x in new], [tests[x] for x in gone],
+                [tests[x] for x in imps], [tests[x] for x in regs],
+                newmapping)
 
     def __str__(self):
         return "Testrun #%d [%s]" % (self.id, self.starttime)
 
+def checklist_where(checkname, validated=None, passed=None):
+    """
+    Returns a SQL condition (usable in QuerySet.extra(where=...)) on the
+    test checklist bitmasks for the given check.
+
+    If validated is not None, only tests for which the check was (or
+    wasn't) validated are matched.
+    If passed is not None, only tests for which the check passed (or
+    didn't pass) are matched.
+    """
+    cif = CustomSQLInterface()
+    classes = cif._fetchAll("SELECT id, type, parent FROM testclassinfo")
+    checks = cif._fetchAll("SELECT id, containerid, name FROM testclassinfo_checklist_dict")
+    ordinals = checklist.compute_checklist_ordinals(classes, checks)
+
+    typeids = {}
+    children = {}
+    for classid, ctype, parent in classes:
+        typeids[classid] = ctype
+        children.setdefault(parent, []).append((classid, ctype))
+    def subclasses(ctype):
+        res = []
+        for classid, subtype in children.get(ctype, []):
+            res.append(classid)
+            res.extend(subclasses(subtype))
+        return res
+
+    clauses = []
+    for checkid, classid, name in checks:
+        if name != checkname:
+            continue
+        ordinal = ordinals[checkid]
+        if ordinal >= checklist.MAX_CHECKLIST_BITS:
+            continue
+        bit = 1 << ordinal
+        # the same bit can be used by a different check in other classes
+        types = [classid] + subclasses(typeids[classid])
+        conds = ["test.type IN (%s)" % ",".join([str(x) for x in types])]
+        if validated != None:
+            conds.append("(test.validatedmask & %d) %s 0" % (bit, validated and "<>" or "="))
+        if passed != None:
+            conds.append("(test.passedmask & %d) %s 0" % (bit, passed and "<>" or "="))
+        clauses.append("(%s)" % " AND ".join(conds))
+    if not clauses:
+        return "1 = 0"
+    return "(%s)" % " OR ".join(clauses)
+
 class TestManager(models.Manager):
     def failed(self):
         """Only returns the tests that succeeded"""
@@ -359,9 +428,18 @@ class TestManager(models.Manager):
 
     def timedout(self):
         """Filters the QuerySet to only return tests that timed out"""
-        # timed-out tests are definitely failed
-        return self.failed().exclude(checklist__name__name="no-timeout",
-                                     checklist__value=1)
+        return self.filter(timedout=1)
+
+    def crashed(self):
+        """Filters the QuerySet to only return tests whose subprocess
+        crashed"""
+        return self.filter(crashed=1)
+
+    def failedcheck(self, checkname):
+        """Filters the QuerySet to only return tests for which the given
+        check was validated and didn't pass"""
+        return self.extra(where=[checklist_where(checkname, validated=True,
+                                                 passed=False)])
 
 class Test(models.Model):
     objects = TestManager()
@@ -370,6 +448,12 @@ class Test(models.Model):
     type = models.ForeignKey(TestClassInfo, db_column="type",
                              related_name="instances")
     resultpercentage = models.TextField(blank=True) # This field type is a guess.
+    validatedmask = models.IntegerField(null=True, blank=True)
+    passedmask = models.IntegerField(null=True, blank=True)
+    returncode = models.IntegerField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    timedout = models.IntegerField(null=True, blank=True)
+    crashed = models.IntegerField(null=True, blank=True)
 
     def get_absolute_url(self):
         return ('web.insanity.views.test_summary', [str(self.id)])
@@ -499,27 +583,21 @@ class Test(models.Model):
                     ret = "Process return code : %d" % retcode
             return ret
 
-        err = None
-
         # pre-computed extras
         if allextras != None:
-            errs = [x for x in allextras if x.containerid==self and x.name.name in ["subprocess-return-code","errors"]]
+            errs = [x for x in allextras if x.containerid==self and x.name.name == "errors"]
         else:
             try:
-                errs = self.extrainfo.all().select_related("name__name", "intvalue","txtvalue","blobvalue").filter(name__name__in=["errors", "subprocess-return-code"])
+                errs = self.extrainfo.all().select_related("name__name", "intvalue","txtvalue","blobvalue").filter(name__name="errors")
             except:
                 errs = []
 
-        if len(errs) == 0:
-            return None
-
-        errs = errs[0]
-        if errs.name.name == "errors":
-            err = stringify_gst_error(errs.value[0])
-        else: # it can only be subprocess-return-code
-            err = stringify_return_code(errs.intvalue)
-
-        return err
+        if len(errs) != 0:
+            return stringify_gst_error(errs[0].value[0])
+        # the return code is stored in the test table
+        if self.returncode != None:
+            return stringify_return_code(self.returncode)
+        return None
     test_error = property(_test_error)
 
     class Meta:
@@ -562,7 +640,7 @@ class MonitorArgumentsDict(models.Model):
             return self.intvalue
         if not self.txtvalue == None:
             return self.txtvalue
-        return loads(str(self.blobvalue))
+        return decode_value(self.blobvalue)
     value = property(_get_value)
 
     class Meta:
@@ -603,7 +681,7 @@ class MonitorExtraInfoDict(models.Model):
             return self.intvalue
         if not self.txtvalue == None:
             return self.txtvalue
-        return loads(str(self.blobvalue))
+        return decode_value(self.blobvalue)
     value = property(_get_value)
 
     class Meta:
@@ -641,9 +719,9 @@ class TestArgumentsDict(models.Model):
         if not self.txtvalue == None:
             return self.txtvalue
         try:
-            val = loads(str(self.blobvalue))
+            val = decode_value(self.blobvalue)
         except:
-            val = "Non-pickleable value, fix test"
+            val = "Non-decodable value, fix test"
         return val
     value = property(_get_value)
 
@@ -690,7 +768,7 @@ class TestExtraInfoDict(models.Model):
             return self.intvalue
         if not self.txtvalue == None:
             return self.txtvalue
-        return loads(str(self.blobvalue))
+        return decode_value(self.blobvalue)
     value = property(_get_value)
 
     class Meta:
@@ -711,12 +789,42 @@ class TestRunEnvironmentDict(models.Model):
             return self.intvalue
         if not self.txtvalue == None:
             return self.txtvalue
-        return loads(str(self.blobvalue))
+        return decode_value(self.blobvalue)
     value = property(_get_value)
 
     class Meta:
         db_table = 'testrun_environment_dict'
 
+class TestRunDuplicate(models.Model):
+    id = models.IntegerField(null=True, primary_key=True, blank=True)
+    testrunid = models.ForeignKey(TestRun, db_column="testrunid",
+                                  related_name="duplicates")
+    value = models.TextField(blank=True)
+    duplicate = models.TextField(blank=True)
+
+    class Meta:
+        db_table = 'testrun_duplicate'
+
+class CrashBucket(models.Model):
+    id = models.IntegerField(null=True, primary_key=True, blank=True)
+    signature = models.TextField(blank=True)
+    signum = models.IntegerField(null=True, blank=True)
+    frames = models.TextField(blank=True)
+    creationtime = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'crash_bucket'
+
+class TestCrash(models.Model):
+    id = models.IntegerField(null=True, primary_key=True, blank=True)
+    testid = models.ForeignKey(Test, db_column="testid",
+                               related_name="crashes")
+    bucketid = models.ForeignKey(CrashBucket, db_column="bucketid",
+                                 related_name="tests")
+
+    class Meta:
+        db_table = 'test_crash'
+
 class Version(models.Model):
     version = models.IntegerField(null=True, blank=True)
     modificationtime = models.IntegerField(null=True, blank=True)
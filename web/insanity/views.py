@@ -46,11 +46,11 @@ def matrix_view(request, testrun_id):
 
     # crashonly and timedoutonly are exclusive
     if crashonly:
-        testsinst = testsinst.filter(checklist__name__name="subprocess-exited-normally",
-                                     checklist__value=0)
+        # the subprocess didn't exit normally (non-zero return code),
+        # whether it was killed by a signal or returned an error
+        testsinst = testsinst.filter(returncode__isnull=False).exclude(returncode=0).exclude(timedout=1)
     elif timedoutonly:
-        testsinst = testsinst.filter(checklist__name__name="no-timeout",
-                                     checklist__value=0)
+        testsinst = testsinst.filter(timedout=1)
 
     if not showscenario:
         sctypes = TestClassInfo.objects.scenarios()
@@ -78,7 +78,7 @@ def matrix_view(request, testrun_id):
             checks = TestCheckListList.objects.select_related("containerid", "name","value").filter(containerid__in=query)
             args = TestArgumentsDict.objects.select_related("containerid", "name","intvalue","txtvalue","blobvalue").filter(containerid__in=query)
             extras = TestExtraInfoDict.objects.select_related("containerid", "name__name", "intvalue", "txtvalue", "blobvalue").filter(containerid__in=query,
-                                                                                                                                       name__name__in=["subprocess-return-code","errors"])
+                                                                                                                                       name__name="errors")
             tests.append({"type":t,
                           "tests":query,
                           "fullchecklist":t.fullchecklist,